@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Micro-benchmark: per-rule url filtering vs the compiled UrlAdmission.
+
+    python benchmarks/bench_admission.py [--links N] [--repeat R]
+
+Prints one JSON object with the timings of both implementations on the same
+synthetic link set (Douban-like, with many duplicates and rejects).
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from spinbot.spider.admission import UrlAdmission, lenient_host  # noqa: E402
+
+ALLOWED_PATHS = [r'/group/\w+/members', r'/group/\w+/$']
+ITEM_PATHS = {'group': r'/group/\w+/members'}
+EXCLUDE = '(sec.douban.com|accounts/connect/sina_weibo/)'
+ROOT_DOMAINS = {'www.douban.com'}
+
+
+class LegacyRules(object):
+  """The per-call rule evaluation BaseCrawler used to do."""
+
+  def __init__(self):
+    self.root_domains = ROOT_DOMAINS
+    self.strict = True
+    self.exclude = EXCLUDE
+
+  def host_okay(self, host):
+    host = host.lower()
+    if host in self.root_domains:
+      return True
+    if re.match(r'\A[\d\.]*\Z', host):
+      return False
+    if self.strict:
+      host = host[4:] if host.startswith('www.') else 'www.' + host
+      return host in self.root_domains
+    return lenient_host(host) in self.root_domains
+
+  def path_allowed(self, url):
+    for rule in ALLOWED_PATHS:
+      if re.search(rule, url):
+        return True
+    return False
+
+  def url_allowed(self, url):
+    if self.exclude and re.search(self.exclude, url):
+      return False
+    parts = urllib.parse.urlparse(url)
+    if parts.scheme not in ('http', 'https'):
+      return False
+    host, port = urllib.parse.splitport(parts.netloc)
+    if not self.host_okay(host):
+      return False
+    return self.path_allowed(url)
+
+  def parse_item_allowed(self, url):
+    for key, rule in ITEM_PATHS.items():
+      if re.search(rule, url):
+        return key
+    return None
+
+
+def make_links(count, seed=42):
+  rng = random.Random(seed)
+  templates = [
+    'https://www.douban.com/group/{}/members?start={}',
+    'https://www.douban.com/group/{}/',
+    'https://www.douban.com/group/topic/{}/?start={}',
+    'https://www.douban.com/people/{}/',
+    'https://sec.douban.com/b?r={}&s={}',
+    'https://img3.doubanio.com/view/group/{}/{}.jpg',
+    'javascript:void({}{})',
+  ]
+  groups = [rng.randint(100000, 600000) for _ in range(count // 20 or 1)]
+  links = []
+  for _ in range(count):
+    template = rng.choice(templates)
+    links.append(template.format(rng.choice(groups), rng.randrange(0, 700, 35)))
+  return links
+
+
+def run(links, repeat):
+  legacy = LegacyRules()
+  started = time.perf_counter()
+  for _ in range(repeat):
+    for link in links:
+      legacy.url_allowed(link)
+      legacy.parse_item_allowed(link)
+  legacy_secs = time.perf_counter() - started
+
+  admission = UrlAdmission(ROOT_DOMAINS, strict=True, exclude=EXCLUDE,
+                           allowed_paths=ALLOWED_PATHS, item_paths=ITEM_PATHS)
+  started = time.perf_counter()
+  for _ in range(repeat):
+    for link in links:
+      admission.check(link)
+  compiled_secs = time.perf_counter() - started
+
+  mismatches = sum(
+    1 for link in links
+    if (legacy.url_allowed(link), legacy.parse_item_allowed(link)) !=
+    tuple(admission.check(link)))
+  calls = len(links) * repeat
+  return {
+    'links': len(links),
+    'distinct_links': len(set(links)),
+    'repeat': repeat,
+    'legacy_us_per_link': legacy_secs / calls * 1e6,
+    'compiled_us_per_link': compiled_secs / calls * 1e6,
+    'speedup': legacy_secs / compiled_secs if compiled_secs else None,
+    'mismatches': mismatches,
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--links', type=int, default=200000)
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+  print(json.dumps(run(make_links(args.links), args.repeat), indent=2))
+
+
+if __name__ == '__main__':
+  main()
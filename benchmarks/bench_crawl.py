@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""End-to-end crawl throughput against local stand-in servers.
+
+    python benchmarks/bench_crawl.py [--scenario NAME ...] [--scale S]
+        [--repeat R] [--out FILE] [--compare BASELINE.json]
+
+Each scenario serves synthetic Douban or couplet pages plus a fake proxy
+upstream (see stand_in.py) from one process and runs the real
+DoubanGroupUserCrawler / CoupletCrawler in a fresh one, so peak RSS and CPU
+are the crawler's alone.  Member users are counted in memory instead of
+written to MongoDB.  Prints one JSON object: pages/sec, exact p50/p99 fetch
+latency, peak RSS and CPU per page for every scenario, with the commit they
+were measured on.  --compare adds new/old ratios against an earlier output.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import uvloop  # noqa: E402
+
+from spinbot.spider import crawler as crawler_module  # noqa: E402
+from spinbot.spider.crawl import close_crawler  # noqa: E402
+from spinbot.spider.crawler import (CoupletCrawler,  # noqa: E402
+                                    DoubanGroupUserCrawler)
+from spinbot.spider.parsers import ParserPool  # noqa: E402
+from spinbot.spider.proxy import IndexedProxyPool  # noqa: E402
+from stand_in import Site, serve  # noqa: E402
+
+# Site options per scenario; 'crawler' picks the crawler, 'proxy_rate' the
+# per-proxy request rate (the crawler default of 2/s would make every run
+# measure proxy pacing rather than the crawler).
+SCENARIOS = {
+  'douban': dict(crawler='douban', groups=60),
+  'douban_latency': dict(crawler='douban', groups=60, latency=0.05),
+  'douban_errors': dict(crawler='douban', groups=60, error_rate=0.05),
+  'douban_bans': dict(crawler='douban', groups=60, ban_rate=0.05,
+                      dead_rate=0.1),
+  'douban_paced': dict(crawler='douban', groups=10, proxy_rate=2),
+  'couplets': dict(crawler='couplet', couplet_pages=600),
+  'couplets_latency': dict(crawler='couplet', couplet_pages=600,
+                           latency=0.05),
+}
+SCALED = ('groups', 'couplet_pages')
+METRICS = ('pages_per_sec', 'latency_p50', 'latency_p99', 'peak_rss_mb',
+           'cpu_ms_per_page')
+
+
+class BenchDoubanCrawler(DoubanGroupUserCrawler):
+
+  def __init__(self, site, proxy_rate, **kwargs):
+    self.GROUP_BASE_URL = site.origin + '/group/{}/members'
+    self.latencies = []
+    super(BenchDoubanCrawler, self).__init__(
+      [site.origin + '/'], group_ids=list(site.group_ids()), **kwargs)
+    self.upstream_url = site.upstream + '/get_all/'
+    self.proxy_pool = IndexedProxyPool(rate=proxy_rate, burst=self.burst,
+                                       max_fail=self.max_fail)
+
+  def record_statistic(self, fetch_statistic, elapsed=None):
+    super(BenchDoubanCrawler, self).record_statistic(fetch_statistic, elapsed)
+    if elapsed is not None:
+      self.latencies.append(elapsed)
+
+  def default_sinks(self):
+    return []
+
+  def items(self):
+    return len(self._users)
+
+
+class BenchCoupletCrawler(CoupletCrawler):
+
+  def __init__(self, site, proxy_rate, **kwargs):
+    domain = re.escape('http://www.duiduilian.com')
+    origin = re.escape(site.origin)
+    self.ALLOWED_PATHS = [rule.replace(domain, origin)
+                          for rule in CoupletCrawler.ALLOWED_PATHS]
+    self.ITEM_PATHS = {key: rule.replace(domain, origin)
+                       for key, rule in CoupletCrawler.ITEM_PATHS.items()}
+    self.latencies = []
+    self.couplets = set()
+    super(BenchCoupletCrawler, self).__init__(
+      [site.origin + '/chunlian/list0/'], **kwargs)
+
+  def record_statistic(self, fetch_statistic, elapsed=None):
+    super(BenchCoupletCrawler, self).record_statistic(fetch_statistic,
+                                                      elapsed)
+    if elapsed is not None:
+      self.latencies.append(elapsed)
+
+  def items(self):
+    return len(self.couplets)
+
+
+def percentile(values, p):
+  if not values:
+    return None
+  values = sorted(values)
+  return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def cpu_secs(usage):
+  return usage.ru_utime + usage.ru_stime
+
+
+def run_scenario(site, kind, proxy_rate, max_tasks, parse_executor):
+  """Crawl site once in this (fresh) process and return its metrics."""
+  crawler_module.PROXY_URL = site.upstream + '/get/'
+  asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+  loop = asyncio.get_event_loop()
+  crawler_class = BenchDoubanCrawler if kind == 'douban' else \
+    BenchCoupletCrawler
+  crawler = crawler_class(site, proxy_rate, max_tasks=max_tasks,
+                          user_agents=['bench-a', 'bench-b'], loop=loop,
+                          parser_pool=ParserPool(parse_executor),
+                          stats_ring_size=10)
+  before = resource.getrusage(resource.RUSAGE_SELF)
+  started = time.perf_counter()
+  loop.run_until_complete(crawler.crawl())
+  wall = time.perf_counter() - started
+  after = resource.getrusage(resource.RUSAGE_SELF)
+  pages = len(crawler.stats)
+  cpu = cpu_secs(after) - cpu_secs(before)
+  rss_unit = 1 if sys.platform == 'darwin' else 1024
+  result = {
+    'pages': pages,
+    'items': crawler.items(),
+    'expected_items': (site.expected_users() if kind == 'douban'
+                       else site.expected_couplets()),
+    'retries': sum(crawler.stats.retries.values()),
+    'failures': crawler.retry_policy.exhausted +
+    crawler.retry_policy.over_budget,
+    'wall_secs': wall,
+    'pages_per_sec': pages / wall if wall else None,
+    'latency_p50': percentile(crawler.latencies, 50),
+    'latency_p99': percentile(crawler.latencies, 99),
+    'peak_rss_mb': after.ru_maxrss * rss_unit / 2 ** 20,
+    'cpu_ms_per_page': cpu / pages * 1000 if pages else None,
+  }
+  close_crawler(crawler, loop)
+  return result
+
+
+def run(name, scale, max_tasks, parse_executor, origin_port):
+  options = dict(SCENARIOS[name])
+  kind = options.pop('crawler')
+  proxy_rate = options.pop('proxy_rate', 1000)
+  for key in SCALED:
+    if key in options:
+      options[key] = max(1, int(options[key] * scale))
+  site = Site(origin_port=origin_port, **options)
+  context = multiprocessing.get_context('spawn')
+  ready, stop = context.Event(), context.Event()
+  server = context.Process(target=serve, args=(site, ready, stop),
+                           daemon=True)
+  server.start()
+  try:
+    if not ready.wait(30):
+      raise RuntimeError('stand-in server for {} did not start'.format(name))
+    with concurrent.futures.ProcessPoolExecutor(
+        1, mp_context=context) as executor:
+      result = executor.submit(run_scenario, site, kind, proxy_rate,
+                               max_tasks, parse_executor).result()
+  finally:
+    stop.set()
+    server.join(10)
+  result['scenario'] = dict(SCENARIOS[name], **options)
+  return result
+
+
+def median_run(runs):
+  runs = sorted(runs, key=lambda r: r['pages_per_sec'] or 0)
+  result = dict(runs[len(runs) // 2])
+  result['runs_pages_per_sec'] = [r['pages_per_sec'] for r in runs]
+  return result
+
+
+def git_commit():
+  try:
+    return subprocess.check_output(
+      ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+      stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def compare(results, baseline):
+  for name, result in results.items():
+    old = baseline.get('scenarios', {}).get(name)
+    if not old:
+      continue
+    result['vs_baseline'] = {
+      metric: result[metric] / old[metric]
+      for metric in METRICS
+      if result.get(metric) is not None and old.get(metric)}
+  return baseline.get('commit')
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                      help='Scenario to run (repeatable, default all)')
+  parser.add_argument('--scale', type=float, default=1.0,
+                      help='Multiply the groups / pages of every scenario')
+  parser.add_argument('--repeat', type=int, default=1,
+                      help='Runs per scenario; the median one is reported')
+  parser.add_argument('--max_tasks', type=int, default=50)
+  parser.add_argument('--parse_executor', default='inline',
+                      choices=('inline', 'thread', 'process'))
+  parser.add_argument('--origin_port', type=int, default=8901)
+  parser.add_argument('--out', help='Also write the JSON to this file')
+  parser.add_argument('--compare', metavar='BASELINE',
+                      help='Earlier output to compute new/old ratios against')
+  args = parser.parse_args()
+
+  results = {}
+  for name in args.scenario or sorted(SCENARIOS):
+    runs = [run(name, args.scale, args.max_tasks, args.parse_executor,
+                args.origin_port) for _ in range(args.repeat)]
+    results[name] = median_run(runs)
+  output = {
+    'commit': git_commit(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'options': {key: value for key, value in vars(args).items()
+                if key not in ('out', 'compare')},
+    'scenarios': results,
+  }
+  if args.compare:
+    with open(args.compare) as fp:
+      output['baseline_commit'] = compare(results, json.load(fp))
+  text = json.dumps(output, indent=2, ensure_ascii=False)
+  if args.out:
+    with open(args.out, 'w') as fp:
+      fp.write(text + '\n')
+  print(text)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Local stand-ins for the sites and services the crawlers talk to.
+
+One aiohttp app serves everything:
+
+  /group/<id>/members[?start=N]   synthetic Douban members pages (``.nbg``
+                                  entries, the ``.ft-members`` count and a
+                                  paginator), 35 members per page
+  /chunlian/list<k>/              couplet index pages linking 20 couplet
+                                  pages and the next index
+  /chunlian/<n>.html              couplet pages (``.content_zw > p``)
+  /get/, /get_all/                the proxy upstream: one or all proxies
+
+It listens on the origin port, the upstream port and every proxy port.  An
+aiohttp server answers absolute-form proxy requests from the path, so a
+"proxy" is just another port of the same app.  ``Site`` knobs add latency,
+5xx errors, bans (an empty members page, as Douban does) and dead groups,
+all drawn from seeded generators so runs are reproducible.
+
+    python benchmarks/stand_in.py --groups 100   # serve until interrupted
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import zlib
+
+from aiohttp import web
+
+MEMBERS_PER_PAGE = 35
+COUPLETS_PER_LIST = 20
+FIRST_GROUP_ID = 100000
+
+
+class Site(object):
+
+  def __init__(self, groups=50, min_members=20, max_members=400,
+               couplet_pages=500, latency=0.0, error_rate=0.0, ban_rate=0.0,
+               dead_rate=0.0, seed=1, host='127.0.0.1', origin_port=8901,
+               upstream_port=5010, proxy_ports=16):
+    self.groups = groups
+    self.min_members = min_members
+    self.max_members = max_members
+    self.couplet_pages = couplet_pages
+    self.latency = latency
+    self.error_rate = error_rate
+    self.ban_rate = ban_rate
+    self.dead_rate = dead_rate
+    self.seed = seed
+    self.host = host
+    self.origin_port = origin_port
+    self.upstream_port = upstream_port
+    self.proxy_ports = [origin_port + 10 + i for i in range(proxy_ports)]
+    self.rng = random.Random(seed)
+    self.requests = 0
+
+  @property
+  def origin(self):
+    return 'http://{}:{}'.format(self.host, self.origin_port)
+
+  @property
+  def upstream(self):
+    return 'http://{}:{}'.format(self.host, self.upstream_port)
+
+  def group_ids(self):
+    return range(FIRST_GROUP_ID, FIRST_GROUP_ID + self.groups)
+
+  def _group_rng(self, gid):
+    return random.Random(self.seed * 1000003 + gid)
+
+  def group_dead(self, gid):
+    return self._group_rng(gid).random() < self.dead_rate
+
+  def group_members(self, gid):
+    rng = self._group_rng(gid)
+    rng.random()
+    return rng.randint(self.min_members, self.max_members)
+
+  def expected_users(self):
+    """Distinct users a complete crawl of the groups finds."""
+    return sum(self.group_members(gid) for gid in self.group_ids()
+               if not self.group_dead(gid))
+
+  def expected_couplets(self):
+    return sum(len(self.couplets(n)) for n in range(self.couplet_pages))
+
+  def couplets(self, n):
+    rng = random.Random(zlib.crc32(b'couplet') + n)
+    return [('上联{}之{}'.format(n, i), '下联{}之{}'.format(n, i))
+            for i in range(rng.randint(3, 8))]
+
+
+def members_page(site, gid, start):
+  count = site.group_members(gid)
+  entries = []
+  for index in range(start, min(count, start + MEMBERS_PER_PAGE)):
+    entries.append(
+      '<li class="member-item"><div class="pic">'
+      '<a class="nbg" href="https://www.douban.com/people/{0}-{1}/">'
+      '<img src="https://img3.doubanio.com/icon/u{0}-{1}.jpg" '
+      'alt="member {0}-{1}" class="imgnoga"></a></div>'
+      '<div class="name"><a href="https://www.douban.com/people/{0}-{1}/">'
+      'member {0}-{1}</a></div></li>'.format(gid, index))
+  paginator = ''
+  if start + MEMBERS_PER_PAGE < count:
+    paginator = ('<div class="paginator"><span class="next">'
+                 '<a href="/group/{}/members?start={}">next</a></span></div>'
+                 .format(gid, start + MEMBERS_PER_PAGE))
+  return (
+    '<html><head><title>group {0}</title></head><body>'
+    '<div class="mod side-nav"><p class="ft-members">'
+    '<a href="/group/{0}/members">members</a> <i>({1})</i></p></div>'
+    '<div class="member-list"><ul>{2}</ul></div>{3}'
+    '</body></html>'.format(gid, count, ''.join(entries), paginator))
+
+
+def banned_page():
+  return ('<html><body><div class="mod">'
+          '<p>please log in to see this group</p></div></body></html>')
+
+
+def couplet_list_page(site, k):
+  first = k * COUPLETS_PER_LIST
+  last = min(site.couplet_pages, first + COUPLETS_PER_LIST)
+  links = ''.join('<li><a href="/chunlian/{0}.html">couplet {0}</a></li>'
+                  .format(n) for n in range(first, last))
+  if last < site.couplet_pages:
+    links += '<li><a href="/chunlian/list{}/">next</a></li>'.format(k + 1)
+  return '<html><body><ul>{}</ul></body></html>'.format(links)
+
+
+def couplet_page(site, n):
+  paragraphs = []
+  for i, (first, second) in enumerate(site.couplets(n)):
+    if i % 2:
+      paragraphs.append('<p>{}\n{} 佚名</p>'.format(first, second))
+    else:
+      paragraphs.append('<p><font>{}</font><br><font>{}</font></p>'
+                        .format(first, second))
+  return ('<html><body><div class="content_zw">{}</div>'
+          '<a href="/chunlian/list0/">back</a></body></html>'
+          .format(''.join(paragraphs)))
+
+
+def make_app(site):
+  async def delay():
+    if site.latency:
+      await asyncio.sleep(site.latency * (0.5 + site.rng.random()))
+
+  def html_response(text):
+    return web.Response(text=text, content_type='text/html')
+
+  async def index(request):
+    site.requests += 1
+    return html_response(
+      '<html><body><a href="/chunlian/list0/">couplets</a></body></html>')
+
+  async def group_members(request):
+    site.requests += 1
+    await delay()
+    gid = int(request.match_info['gid'])
+    if gid not in site.group_ids() or site.group_dead(gid):
+      raise web.HTTPNotFound()
+    if site.rng.random() < site.error_rate:
+      raise web.HTTPServiceUnavailable()
+    if site.rng.random() < site.ban_rate:
+      return html_response(banned_page())
+    start = int(request.query.get('start', 0))
+    return html_response(members_page(site, gid, start))
+
+  async def couplet_list(request):
+    site.requests += 1
+    await delay()
+    k = int(request.match_info['k'])
+    if k * COUPLETS_PER_LIST >= max(site.couplet_pages, 1):
+      raise web.HTTPNotFound()
+    return html_response(couplet_list_page(site, k))
+
+  async def couplet(request):
+    site.requests += 1
+    await delay()
+    n = int(request.match_info['n'])
+    if n >= site.couplet_pages:
+      raise web.HTTPNotFound()
+    if site.rng.random() < site.error_rate:
+      raise web.HTTPServiceUnavailable()
+    return html_response(couplet_page(site, n))
+
+  async def get_proxy(request):
+    port = site.rng.choice(site.proxy_ports)
+    return web.Response(text='{}:{}'.format(site.host, port))
+
+  async def get_all_proxies(request):
+    return web.Response(
+      text=json.dumps(['{}:{}'.format(site.host, port)
+                       for port in site.proxy_ports]),
+      content_type='application/json')
+
+  app = web.Application()
+  app.router.add_get('/', index)
+  app.router.add_get(r'/group/{gid:\d+}/members', group_members)
+  app.router.add_get(r'/chunlian/list{k:\d+}/', couplet_list)
+  app.router.add_get(r'/chunlian/{n:\d+}.html', couplet)
+  app.router.add_get('/get/', get_proxy)
+  app.router.add_get('/get_all/', get_all_proxies)
+  return app
+
+
+async def start(site):
+  """Listen on every port of site; returns the runner to clean up."""
+  runner = web.AppRunner(make_app(site), access_log=None)
+  await runner.setup()
+  for port in [site.origin_port, site.upstream_port] + site.proxy_ports:
+    await web.TCPSite(runner, site.host, port).start()
+  return runner
+
+
+def serve(site, ready=None, stop=None):
+  """Run site in this process until stop (a multiprocessing Event) is set.
+  """
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  runner = loop.run_until_complete(start(site))
+  if ready is not None:
+    ready.set()
+  try:
+    if stop is None:
+      loop.run_forever()
+    else:
+      while not stop.is_set():
+        loop.run_until_complete(asyncio.sleep(0.1))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--groups', type=int, default=50)
+  parser.add_argument('--couplet_pages', type=int, default=500)
+  parser.add_argument('--latency', type=float, default=0.0)
+  parser.add_argument('--error_rate', type=float, default=0.0)
+  parser.add_argument('--ban_rate', type=float, default=0.0)
+  parser.add_argument('--dead_rate', type=float, default=0.0)
+  parser.add_argument('--origin_port', type=int, default=8901)
+  parser.add_argument('--upstream_port', type=int, default=5010)
+  parser.add_argument('--proxy_ports', type=int, default=16)
+  args = parser.parse_args()
+  site = Site(**vars(args))
+  print('origin {}, proxy upstream {}/get_all/'.format(site.origin,
+                                                       site.upstream))
+  serve(site)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+import asyncio
+import logging
+
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+
+class BulkWriter:
+    """
+    Buffer write operations for a motor collection and flush them as
+    unordered bulk_write batches.
+    A batch is sent once `batch_size` operations are queued or
+    `flush_interval` seconds after the first queued one.  When more than
+    `max_pending` operations wait for Mongo, `add` blocks until a batch has
+    been written, which pushes back on the producers.
+    """
+
+    def __init__(self, collection, batch_size=500, flush_interval=1.0,
+                 max_pending=5000):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max(max_pending, batch_size)
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self._ops = []
+        self._in_flight = 0
+        self._flush_task = None
+        self._timer = None
+        self._waiters = []
+
+    @property
+    def pending(self):
+        return len(self._ops) + self._in_flight
+
+    async def add(self, operation):
+        """
+        Queue one pymongo write operation (UpdateOne, InsertOne, ...)
+        :param operation: the write operation
+        """
+        while self.pending >= self.max_pending:
+            self._start_flush()
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+        self._ops.append(operation)
+        if len(self._ops) >= self.batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(
+                self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_all())
+
+    def _wake_waiters(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def _flush_all(self):
+        while self._ops:
+            batch = self._ops[:self.batch_size]
+            del self._ops[:self.batch_size]
+            self._in_flight = len(batch)
+            try:
+                result = await self.collection.bulk_write(batch, ordered=False)
+                self.written += len(batch)
+                logger.debug('bulk wrote %d ops (upserted %d, modified %d)',
+                             len(batch), result.upserted_count,
+                             result.modified_count)
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors', [])
+                self.failed += len(errors)
+                self.written += len(batch) - len(errors)
+                logger.error('bulk write to %s had %d errors: %r',
+                             self.collection.name, len(errors), errors[:3])
+            except Exception as e:
+                self.failed += len(batch)
+                logger.exception(e)
+            finally:
+                self._in_flight = 0
+                self.batches += 1
+                self._wake_waiters()
+
+    async def flush(self):
+        """
+        Write every queued operation
+        """
+        while self.pending:
+            self._start_flush()
+            await asyncio.shield(self._flush_task)
+
+    async def close(self):
+        await self.flush()
+        self._wake_waiters()
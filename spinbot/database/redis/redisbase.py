@@ -15,7 +15,7 @@ class RedisSession:
                                                 maxsize=10)
       else:
         self._pool = await aioredis.create_pool(
-          'redis://{}'.format(REDIS_SETTING.get('HOST'), 'localhost'),
+          'redis://{}'.format(REDIS_SETTING.get('HOST', 'localhost')),
           db=REDIS_SETTING.get('DB', None),
           minsize=REDIS_SETTING.get('POOLSIZE', 5),
           maxsize=REDIS_SETTING.get('POOLSIZE', 5) + 10)
@@ -15,10 +15,17 @@ MONGODB = dict(
 
 LOG_LEVEL = logging.DEBUG
 
+REDIS_SETTING = dict(
+  HOST=os.getenv('REDIS_HOST', 'localhost'),
+  DB=int(os.getenv('REDIS_DB', 0)),
+  POOLSIZE=5,
+)
+
 # crawler settings
 CRAWLER_SETTINGS = {
   'max_tries': 10,
   'max_tasks': 50,
+  'dedup': 'exact',
 }
 
 
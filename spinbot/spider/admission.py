@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Compiled URL admission rules.
+
+``UrlAdmission`` folds the crawler's exclude pattern, host matching,
+``ALLOWED_PATHS`` and ``ITEM_PATHS`` into precompiled matchers and caches the
+decision per url, so every discovered link costs one dict lookup once it
+has been seen.
+"""
+
+import functools
+import re
+import urllib.parse
+from collections import namedtuple
+
+IP_RE = re.compile(r'\A[\d\.]*\Z')
+
+Admission = namedtuple('Admission', 'allowed item_kind')
+REJECTED = Admission(False, None)
+
+
+def lenient_host(host):
+  parts = host.split('.')[-2:]
+  return ''.join(parts)
+
+
+def compile_any(rules):
+  """Compile a list of regexes into one alternation, or None if empty."""
+  if not rules:
+    return None
+  try:
+    return re.compile('|'.join('(?:{})'.format(rule) for rule in rules))
+  except re.error:
+    # e.g. inline global flags that are only valid at the start of a
+    # pattern; fall back to trying the rules one by one.
+    compiled = [re.compile(rule) for rule in rules]
+    return _AnyOf(compiled)
+
+
+class _AnyOf(object):
+
+  def __init__(self, patterns):
+    self.patterns = patterns
+
+  def search(self, string):
+    for pattern in self.patterns:
+      match = pattern.search(string)
+      if match:
+        return match
+    return None
+
+
+class UrlAdmission(object):
+  """Decide once per url whether it may be crawled and which item it is.
+
+  ``root_domains`` is the crawler's live set, so hosts added after
+  construction are honoured; cached decisions are dropped by ``clear()``.
+  """
+
+  def __init__(self, root_domains, strict=True, exclude=None,
+               allowed_paths=None, item_paths=None, cache_size=1 << 16):
+    self.root_domains = root_domains
+    self.strict = strict
+    self.exclude = re.compile(exclude) if exclude else None
+    self.allowed = compile_any(allowed_paths)
+    item_paths = item_paths or {}
+    self.item_rules = [(kind, re.compile(rule))
+                       for kind, rule in item_paths.items()]
+    self.any_item = compile_any(list(item_paths.values()))
+    self.check = functools.lru_cache(maxsize=cache_size)(self._check)
+
+  def clear(self):
+    self.check.cache_clear()
+
+  def host_okay(self, host):
+    """Check if a host should be crawled.
+    A literal match (after lowercasing) is always good.  For hosts
+    that don't look like IP addresses, some approximate matches
+    are okay depending on the strict flag.
+    """
+    host = host.lower()
+    root_domains = self.root_domains
+    if host in root_domains:
+      return True
+    if IP_RE.match(host):
+      return False
+    if self.strict:
+      host = host[4:] if host.startswith('www.') else 'www.' + host
+      return host in root_domains
+    return lenient_host(host) in root_domains
+
+  def path_allowed(self, url):
+    return self.allowed is not None and self.allowed.search(url) is not None
+
+  def item_kind(self, url):
+    if self.any_item is None or not self.any_item.search(url):
+      return None
+    if len(self.item_rules) == 1:
+      return self.item_rules[0][0]
+    for kind, rule in self.item_rules:
+      if rule.search(url):
+        return kind
+    return None
+
+  def _check(self, url):
+    item_kind = self.item_kind(url)
+    if self.exclude is not None and self.exclude.search(url):
+      return Admission(False, item_kind)
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+      return Admission(False, item_kind)
+    host = parts.hostname
+    if not host or not self.host_okay(host):
+      return Admission(False, item_kind)
+    return Admission(self.path_allowed(url), item_kind)
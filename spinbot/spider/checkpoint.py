@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Checkpoint and resume for long crawls.
+
+A checkpoint directory holds two files:
+
+* ``seen.bin`` -- append-only log of the 64-bit fingerprints added to an
+  exact (``FingerprintSet``) seen store.  Each checkpoint appends only the
+  fingerprints added since the previous one.
+* ``state.pickle`` -- frontier (queued and in-flight items), aggregate
+  statistics, crawler specific progress (e.g. the position in
+  ``group_range``) and, for other seen stores, the whole store.  It is
+  rewritten atomically and records how much of ``seen.bin`` it covers, so a
+  crash between the two writes never leaves them inconsistent.
+
+The state also records the dedup mode; resuming with another one fails.
+"""
+
+import asyncio
+import logging
+import os
+import pickle
+import time
+from array import array
+
+from spinbot.utils.dedup import seen_store_mode
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = 'state.pickle'
+SEEN_FILE = 'seen.bin'
+VERSION = 1
+
+
+class CheckpointManager(object):
+
+  def __init__(self, path, interval=60):
+    self.path = path
+    self.interval = interval
+    self.saves = 0
+    self.last_save = None
+    self._task = None
+    # Length of seen.bin covered by the last state written.
+    self._seen_bytes = 0
+    os.makedirs(path, exist_ok=True)
+
+  @property
+  def state_path(self):
+    return os.path.join(self.path, STATE_FILE)
+
+  @property
+  def seen_path(self):
+    return os.path.join(self.path, SEEN_FILE)
+
+  def exists(self):
+    return os.path.exists(self.state_path)
+
+  def attach(self, crawler, resume=False):
+    """Prepare crawler for checkpointing, restoring it first if resume."""
+    seen = crawler.seen_urls
+    if resume and self.exists():
+      self.restore(crawler)
+      if hasattr(seen, 'start_journal'):
+        seen.start_journal(include_existing=False)
+    else:
+      for name in (self.state_path, self.seen_path):
+        if os.path.exists(name):
+          os.remove(name)
+      self._seen_bytes = 0
+      if hasattr(seen, 'start_journal'):
+        seen.start_journal()
+
+  def save(self, crawler):
+    started = time.time()
+    seen = crawler.seen_urls
+    journaled = hasattr(seen, 'drain_journal')
+    state = {
+      'version': VERSION,
+      'time': started,
+      'pending': crawler.pending_items(),
+      'stats': crawler.stats.state(),
+      'crawler': crawler.checkpoint_state(),
+      'dedup': seen_store_mode(seen),
+    }
+    if not journaled:
+      state['seen'] = seen
+      self._write_state(state)
+    else:
+      fingerprints = seen.drain_journal()
+      try:
+        with open(self.seen_path, 'ab') as fp:
+          # Drop whatever a failed save appended after the last state.
+          fp.truncate(self._seen_bytes)
+          fingerprints.tofile(fp)
+          fp.flush()
+          os.fsync(fp.fileno())
+          state['seen_bytes'] = fp.tell()
+        self._write_state(state)
+      except BaseException:
+        # Nothing was committed: keep the fingerprints for the next save.
+        seen.restore_journal(fingerprints)
+        raise
+      self._seen_bytes = state['seen_bytes']
+    self.saves += 1
+    self.last_save = time.time()
+    logger.info('checkpoint: %d pending urls, %d seen, %.3f secs',
+                len(state['pending']), len(seen), self.last_save - started)
+
+  def _write_state(self, state):
+    tmp_path = self.state_path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+      pickle.dump(state, fp, pickle.HIGHEST_PROTOCOL)
+      fp.flush()
+      os.fsync(fp.fileno())
+    os.replace(tmp_path, self.state_path)
+
+  def restore(self, crawler):
+    with open(self.state_path, 'rb') as fp:
+      state = pickle.load(fp)
+    if state.get('version') != VERSION:
+      raise ValueError('Unsupported checkpoint version: {!r}'.format(
+        state.get('version')))
+    mode = seen_store_mode(crawler.seen_urls)
+    if state.get('dedup', mode) != mode:
+      raise ValueError(
+        'Checkpoint {} was written with dedup mode {!r}, not {!r}; resume '
+        'with the same --dedup'.format(self.path, state['dedup'], mode))
+    if 'seen' in state:
+      crawler.seen_urls = state['seen']
+    else:
+      with open(self.seen_path, 'r+b') as fp:
+        fp.truncate(state['seen_bytes'])
+        fingerprints = array('Q')
+        fingerprints.frombytes(fp.read())
+      crawler.seen_urls.load_fingerprints(fingerprints)
+      self._seen_bytes = state['seen_bytes']
+    crawler.stats.restore(state['stats'])
+    crawler.restore_state(state['crawler'])
+    crawler.q.clear()
+    for item in state['pending']:
+      crawler.q.put_nowait(item)
+    logger.info('resumed checkpoint from %s: %d pending urls, %d seen',
+                time.ctime(state['time']), len(state['pending']),
+                len(crawler.seen_urls))
+
+  def start(self, crawler):
+    if self._task is None:
+      self._task = asyncio.ensure_future(self._save_forever(crawler))
+
+  def stop(self):
+    if self._task is not None:
+      self._task.cancel()
+      self._task = None
+
+  async def _save_forever(self, crawler):
+    while True:
+      await asyncio.sleep(self.interval)
+      try:
+        self.save(crawler)
+      except Exception as e:
+        logger.exception(e)
@@ -14,8 +14,20 @@ import sys
 import uvloop
 
 from spinbot.spider.crawler import DoubanGroupUserCrawler, CoupletCrawler, get_user_agents
+from spinbot.spider.checkpoint import CheckpointManager
+from spinbot.spider.httpcache import ConditionalCache
+from spinbot.spider.hooks import profiling_hooks
+from spinbot.spider.parsers import ParserPool
+from spinbot.spider.pipeline import JsonlSink, RedisSink
+from spinbot.spider.redis_frontier import RedisFrontier
 from spinbot.spider.reporting import *
+from spinbot.spider.retry import RetryPolicy
+from spinbot.spider.sharding import (MergedCrawl, run_sharded, shard_path,
+                                     shard_summary)
 from spinbot.settings import *
+from spinbot.utils.idcache import NegativeIdCache
+
+logger = logging.getLogger(__name__)
 
 ARGS = argparse.ArgumentParser(description="Web crawler")
 ARGS.add_argument(
@@ -34,10 +46,89 @@ ARGS.add_argument(
     '--max_tries', action='store', type=int, metavar='N',
     default=CRAWLER_SETTINGS.get('max_tries', 10),
     help='Limit retries on network errors')
+ARGS.add_argument(
+    '--retry_delay', action='store', type=float, metavar='SECS',
+    default=CRAWLER_SETTINGS.get('retry_delay', 1.0),
+    help='Backoff before the first retry (doubles per retry)')
+ARGS.add_argument(
+    '--retry_max_delay', action='store', type=float, metavar='SECS',
+    default=CRAWLER_SETTINGS.get('retry_max_delay', 300.0),
+    help='Upper bound of the retry backoff')
+ARGS.add_argument(
+    '--retry_budget', action='store', type=int, metavar='N',
+    default=CRAWLER_SETTINGS.get('retry_budget'),
+    help='Limit retries over the whole run')
+ARGS.add_argument(
+    '--retry_ratio', action='store', type=float, metavar='R',
+    default=CRAWLER_SETTINGS.get('retry_ratio'),
+    help='Limit retries to R per finished fetch')
 ARGS.add_argument(
     '--max_tasks', action='store', type=int, metavar='N',
     default=CRAWLER_SETTINGS.get('max_tasks', 5),
     help='Limit concurrent connections')
+ARGS.add_argument(
+    '--adaptive_tasks', action='store_true',
+    default=CRAWLER_SETTINGS.get('adaptive_tasks', False),
+    help='Adjust concurrent fetches between --min_tasks and --max_tasks')
+ARGS.add_argument(
+    '--min_tasks', action='store', type=int, metavar='N',
+    default=CRAWLER_SETTINGS.get('min_tasks', 1),
+    help='Lower bound of adaptive concurrency')
+ARGS.add_argument(
+    '--host_delay', action='store', type=float, metavar='SECS',
+    default=CRAWLER_SETTINGS.get('host_delay', 0.0),
+    help='Minimum delay between requests to the same host')
+ARGS.add_argument(
+    '--max_per_host', action='store', type=int, metavar='N',
+    default=CRAWLER_SETTINGS.get('max_per_host'),
+    help='Limit concurrent connections per host')
+ARGS.add_argument(
+    '--global_rate', action='store', type=float, metavar='RPS',
+    default=CRAWLER_SETTINGS.get('global_rate'),
+    help='Limit requests per second across all hosts')
+ARGS.add_argument(
+    '--host_rate', action='store', type=float, metavar='RPS',
+    default=CRAWLER_SETTINGS.get('host_rate'),
+    help='Limit requests per second per host')
+ARGS.add_argument(
+    '--keepalive_timeout', action='store', type=float, metavar='SECS',
+    default=CRAWLER_SETTINGS.get('keepalive_timeout', 30),
+    help='Keep idle connections (per target and proxy) open this long')
+ARGS.add_argument(
+    '--dns_ttl', action='store', type=int, metavar='SECS',
+    default=CRAWLER_SETTINGS.get('dns_ttl', 300),
+    help='Cache resolved host addresses this long')
+ARGS.add_argument(
+    '--max_body_size', action='store', type=int, metavar='BYTES',
+    default=CRAWLER_SETTINGS.get('max_body_size', 10 * 1024 * 1024),
+    help='Skip responses with larger bodies')
+ARGS.add_argument(
+    '--http_cache', action='store', metavar='PATH',
+    help='Revalidate pages against a persistent ETag/Last-Modified cache')
+ARGS.add_argument(
+    '--http_cache_size', action='store', type=int, metavar='BYTES',
+    default=64 * 1024 * 1024, help='Evict cache entries beyond this size')
+ARGS.add_argument(
+    '--dead_groups', action='store', metavar='PATH',
+    help='Persistent cache of dead/private/redirecting group ids to skip')
+ARGS.add_argument(
+    '--group_recheck_days', action='store', type=float, metavar='DAYS',
+    default=CRAWLER_SETTINGS.get('group_recheck_days', 30),
+    help='Try groups in --dead_groups again after this many days')
+ARGS.add_argument(
+    '--metrics_port', action='store', type=int, metavar='PORT',
+    help='Serve Prometheus metrics on this port (plus the shard index)')
+ARGS.add_argument(
+    '--hooks_dir', action='store', metavar='DIR',
+    help='Enable profiling hooks writing to DIR: SIGUSR1 (or POST '
+    '/hooks/profile) captures a cProfile window, SIGUSR2 (or POST '
+    '/hooks/memory) writes a tracemalloc diff')
+ARGS.add_argument(
+    '--profile_seconds', action='store', type=float, metavar='SECS',
+    default=30.0, help='Length of a profile capture')
+ARGS.add_argument(
+    '--profile_interval', action='store', type=float, metavar='SECS',
+    help='Also capture a profile window every SECS')
 ARGS.add_argument(
     '--exclude', action='store', metavar='REGEX',
     help='Exclude matching URLs')
@@ -47,6 +138,72 @@ ARGS.add_argument(
 ARGS.add_argument(
     '--lenient', action='store_false', dest='strict',
     default=True, help='Lenient host matching')
+ARGS.add_argument(
+    '--dedup', action='store', choices=('exact', 'bloom'),
+    default=CRAWLER_SETTINGS.get('dedup', 'exact'),
+    help='Seen-URL store: exact 64-bit fingerprints or scalable bloom filter')
+ARGS.add_argument(
+    '--dedup_error_rate', action='store', type=float, metavar='P',
+    default=0.001, help='False positive rate of the bloom seen-URL store')
+ARGS.add_argument(
+    '--stats_file', action='store', metavar='PATH',
+    help='Stream per-URL fetch records to a gzipped JSON-lines file')
+ARGS.add_argument(
+    '--stats_ring_size', action='store', type=int, metavar='N',
+    default=1000, help='Number of recent per-URL records kept in memory')
+ARGS.add_argument(
+    '--progress', action='store', type=float, metavar='SECS', default=10,
+    help='Print a progress line to stderr every SECS (0 to disable)')
+ARGS.add_argument(
+    '--progress_window', action='store', type=float, metavar='SECS',
+    default=60, help='Rates in progress lines cover the last SECS')
+ARGS.add_argument(
+    '--summary_json', action='store', metavar='PATH',
+    help="Write the final report as JSON to PATH ('-' for stdout)")
+ARGS.add_argument(
+    '--report_urls', action='store_true', default=False,
+    help='List the last --stats_ring_size urls in the final report')
+ARGS.add_argument(
+    '--items_jsonl', action='store', metavar='PATH',
+    help='Also append crawled items to a JSON-lines file')
+ARGS.add_argument(
+    '--items_redis', action='store', metavar='KEY',
+    help='Also push crawled items as JSON onto this Redis list')
+ARGS.add_argument(
+    '--pipeline_size', action='store', type=int, metavar='N', default=1000,
+    help='Items queued per pipeline stage before parsing waits for storage')
+ARGS.add_argument(
+    '--pipeline_batch', action='store', type=int, metavar='N', default=100,
+    help='Items written to the sinks per batch')
+ARGS.add_argument(
+    '--parse_executor', action='store',
+    choices=('inline', 'thread', 'process'),
+    default=CRAWLER_SETTINGS.get('parse_executor', 'inline'),
+    help='Where HTML item parsing runs')
+ARGS.add_argument(
+    '--parse_workers', action='store', type=int, metavar='N',
+    default=None, help='Parser pool size (default: number of CPUs)')
+ARGS.add_argument(
+    '--parse_in_flight', action='store', type=int, metavar='N',
+    default=None, help='Limit queued parse jobs (default: 2 * workers)')
+ARGS.add_argument(
+    '--checkpoint', action='store', metavar='DIR',
+    help='Periodically checkpoint crawl progress into DIR')
+ARGS.add_argument(
+    '--checkpoint_interval', action='store', type=float, metavar='SECS',
+    default=60, help='Seconds between checkpoints')
+ARGS.add_argument(
+    '--resume', action='store_true', default=False,
+    help='Resume from the checkpoint in --checkpoint DIR')
+ARGS.add_argument(
+    '--redis_frontier', action='store', metavar='NAMESPACE',
+    help='Share queue and seen-set with other processes through Redis')
+ARGS.add_argument(
+    '--redis_reset', action='store_true', default=False,
+    help='Clear the Redis frontier namespace before crawling')
+ARGS.add_argument(
+    '--processes', action='store', type=int, metavar='N', default=1,
+    help='Shard the crawl over N processes, each with its own event loop')
 ARGS.add_argument(
     '-v', '--verbose', action='count', dest='level',
     default=2, help='Verbose logging (repeat for more verbose)')
@@ -62,6 +219,138 @@ def fix_url(url):
     return url
 
 
+def build_crawler(args, loop, shard=None):
+    """Create the crawler and its checkpoint manager from parsed args.
+    Per-run files get a .shardN suffix when crawling as one of many shards.
+    """
+    def path(option):
+        if shard is None:
+            return option
+        return shard_path(option, shard.index)
+
+    roots = {fix_url(root) for root in args.roots}
+    user_agents = get_user_agents('user-agents.txt')
+    parser_pool = ParserPool(args.parse_executor, args.parse_workers,
+                             args.parse_in_flight)
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = CheckpointManager(path(args.checkpoint),
+                                       args.checkpoint_interval)
+    frontier = None
+    if args.redis_frontier:
+        frontier = RedisFrontier(args.redis_frontier)
+        if args.redis_reset:
+            loop.run_until_complete(frontier.reset())
+    http_cache = None
+    if args.http_cache:
+        http_cache = ConditionalCache(path(args.http_cache),
+                                      args.http_cache_size)
+    dead_groups = None
+    if args.dead_groups:
+        dead_groups = NegativeIdCache(path(args.dead_groups),
+                                      args.group_recheck_days)
+    retry_policy = RetryPolicy(max_retries=max(0, args.max_tries - 1),
+                               base_delay=args.retry_delay,
+                               max_delay=args.retry_max_delay,
+                               budget=args.retry_budget,
+                               budget_ratio=args.retry_ratio)
+    metrics_port = args.metrics_port
+    if metrics_port and shard is not None:
+        metrics_port += shard.index
+    progress = None
+    if args.progress:
+        progress = ProgressReporter(
+            args.progress, args.progress_window,
+            label=None if shard is None else 'shard %d' % shard.index)
+    item_sinks = []
+    if args.items_jsonl:
+        item_sinks.append(JsonlSink(path(args.items_jsonl)))
+    if args.items_redis:
+        item_sinks.append(RedisSink(args.items_redis))
+    hooks = None
+    if args.hooks_dir:
+        hooks = profiling_hooks(args.hooks_dir, args.profile_seconds,
+                                args.profile_interval)
+    dedup_options = {}
+    if args.dedup == 'bloom':
+        dedup_options['error_rate'] = args.dedup_error_rate
+    crawler = DoubanGroupUserCrawler(roots,
+                                     exclude=args.exclude,
+                                     strict=args.strict,
+                                     max_redirect=args.max_redirect,
+                                     max_tries=args.max_tries,
+                                     max_tasks=args.max_tasks,
+                                     user_agents=user_agents,
+                                     proxy='http://127.0.0.1:3128',
+                                     group_range=(100000, 600000),
+                                     loop=loop,
+                                     dedup=args.dedup,
+                                     dedup_options=dedup_options,
+                                     host_delay=args.host_delay,
+                                     max_per_host=args.max_per_host,
+                                     global_rate=args.global_rate,
+                                     host_rate=args.host_rate,
+                                     stats_ring_size=args.stats_ring_size,
+                                     stats_path=path(args.stats_file),
+                                     parser_pool=parser_pool,
+                                     max_body_size=args.max_body_size,
+                                     http_cache=http_cache,
+                                     checkpoint=checkpoint,
+                                     frontier=frontier,
+                                     shard=shard,
+                                     keepalive_timeout=args.keepalive_timeout,
+                                     dns_ttl=args.dns_ttl,
+                                     adaptive_tasks=args.adaptive_tasks,
+                                     min_tasks=args.min_tasks,
+                                     retry_policy=retry_policy,
+                                     metrics_port=metrics_port,
+                                     hooks=hooks,
+                                     progress=progress,
+                                     item_sinks=item_sinks,
+                                     pipeline_options=dict(
+                                         maxsize=args.pipeline_size,
+                                         batch_size=args.pipeline_batch),
+                                     dead_groups=dead_groups)
+    if checkpoint is not None:
+        checkpoint.attach(crawler, resume=args.resume)
+    return crawler, checkpoint
+
+
+def run_crawler(crawler, checkpoint, loop):
+    try:
+        loop.run_until_complete(crawler.crawl())  # Crawler gonna crawl.
+    except KeyboardInterrupt:
+        sys.stderr.flush()
+        print('\nInterrupted\n')
+    finally:
+        if checkpoint is not None:
+            checkpoint.save(crawler)
+
+
+def close_crawler(crawler, loop):
+    crawler.close()
+
+    # next two lines are required for actual aiohttp resource cleanup
+    loop.stop()
+    loop.run_forever()
+
+    loop.close()
+
+
+def crawl_shard(shard, args):
+    """Entry point of one --processes worker; returns its shard summary."""
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.get_event_loop()
+    crawler, checkpoint = build_crawler(args, loop, shard)
+    try:
+        run_crawler(crawler, checkpoint, loop)
+        logger.info('shard %d forwarded %d urls', shard.index,
+                    shard.forwarded)
+        return shard_summary(crawler)
+    finally:
+        close_crawler(crawler, loop)
+
+
 def main():
     """Main program.
     Parse arguments, set up event loop, run crawler, print report.
@@ -84,35 +373,32 @@ def main():
     #     asyncio.set_event_loop(loop)
     # else:
     #     loop = asyncio.get_event_loop()
+    if args.resume and not args.checkpoint:
+        print('--resume needs --checkpoint DIR')
+        return
+    if args.processes > 1:
+        if args.redis_frontier:
+            print('--processes and --redis_frontier are exclusive')
+            return
+        merged = MergedCrawl(run_sharded(args.processes, crawl_shard, args))
+        report(merged, urls=args.report_urls)
+        if args.summary_json:
+            write_summary(merged, args.summary_json)
+        print('\ncrawler number of users : {} ({} shards)\n'.format(
+            merged.users, merged.shards))
+        return
+
     asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     loop = asyncio.get_event_loop()
-    roots = {fix_url(root) for root in args.roots}
-    user_agents = get_user_agents('user-agents.txt')
-    crawler = DoubanGroupUserCrawler(roots,
-                                     exclude=args.exclude,
-                                     strict=args.strict,
-                                     max_redirect=args.max_redirect,
-                                     max_tries=args.max_tries,
-                                     max_tasks=args.max_tasks,
-                                     user_agents=user_agents,
-                                     proxy='http://127.0.0.1:3128',
-                                     group_range=(100000, 600000),
-                                     loop=loop)
+    crawler, checkpoint = build_crawler(args, loop)
     try:
-        loop.run_until_complete(crawler.crawl())  # Crawler gonna crawl.
-    except KeyboardInterrupt:
-        sys.stderr.flush()
-        print('\nInterrupted\n')
+        run_crawler(crawler, checkpoint, loop)
     finally:
-        report(crawler)
+        report(crawler, urls=args.report_urls)
+        if args.summary_json:
+            write_summary(crawler, args.summary_json)
         print('\ncrawler number of users : {} \n'.format(len(crawler._users)))
-        crawler.close()
-
-        # next two lines are required for actual aiohttp resource cleanup
-        loop.stop()
-        loop.run_forever()
-
-        loop.close()
+        close_crawler(crawler, loop)
 
 
 if __name__ == '__main__':
@@ -5,6 +5,7 @@
 import asyncio
 import cgi
 import logging
+import math
 import os
 import random
 import re
@@ -12,39 +13,72 @@ import string
 import time
 import urllib
 import urllib.parse
-from collections import namedtuple
+from collections import deque, namedtuple
 
 import aiohttp
 import async_timeout
-import requests
 import uvloop
-from lxml import html
+from pymongo import UpdateOne
 
 from spinbot.database.mongodb.motorbase import MotorBase
+from spinbot.spider.admission import IP_RE, UrlAdmission, lenient_host
+from spinbot.spider.frontier import HostScheduler, url_host
+from spinbot.spider.hooks import HookRegistry
+from spinbot.spider.httpcache import body_digest
+from spinbot.spider.metrics import Metrics, MetricsServer
+from spinbot.spider.parsers import (ParserPool, extract_couplets,
+                                    extract_group_page)
+from spinbot.spider.pipeline import Dedup, ItemPipeline, MongoSink, Validate
 from spinbot.spider.proxy import ProxyMixin
-
-try:
-  # Python 3.4.
-  from asyncio import JoinableQueue as Queue
-except ImportError:
-  # Python 3.5.
-  from asyncio import Queue
+from spinbot.spider.session import SessionManager
+from spinbot.spider.retry import RetryPolicy
+from spinbot.spider.stats import FetchStats, exception_name
+from spinbot.utils.charset import detect_encoding
+from spinbot.utils.concurrency import AIMDController
+from spinbot.utils.dedup import create_seen_store
+from spinbot.utils.rate_limit import RateLimits
 
 logger = logging.getLogger(__name__)
 
+PROXY_URL = 'http://127.0.0.1:5010/get/'
+# Replace href with (?:href|src) to follow image links.
+HREF_RE = re.compile(r'''(?i)href=["']([^\s"'<>]+)''')
+# How often join() tops the queue up while seeds remain.
+SEED_POLL_INTERVAL = 0.5
 USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_2) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.95 Safari/537.36'
 
 
 
-def lenient_host(host):
-  parts = host.split('.')[-2:]
-  return ''.join(parts)
-
-
 def is_redirect(response):
   return response.status in (300, 301, 302, 303, 307)
 
 
+class BodyTooLarge(Exception):
+  pass
+
+
+class PageRejected(Exception):
+  """A page its parse callback refused (see BaseCrawler.parse_item)."""
+
+
+async def read_body(response, max_size):
+  """Read the whole body once, refusing anything larger than max_size."""
+  length = response.headers.get('content-length')
+  if length and length.isdigit() and int(length) > max_size:
+    raise BodyTooLarge('{} bytes announced'.format(length))
+  chunks = []
+  size = 0
+  while True:
+    chunk = await response.content.read(64 * 1024)
+    if not chunk:
+      break
+    size += len(chunk)
+    if size > max_size:
+      raise BodyTooLarge('more than {} bytes'.format(max_size))
+    chunks.append(chunk)
+  return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+
 FetchStatistic = namedtuple('FetchStatistic', [
   'url', 'next_url', 'status', 'exception', 'size', 'content_type', 'encoding',
   'num_urls', 'num_new_urls'
@@ -72,6 +106,11 @@ class BaseCrawler(object):
   ALLOW_CONTENT_TYPE = ('text/html', 'application/xml')
   ALLOWED_PATHS = None
   ITEM_PATHS = None
+  DEDUP = 'exact'
+  # Responses worth another try later rather than parsing as errors.
+  RETRY_STATUSES = (429, 500, 502, 503, 504)
+  # Retry reason for pages parse_item rejects.
+  REJECTED_REASON = 'rejected'
 
   def __init__(self,
                roots,
@@ -86,7 +125,34 @@ class BaseCrawler(object):
                allowed_paths=None,
                item_paths=None,
                *,
-               loop=None):
+               loop=None,
+               dedup=None,
+               dedup_options=None,
+               seed_low_water=None,
+               host_delay=0.0,
+               max_per_host=None,
+               global_rate=None,
+               host_rate=None,
+               stats_ring_size=1000,
+               stats_path=None,
+               parser_pool=None,
+               max_body_size=10 * 1024 * 1024,
+               http_cache=None,
+               checkpoint=None,
+               frontier=None,
+               shard=None,
+               keepalive_timeout=30,
+               dns_ttl=300,
+               adaptive_tasks=False,
+               min_tasks=1,
+               retry_policy=None,
+               metrics=None,
+               metrics_port=None,
+               hooks=None,
+               progress=None,
+               pipeline=None,
+               item_sinks=None,
+               pipeline_options=None):
     if not loop:
       asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
       self.loop = asyncio.get_event_loop()
@@ -100,10 +166,45 @@ class BaseCrawler(object):
     self.max_tries = max_tries
     self.max_tasks = max_tasks
     self.time_out = time_out
-    self.q = Queue(loop=self.loop)
-    self.seen_urls = set()
-    self.done = []
-    self._session = aiohttp.ClientSession(loop=self.loop)
+    self.q = frontier or HostScheduler(
+      min_delay=host_delay, max_per_host=max_per_host, loop=self.loop)
+    if dedup is None or isinstance(dedup, str):
+      self.seen_urls = create_seen_store(dedup or self.DEDUP,
+                                         **(dedup_options or {}))
+    else:
+      self.seen_urls = dedup
+    self.rate_limits = RateLimits(global_rate=global_rate, host_rate=host_rate)
+    self.stats = FetchStats(ring_size=stats_ring_size, path=stats_path)
+    self.parser_pool = parser_pool or ParserPool('inline')
+    self.max_body_size = max_body_size
+    self.http_cache = http_cache
+    self.checkpoint = checkpoint
+    self.progress = progress
+    self._pipeline = pipeline
+    self.item_sinks = list(item_sinks or [])
+    self.pipeline_options = pipeline_options or {}
+    self.shard = shard
+    self.retry_policy = retry_policy or RetryPolicy(
+      max_retries=max(0, max_tries - 1))
+    # max_tasks workers run, but only concurrency.limit of them fetch at once
+    # (see acquire_slot).
+    self.concurrency = None
+    if adaptive_tasks:
+      self.concurrency = AIMDController(
+        initial=max(min_tasks, max_tasks // 2), min_limit=min_tasks,
+        max_limit=max_tasks)
+    self.metrics = metrics or Metrics()
+    self.metrics_port = metrics_port
+    self._metrics_server = None
+    self._in_flight = {}
+    self._slot_holders = set()
+    self._cache_notes = {}
+    self._seeds = deque()
+    self._feeding_seeds = False
+    self.seed_low_water = seed_low_water or max_tasks * 2
+    self.sessions = SessionManager(
+      limit=max_tasks, limit_per_host=max_per_host or 0,
+      keepalive_timeout=keepalive_timeout, dns_ttl=dns_ttl, loop=self.loop)
     self.root_domains = set()
 
     self._allowed_paths = None
@@ -119,7 +220,7 @@ class BaseCrawler(object):
       host, port = urllib.parse.splitport(parts.netloc)
       if not host:
         continue
-      if re.match(r'\A[\d\.]*\Z', host):
+      if IP_RE.match(host):
         self.root_domains.add(host)
       else:
         host = host.lower()
@@ -135,16 +236,74 @@ class BaseCrawler(object):
       self._user_agents = user_agents
     self.t0 = time.time()
     self.t1 = None
+    self._admission = None
+    self.register_gauges()
+    # Wraps fetch/parse/parse_item/record_statistic while hooks want them.
+    self.hooks = hooks or HookRegistry()
+    self.hooks.attach(self)
+
+  def register_gauges(self):
+    """Expose crawler state read at scrape time (see Metrics.gauge)."""
+    metrics = self.metrics
+    metrics.describe('stage_seconds', 'Seconds spent per crawl stage.')
+    metrics.describe('fetches_total',
+                     'Fetch attempts per host and status, retries included.')
+    metrics.describe('retries_total', 'Deferred retries per host and reason.')
+    metrics.gauge('queue_depth', self.q.qsize)
+    metrics.gauge('in_flight', lambda: len(self._in_flight))
+    if hasattr(self.q, 'delayed'):
+      metrics.gauge('retries_waiting', self.q.delayed)
+    metrics.gauge('seen_urls', lambda: len(self.seen_urls))
+    metrics.gauge('connections_in_use',
+                  lambda: self.sessions.pool_stats()['acquired'])
+    if self.concurrency is not None:
+      metrics.gauge('concurrency_limit', lambda: self.concurrency.limit)
+
+  @property
+  def admission(self):
+    """Compiled url rules, built on first use so that subclasses can still
+    adjust exclude / root_domains / paths in their __init__.
+    """
+    if self._admission is None:
+      self._admission = UrlAdmission(
+        self.root_domains, strict=self.strict, exclude=self.exclude,
+        allowed_paths=self.allowed_paths, item_paths=self.item_paths)
+    return self._admission
+
+  def reset_admission(self):
+    """Drop the compiled rules after changing them at runtime."""
+    self._admission = None
 
   @property
   def session(self):
-    if not self._session:
-      self._session = aiohttp.ClientSession(loop=self.loop)
-    return self._session
+    return self.sessions.session
 
   @property
-  def proxy(self):
-    proxy = 'http://{}'.format(requests.get("http://127.0.0.1:5010/get/").text)
+  def pipeline(self):
+    if self._pipeline is None:
+      self._pipeline = self.build_pipeline()
+    return self._pipeline
+
+  def build_pipeline(self):
+    """The item pipeline used when none was passed in."""
+    return ItemPipeline(self.item_stages(),
+                        self.default_sinks() + self.item_sinks,
+                        metrics=self.metrics, **self.pipeline_options)
+
+  def item_stages(self):
+    return []
+
+  def default_sinks(self):
+    return []
+
+  async def emit(self, item):
+    """Hand an item to the pipeline; waits while the pipeline is full."""
+    with self.metrics.timer('stage_seconds', stage='store'):
+      await self.pipeline.put(item)
+
+  async def acquire_proxy(self):
+    async with self.session.get(PROXY_URL) as r:
+      proxy = 'http://{}'.format((await r.text()).strip())
     logger.info(proxy)
     return proxy
 
@@ -161,36 +320,32 @@ class BaseCrawler(object):
     return self._item_paths
 
   def host_okay(self, host):
-    """Check if a host should be crawled.
-    A literal match (after lowercasing) is always good.  For hosts
-    that don't look like IP addresses, some approximate matches
-    are okay depending on the strict flag.
-    """
-    host = host.lower()
-    if host in self.root_domains:
-      return True
-    if re.match(r'\A[\d\.]*\Z', host):
-      return False
-    if self.strict:
-      return self._host_okay_strictish(host)
-    return self._host_okay_lenient(host)
-
-  def _host_okay_strictish(self, host):
-    """Check if a host should be crawled, strict-ish version.
-      This checks for equality modulo an initial 'www.' component.
-      """
-    host = host[4:] if host.startswith('www.') else 'www.' + host
-    return host in self.root_domains
-
-  def _host_okay_lenient(self, host):
-    """Check if a host should be crawled, lenient version.
-      This compares the last two components of the host.
-      """
-    return lenient_host(host) in self.root_domains
-
-  def record_statistic(self, fetch_statistic):
+    """Check if a host should be crawled (see UrlAdmission.host_okay)."""
+    return self.admission.host_okay(host)
+
+  def record_statistic(self, fetch_statistic, elapsed=None):
     """Record the FetchStatistic for completed / failed URL."""
-    self.done.append(fetch_statistic)
+    self.stats.record(fetch_statistic, elapsed)
+    exception = fetch_statistic.exception
+    status = fetch_statistic.status
+    self.record_attempt(
+      fetch_statistic.url, status, elapsed,
+      success=exception is None and status not in (403, 429) and status < 500,
+      timeout=isinstance(exception, asyncio.TimeoutError))
+
+  def record_attempt(self, url, status, elapsed=None, success=True,
+                     timeout=False):
+    """Report one fetch attempt to the metrics and the concurrency
+    controller.  retry() reports the attempts it defers here as well, so
+    both see every outcome, not only each url's final one.
+    """
+    host = url_host(url)
+    self.metrics.inc('fetches_total', host=host, status=str(status))
+    if elapsed is not None:
+      self.metrics.observe('fetch_seconds', elapsed, host=host)
+    if self.concurrency is not None:
+      self.concurrency.observe(success=success, timeout=timeout,
+                               latency=elapsed)
 
   def get_random_user_agent(self):
     if len(self._user_agents) == 1:
@@ -198,28 +353,93 @@ class BaseCrawler(object):
     return random.choice(self._user_agents)
 
   def close(self):
-    self.session.close()
+    if hasattr(self.q, 'close'):
+      self.q.close()
+    if self.http_cache is not None:
+      self.http_cache.close()
+    if self._pipeline is not None and not self.loop.is_running():
+      self.loop.run_until_complete(self._pipeline.close())
+    self.stats.close()
+    self.parser_pool.shutdown()
+    self.sessions.close()
 
   def add_url(self, url, max_redirect=None, meta=None):
     if meta is None:
       meta = {}
     if max_redirect is None:
       max_redirect = self.max_redirect
+    if self.shard is not None:
+      owner = self.shard.owner(self.shard_key(url))
+      if owner != self.shard.index:
+        self.seen_urls.add(url)
+        self.shard.forward(owner, (url, max_redirect, meta))
+        return
     logger.debug('adding %r %r', url, max_redirect)
     self.seen_urls.add(url)
     self.q.put_nowait((url, max_redirect, meta))
 
-  async def parse_item(self, url, data, *args, **kwargs):
+  def shard_key(self, url):
+    """What decides which shard crawls url (see spinbot.spider.sharding)."""
+    return url_host(url)
+
+  def add_seeds(self, seeds):
+    """Register a (sync or async) iterable of seed urls.
+    Seeds are pulled lazily by feed_seeds() whenever the queue runs below
+    seed_low_water, so huge seed ranges cost nothing up front.
+    """
+    if hasattr(seeds, '__aiter__'):
+      self._seeds.append(seeds.__aiter__())
+    else:
+      self._seeds.append(iter(seeds))
+    self._seeding_changed()
+
+  def _seeding_changed(self):
+    # A shared frontier must not finish while this process holds seeds.
+    if hasattr(self.q, 'seeding'):
+      self.q.seeding(bool(self._seeds))
+
+  async def feed_seeds(self):
+    """Top the queue up to seed_low_water from the pending seeds."""
+    if self._feeding_seeds:
+      return
+    self._feeding_seeds = True
+    try:
+      while self._seeds and self.q.qsize() < self.seed_low_water:
+        seeds = self._seeds[0]
+        try:
+          if hasattr(seeds, '__anext__'):
+            url = await seeds.__anext__()
+          else:
+            url = next(seeds)
+        except (StopIteration, StopAsyncIteration):
+          self._seeds.popleft()
+          self._seeding_changed()
+          continue
+        if url not in self.seen_urls:
+          self.add_url(url)
+    finally:
+      self._feeding_seeds = False
+
+  async def run_parser(self, func, *args):
+    """Run an extraction function through the crawler's parser pool."""
+    with self.metrics.timer('stage_seconds', stage='parse'):
+      return await self.parser_pool.run(func, *args)
+
+  async def parse_item(self, url, body, *args, **kwargs):
+    """Run the url's parse_<kind> callback on the raw body; the encoding
+    keyword holds its charset, so run_parser() can decode it off the loop.
+    A callback returns False to reject the page (e.g. a ban page): it is
+    retried, or counted as a PageRejected failure, and kept out of the cache.
+    """
     allowed, parse_function = self.parse_item_allowed(url)
     if allowed:
-      await parse_function(url, data, *args, **kwargs)
+      return await parse_function(url, body, *args, **kwargs)
+    return None
 
   def parse_item_allowed(self, url):
-    if self.item_paths:
-      for key, rule in self.item_paths.items():
-        if not re.search(rule, url):
-          continue
-        return True, self.get_parse_function(key)
+    item_kind = self.admission.check(url).item_kind
+    if item_kind is not None:
+      return True, self.get_parse_function(item_kind)
     return False, None
 
   def get_parse_function(self, name):
@@ -230,19 +450,32 @@ class BaseCrawler(object):
     raise NotImplementedError
 
   def path_allowed(self, url):
-    if self.allowed_paths:
-      logger.debug(self.allowed_paths)
-      for rule in self.allowed_paths:
-        if not re.search(rule, url):
-          continue
-        return True
-    return False
+    return self.admission.path_allowed(url)
 
-  async def parse(self, url, response, **kwargs):
+  async def parse(self, url, response, started=None, **kwargs):
+    """Read and parse response; return (stat, links, elapsed).  elapsed is
+    the request's latency up to the end of the download (started is when
+    the request went out), so parsing and item storage don't count.
+    """
     links = set()
     content_type = None
     encoding = None
-    body = await response.read()
+    accepted = True
+    try:
+      with self.metrics.timer('stage_seconds', stage='download'):
+        body = await read_body(response, self.max_body_size)
+    except BodyTooLarge as e:
+      response.close()
+      logger.error('%r skipped: body %s', url, e)
+      stat = FetchStatistic(
+        url=response.url.human_repr(), next_url=None, status=response.status,
+        exception=e, size=0, content_type=None, encoding=None, num_urls=0,
+        num_new_urls=0)
+      return stat, links, None
+    elapsed = time.time() - started if started is not None else None
+    size = len(body)
+    # The body is in memory: hand the connection back before parsing.
+    await response.release()
 
     if response.status == 200:
       content_type = response.headers.get('content-type')
@@ -251,34 +484,69 @@ class BaseCrawler(object):
       if content_type:
         content_type, pdict = cgi.parse_header(content_type)
 
-      encoding = pdict.get('charset', 'utf-8')
-      if content_type in self.ALLOW_CONTENT_TYPE:
-        data = await response.text()
-        links = await self._parse_links(response.url, data)
-        await self.parse_item(url, data, **kwargs)
+      digest = None
+      if self.http_cache is not None:
+        digest = body_digest(body)
+      if digest is not None and self.http_cache.is_unchanged(url, digest):
+        logger.debug('%r unchanged since last crawl', url)
+        self.page_unchanged(url)
+      else:
+        if content_type in self.ALLOW_CONTENT_TYPE:
+          encoding, _ = detect_encoding(body, pdict.get('charset'))
+          if self.follow_links(url):
+            with self.metrics.timer('stage_seconds', stage='links'):
+              links = await self._parse_links(
+                response.url, body.decode(encoding, errors='replace'))
+          accepted = await self.parse_item(url, body, encoding=encoding,
+                                           **kwargs) is not False
+        else:
+          encoding = pdict.get('charset')
+        # Only cache accepted pages: a cached ban page would make its retry
+        # (and the next run's 304) skip a page that was never parsed.
+        note = self._cache_notes.pop(url, None)
+        if accepted and digest is not None:
+          self.http_cache.store(url, response.headers, digest, note)
 
     stat = FetchStatistic(
       url=response.url.human_repr(),
       next_url=None,
       status=response.status,
-      exception=None,
-      size=len(body),
+      exception=None if accepted else PageRejected(url),
+      size=size,
       content_type=content_type,
       encoding=encoding,
       num_urls=len(links),
-      num_new_urls=len(links - self.seen_urls))
-    return stat, links
+      num_new_urls=sum(1 for link in links if link not in self.seen_urls))
+    return stat, links, elapsed
+
+  def follow_links(self, url):
+    """Whether to queue the links found on url's page."""
+    return True
+
+  def note_for_cache(self, url, note):
+    """Keep note (JSON-serializable) with url's validators once its page
+    is accepted; see page_unchanged().
+    """
+    if self.http_cache is not None:
+      self._cache_notes[url] = note
+
+  def page_unchanged(self, url):
+    """Called instead of parsing when url's page is unchanged since it was
+    cached (a 304 or the same body); http_cache.note(url) holds what
+    note_for_cache() stored for it.
+    """
 
   async def _parse_links(self, base_url, text):
     links = set()
+    if not isinstance(base_url, str):
+      base_url = base_url.human_repr()
 
-    # Replace href with (?:href|src) to follow image links.
-    urls = set(re.findall(r'''(?i)href=["']([^\s"'<>]+)''', text))
+    urls = set(HREF_RE.findall(text))
     if urls:
       logger.info('got %r distinct urls from %r', len(urls), base_url)
     for url in urls:
       try:
-        normalized = urllib.parse.urljoin(base_url.human_repr(), url)
+        normalized = urllib.parse.urljoin(base_url, url)
         # normalized = base_url.join(url)
         defragmented, frag = urllib.parse.urldefrag(normalized)
       except TypeError as type_error:
@@ -294,47 +562,89 @@ class BaseCrawler(object):
     headers.update(**kwargs)
     return headers
 
+  def cache_headers(self, url):
+    if self.http_cache is None:
+      return {}
+    return self.http_cache.conditional_headers(url)
+
   async def fetch(self, url, max_redirect, meta=None):
-    tries = 0
-    exception = None
-    while tries < self.max_tries:
-      try:
-        with async_timeout.timeout(self.time_out):
-          headers = self.headers()
+    """Try url once; on failure defer it for a retry (see retry())."""
+    # Latency runs from the request, not from the proxy / rate-limit /
+    # slot waits before it: it drives the AIMD limit (see record_attempt).
+    started = None
+    if meta is None:
+      meta = {}
+    tries = meta.get('retries', 0)
+    try:
+      with self.metrics.timer('stage_seconds', stage='proxy'):
+        proxy = await self.acquire_proxy()
+      with self.metrics.timer('stage_seconds', stage='rate_limit'):
+        await self.rate_limits.acquire(host=url_host(url), proxy=proxy)
+      await self.acquire_slot()
+      started = time.time()
+      with async_timeout.timeout(self.time_out):
+        headers = self.headers()
+        headers.update(self.cache_headers(url))
+        with self.metrics.timer('stage_seconds', stage='connect'):
           response = await self.session.get(
-            url, headers=headers, proxy=self.proxy, allow_redirects=False)
-
-          if tries > 1:
-            logger.info('try %r for %r success', tries, url)
-
-          break
-      except aiohttp.ClientError as client_error:
-        logger.info('try %r for %r raised %r', tries, url, client_error)
-        exception = client_error
-      except asyncio.TimeoutError as timeout_error:
-        logger.info('try %r for %r raised %r', tries, url, timeout_error)
-        exception = timeout_error
-      except Exception as e:
-        logger.info('try %r for %r raised %r', tries, url, e)
-        exception = e
-
-      tries += 1
-    else:
-      # We never broke out of the loop: all tries failed.
-      logger.error('%r failed after %r tries', url, self.max_tries)
-      self.record_statistic(
-        FetchStatistic(
-          url=url,
-          next_url=None,
-          status=None,
-          exception=exception,
-          size=0,
-          content_type=None,
-          encoding=None,
-          num_urls=0,
-          num_new_urls=0))
+            url, headers=headers, proxy=proxy, allow_redirects=False)
+
+        if tries > 0:
+          logger.info('try %r for %r success', tries, url)
+    except aiohttp.ClientError as client_error:
+      logger.info('try %r for %r raised %r', tries, url, client_error)
+      self.retry(url, max_redirect, meta, client_error, started=started)
+      return
+    except asyncio.TimeoutError as timeout_error:
+      logger.info('try %r for %r raised %r', tries, url, timeout_error)
+      self.retry(url, max_redirect, meta, timeout_error, started=started)
       return
+    except Exception as e:
+      logger.info('try %r for %r raised %r', tries, url, e)
+      self.retry(url, max_redirect, meta, e, started=started)
+      return
+
+    await self.handle_response(url, response, max_redirect, meta, started)
 
+  def retry(self, url, max_redirect, meta, reason, started=None, status=None):
+    """Defer url for another try after an exponential backoff.
+
+    reason is an exception or a short string such as 'status_503', status
+    the response's status if there was one.  Once the url's retries or the
+    run's retry budget are used up, a failure is recorded for exceptions
+    and False is returned.
+    """
+    name = reason if isinstance(reason, str) else exception_name(reason)
+    attempt = (meta or {}).get('retries', 0)
+    elapsed = time.time() - started if started is not None else None
+    delay = self.retry_policy.schedule(attempt, fetched=len(self.stats))
+    if delay is None:
+      logger.error('%r failed after %r tries (%s)', url, attempt + 1, name)
+      if not isinstance(reason, str):
+        self.record_statistic(
+          FetchStatistic(
+            url=url,
+            next_url=None,
+            status=None,
+            exception=reason,
+            size=0,
+            content_type=None,
+            encoding=None,
+            num_urls=0,
+            num_new_urls=0),
+          elapsed)
+      return False
+    self.stats.record_retry(name)
+    self.metrics.inc('retries_total', host=url_host(url), reason=name)
+    self.record_attempt(url, status, elapsed, success=False,
+                        timeout=isinstance(reason, asyncio.TimeoutError))
+    logger.debug('retrying %r in %.1f secs (%s)', url, delay, name)
+    self.q.defer((url, max_redirect, dict(meta or {}, retries=attempt + 1)),
+                 delay)
+    return True
+
+  async def handle_response(self, url, response, max_redirect, meta, started):
+    """Follow a redirect, or parse the page and queue its links."""
     try:
       if is_redirect(response):
         location = response.headers['location']
@@ -349,7 +659,8 @@ class BaseCrawler(object):
             content_type=None,
             encoding=None,
             num_urls=0,
-            num_new_urls=0))
+            num_new_urls=0),
+          time.time() - started)
 
         if next_url in self.seen_urls:
           return
@@ -359,48 +670,155 @@ class BaseCrawler(object):
             self.add_url(next_url, max_redirect - 1)
         else:
           logger.error('redirect limit reached for %r from %r', next_url, url)
+      elif (response.status in self.RETRY_STATUSES and
+            self.retry(url, max_redirect, meta,
+                       'status_{}'.format(response.status), started=started,
+                       status=response.status)):
+        # Deferred for another try; nothing to parse.
+        return
+      elif response.status == 304 and self.http_cache is not None:
+        # Unchanged since the last crawl: nothing to parse or store.
+        self.http_cache.mark_not_modified(url)
+        self.page_unchanged(url)
+        self.record_statistic(
+          FetchStatistic(
+            url=url,
+            next_url=None,
+            status=response.status,
+            exception=None,
+            size=0,
+            content_type=None,
+            encoding=None,
+            num_urls=0,
+            num_new_urls=0),
+          time.time() - started)
       else:
-        stat, links = await self.parse(url, response)
-        self.record_statistic(stat)
-        for link in links.difference(self.seen_urls):
-          self.add_url(link, meta=meta)
-        self.seen_urls.update(links)
+        stat, links, elapsed = await self.parse(url, response, started,
+                                                meta=meta)
+        if isinstance(stat.exception, PageRejected):
+          if self.retry(url, max_redirect, meta, self.REJECTED_REASON,
+                        status=response.status):
+            # retry() reported the attempt; nothing to record or queue.
+            return
+          links = set()
+        self.record_statistic(stat, elapsed)
+        # Links start over with their own retry count.
+        link_meta = {key: value for key, value in (meta or {}).items()
+                     if key != 'retries'}
+        for link in links:
+          if link not in self.seen_urls:
+            self.add_url(link, meta=dict(link_meta))
     finally:
       await response.release()
 
   async def work(self):
     try:
       while True:
-        url, max_redirect, meta = await self.q.get()
-        assert url in self.seen_urls
-        await self.fetch(url, max_redirect, meta)
-        self.q.task_done()
+        await self.work_one()
     except asyncio.CancelledError:
       pass
 
+  async def acquire_slot(self):
+    """Take a concurrency slot for the current task's request; fetch() calls
+    this once its proxy and rate limits are through, and work_one() releases
+    it after the fetch.  Workers waiting for urls, proxies or rate limits
+    hold none, so the AIMD limit only counts requests in progress.
+    """
+    if self.concurrency is None:
+      return
+    await self.concurrency.slots.acquire()
+    self._slot_holders.add(asyncio.current_task())
+
+  def release_slot(self):
+    task = asyncio.current_task()
+    if task in self._slot_holders:
+      self._slot_holders.discard(task)
+      self.concurrency.slots.release()
+
+  async def work_one(self):
+    with self.metrics.timer('stage_seconds', stage='queue'):
+      item = await self.q.get()
+    url, max_redirect, meta = item
+    # A shared frontier hands out urls other processes discovered.
+    self.seen_urls.add(url)
+    self._in_flight[url] = item
+    try:
+      await self.fetch(url, max_redirect, meta)
+    finally:
+      self.release_slot()
+      self._in_flight.pop(url, None)
+    # Feed before task_done() so q.join() can't finish while seeds remain.
+    await self.feed_seeds()
+    self.q.task_done(item)
+
   def url_allowed(self, url):
-    if self.exclude and re.search(self.exclude, url):
-      return False
-    parts = urllib.parse.urlparse(url)
-    if parts.scheme not in ('http', 'https'):
-      logger.debug('skipping non-http scheme in %r', url)
-      return False
-    host, port = urllib.parse.splitport(parts.netloc)
-    if not self.host_okay(host):
-      logger.debug('skipping non-root host in %r', url)
-      return False
-    return self.path_allowed(url)
+    return self.admission.check(url).allowed
+
+  def sweep_progress(self):
+    """(done, total) of a bounded seed sweep, for progress ETAs; or None."""
+    return None
+
+  def pending_items(self):
+    """Items still to fetch: in-flight ones first, then the queued ones."""
+    return list(self._in_flight.values()) + self.q.snapshot()
+
+  def checkpoint_state(self):
+    """Extra crawler progress to store in a checkpoint."""
+    return {}
+
+  def restore_state(self, state):
+    """Restore what checkpoint_state() returned."""
+
+  async def join(self):
+    """Wait until no work is left, on every shard when sharded."""
+    # Seeds are topped up after each fetch, which never happens while every
+    # worker waits on a queue other processes drained (or whose size is
+    # stale); keep feeding here until all seeds are queued.
+    while self._seeds:
+      await self.feed_seeds()
+      if self._seeds:
+        await asyncio.sleep(SEED_POLL_INTERVAL)
+    if self.shard is None:
+      await self.q.join()
+    else:
+      await self.shard.join(self)
 
   async def crawl(self):
     workers = [
       asyncio.Task(self.work(), loop=self.loop) for _ in range(self.max_tasks)
     ]
+    if self.checkpoint is not None:
+      self.checkpoint.start(self)
+    if self.progress is not None:
+      self.progress.start(self)
+    if self.shard is not None:
+      self.shard.start(self)
+    self.pipeline.start()
+    self.hooks.start(self.loop)
+    if self.metrics_port:
+      self._metrics_server = MetricsServer(self.metrics, port=self.metrics_port,
+                                           hooks=self.hooks)
+      await self._metrics_server.start()
 
     self.t0 = time.time()
-    await self.q.join()
-    self.t1 = time.time()
-    for w in workers:
-      w.cancel()
+    try:
+      await self.feed_seeds()
+      await self.join()
+    finally:
+      self.t1 = time.time()
+      for w in workers:
+        w.cancel()
+      await self.pipeline.close()
+      if self.checkpoint is not None:
+        self.checkpoint.stop()
+      if self.progress is not None:
+        self.progress.stop()
+      if self.shard is not None:
+        self.shard.stop()
+      if self._metrics_server is not None:
+        await self._metrics_server.stop()
+        self._metrics_server = None
+      self.hooks.stop()
 
 
 class ProxyMixinCrawler(ProxyMixin, BaseCrawler):
@@ -418,114 +836,99 @@ class ProxyMixinCrawler(ProxyMixin, BaseCrawler):
                allowed_paths=None,
                item_paths=None,
                *,
-               loop=None):
+               loop=None,
+               **kwargs):
     BaseCrawler.__init__(self, roots, exclude, strict, max_redirect, proxy, max_tries, user_agents,
-      max_tasks, time_out, allowed_paths, item_paths, loop=loop)
+      max_tasks, time_out, allowed_paths, item_paths, loop=loop, **kwargs)
     ProxyMixin.__init__(self)
+    self.metrics.gauge('valid_proxies', lambda: self.valid_proxy_count)
+
+  def proxy_failed(self, proxy):
+    self.metrics.inc('proxy_failures_total', proxy=proxy)
+    self.update_fail_proxy(proxy)
+
+  async def crawl(self):
+    self.start_proxy_refresher()
+    try:
+      await super(ProxyMixinCrawler, self).crawl()
+    finally:
+      self.stop_proxy_refresher()
 
   async def fetch(self, url, max_redirect, meta=None):
-    tries = 0
-    exception = None
+    started = None
     proxy = None
     if not meta:
       meta = {}
-    while tries < self.max_tries:
-      try:
-        with async_timeout.timeout(self.time_out):
-          headers = self.headers()
-          proxy = self.proxy
-          meta['proxy'] = proxy
-          # from ipdb import set_trace; set_trace()
+    tries = meta.get('retries', 0)
+    try:
+      # The pool already paces each proxy; apply global/host limits here.
+      with self.metrics.timer('stage_seconds', stage='proxy'):
+        proxy = await self.acquire_proxy()
+      with self.metrics.timer('stage_seconds', stage='rate_limit'):
+        await self.rate_limits.acquire(host=url_host(url))
+      await self.acquire_slot()
+      started = time.time()
+      with async_timeout.timeout(self.time_out):
+        headers = self.headers()
+        headers.update(self.cache_headers(url))
+        meta['proxy'] = proxy
+        connect = self.metrics.timer('stage_seconds', stage='connect')
+        with connect:
           response = await self.session.get(
             url, headers=headers, proxy=proxy, allow_redirects=False)
+        self.metrics.observe('proxy_connect_seconds', connect.elapsed,
+                             proxy=proxy)
 
-          if tries > 1:
-            logger.info('try %r for %r success', tries, url)
-
-          break
-      except aiohttp.ClientError as client_error:
-        logger.info('try %r for %r raised %r', tries, url, client_error)
-        if proxy:
-          self.update_fail_proxy(proxy)
-        exception = client_error
-      except asyncio.TimeoutError as timeout_error:
-        logger.info('try %r for %r raised %r', tries, url, timeout_error)
-        if proxy:
-          self.update_fail_proxy(proxy)
-        exception = timeout_error
-      except Exception as e:
-        if proxy:
-          self.update_fail_proxy(proxy)
-        logger.info('try %r for %r raised %r', tries, url, e)
-        exception = e
-
-      tries += 1
-    else:
-      # We never broke out of the loop: all tries failed.
-      logger.error('%r failed after %r tries', url, self.max_tries)
-      self.record_statistic(
-        FetchStatistic(
-          url=url,
-          next_url=None,
-          status=None,
-          exception=exception,
-          size=0,
-          content_type=None,
-          encoding=None,
-          num_urls=0,
-          num_new_urls=0))
+        if tries > 0:
+          logger.info('try %r for %r success', tries, url)
+    except aiohttp.ClientError as client_error:
+      logger.info('try %r for %r raised %r', tries, url, client_error)
+      if proxy:
+        self.proxy_failed(proxy)
+      self.retry(url, max_redirect, meta, client_error, started=started)
+      return
+    except asyncio.TimeoutError as timeout_error:
+      logger.info('try %r for %r raised %r', tries, url, timeout_error)
+      if proxy:
+        self.proxy_failed(proxy)
+      self.retry(url, max_redirect, meta, timeout_error, started=started)
+      return
+    except Exception as e:
+      if proxy:
+        self.proxy_failed(proxy)
+      logger.info('try %r for %r raised %r', tries, url, e)
+      self.retry(url, max_redirect, meta, e, started=started)
       return
 
-    try:
-      if is_redirect(response):
-        location = response.headers['location']
-        next_url = urllib.parse.urljoin(url, location)
-        self.record_statistic(
-          FetchStatistic(
-            url=url,
-            next_url=next_url,
-            status=response.status,
-            exception=None,
-            size=0,
-            content_type=None,
-            encoding=None,
-            num_urls=0,
-            num_new_urls=0))
-
-        if next_url in self.seen_urls:
-          return
-        if max_redirect > 0:
-          if self.url_allowed(next_url):
-            logger.info('redirect to %r from %r', next_url, url)
-            self.add_url(next_url, max_redirect - 1)
-        else:
-          logger.error('redirect limit reached for %r from %r', next_url, url)
-      else:
-        stat, links = await self.parse(url, response, meta=meta)
-        self.record_statistic(stat)
-        for link in links.difference(self.seen_urls):
-          self.add_url(link, meta=meta)
-        self.seen_urls.update(links)
-    finally:
-      await response.release()
+    await self.handle_response(url, response, max_redirect, meta, started)
 
 class DoubanGroupUserCrawler(ProxyMixinCrawler):
   ALLOWED_PATHS = [r'/group/\w+/members', r'/group/\w+/$']  # r'/group/\w+',]
   ITEM_PATHS = {'group': r'/group/\w+/members'}
   UserMeta = namedtuple('UserMeta', 'home_url name')
   GROUP_BASE_URL = 'https://www.douban.com/group/{}/members'
+  GROUP_ID_RE = re.compile(r'/group/([^/]+)/')
+  FIRST_MEMBERS_PAGE_RE = re.compile(r'/group/(\d+)/members(?:\?start=0)?$')
+  MEMBERS_PER_PAGE = 35
+  # Douban answers bans with 403 too: retry before calling a group private.
+  RETRY_STATUSES = ProxyMixinCrawler.RETRY_STATUSES + (403,)
+  # An empty member list is a ban page.
+  REJECTED_REASON = 'banned'
 
   def __init__(self, roots, exclude=None, strict=True, max_redirect=10,
                proxy=None, max_tries=4, user_agents=None, max_tasks=10,
                time_out=15, allowed_paths=None, item_paths=None,
-               group_ids=None, group_range=None, *, loop=None):
+               group_ids=None, group_range=None, *, loop=None,
+               dead_groups=None, **kwargs):
     super(DoubanGroupUserCrawler, self).__init__(
       roots, exclude, strict, max_redirect, proxy, max_tries, user_agents,
-      max_tasks, time_out, allowed_paths, item_paths, loop=loop)
+      max_tasks, time_out, allowed_paths, item_paths, loop=loop, **kwargs)
 
     self._users = set()
     self.grou_ids = group_ids
     self.group_range = group_range
+    self.dead_groups = dead_groups
+    self._next_group_id = None
     self.init_roots()
     self._db = None
     self.root_domains.add('www.douban.com')
@@ -545,33 +948,118 @@ class DoubanGroupUserCrawler(ProxyMixinCrawler):
       self._collection = self.db.users
     return self._collection
 
-  async def add_user(self, user_meta):
-    await self.users.update_one(
-      {'home_url': user_meta.home_url}, {'$set': {'nick_name': user_meta.name}},
-      upsert=True)
+  @staticmethod
+  def user_operation(user_meta):
+    return UpdateOne({'home_url': user_meta.home_url},
+                     {'$set': {'nick_name': user_meta.name}}, upsert=True)
+
+  @staticmethod
+  def valid_user(user_meta):
+    return bool(user_meta.home_url)
+
+  def item_stages(self):
+    return [Validate(self.valid_user), Dedup(self._users)]
+
+  def default_sinks(self):
+    # The collection is looked up on the first write, not at start up.
+    return [MongoSink(lambda: self.users, self.user_operation)]
+
+  def close(self):
+    self.save_dead_groups()
+    super(DoubanGroupUserCrawler, self).close()
 
   def init_roots(self):
     self.root_domains.add(self.GROUP_BASE_URL)
     if self.grou_ids:
-      for gid in self.grou_ids:
-        root_url = self.GROUP_BASE_URL.format(gid)
-        self.add_url(root_url)
+      self.add_seeds(
+        self.GROUP_BASE_URL.format(gid) for gid in self.grou_ids
+        if not self.known_dead_group(gid))
 
     if self.group_range:
-      start_id = self.group_range[0]
-      end_id = self.group_range[1]
-      for gid in range(start_id, end_id):
-        group_url = self.GROUP_BASE_URL.format(gid)
-        self.add_url(group_url)
+      self.add_seeds(self.group_range_seeds())
+
+  def group_range_seeds(self):
+    start_id, end_id = self.group_range[0], self.group_range[1]
+    if self._next_group_id is not None:
+      start_id = max(start_id, self._next_group_id)
+    for gid in range(start_id, end_id):
+      self._next_group_id = gid + 1
+      if self.shard is not None and not self.shard.owns(str(gid)):
+        continue
+      if self.known_dead_group(gid):
+        continue
+      yield self.GROUP_BASE_URL.format(gid)
+
+  def sweep_progress(self):
+    if not self.group_range:
+      return None
+    start_id, end_id = self.group_range[0], self.group_range[1]
+    next_id = self._next_group_id or start_id
+    return next_id - start_id, end_id - start_id
+
+  def known_dead_group(self, gid):
+    """True if gid was found dead, private or redirecting recently."""
+    if self.dead_groups is None or not str(gid).isdigit():
+      return False
+    return self.dead_groups.should_skip(int(gid))
+
+  def save_dead_groups(self):
+    """Write dead_groups to its file; done with every checkpoint and on
+    close, so an interrupted crawl keeps what it learned.
+    """
+    if self.dead_groups is not None and self.dead_groups.path:
+      self.dead_groups.save()
+
+  def record_statistic(self, fetch_statistic, elapsed=None):
+    super(DoubanGroupUserCrawler, self).record_statistic(fetch_statistic,
+                                                         elapsed)
+    if self.dead_groups is not None:
+      self.note_group_status(fetch_statistic)
+
+  def note_group_status(self, stat):
+    """Remember (or forget) a group as dead from its first members page."""
+    match = self.FIRST_MEMBERS_PAGE_RE.search(stat.url)
+    if match is None:
+      return
+    gid = int(match.group(1))
+    if stat.next_url:
+      reason = 'redirect'
+    elif stat.status in (404, 410):
+      reason = 'dead'
+    elif stat.status == 403:
+      reason = 'private'
+    else:
+      # A ban page says nothing about the group.
+      if stat.status == 200 and stat.exception is None:
+        self.dead_groups.discard(gid)
+      return
+    self.dead_groups.add(gid, reason)
+
+  def shard_key(self, url):
+    # All pages of a group go to the shard owning its id.
+    match = self.GROUP_ID_RE.search(url)
+    if match:
+      return match.group(1)
+    return super(DoubanGroupUserCrawler, self).shard_key(url)
+
+  def checkpoint_state(self):
+    state = super(DoubanGroupUserCrawler, self).checkpoint_state()
+    state['next_group_id'] = self._next_group_id
+    # The dead groups file outlives checkpoints; keep it as current.
+    self.save_dead_groups()
+    return state
+
+  def restore_state(self, state):
+    super(DoubanGroupUserCrawler, self).restore_state(state)
+    self._next_group_id = state.get('next_group_id')
 
   @property
   def session(self):
-    if not self._session:
-      self._session = aiohttp.ClientSession(loop=self.loop)
+    session = super(DoubanGroupUserCrawler, self).session
     cookies = {'bid': DoubanGroupUserCrawler.get_bid_of_cookies()}
-    self._session.cookie_jar.update_cookies(cookies)
+    session.cookie_jar.update_cookies(cookies)
     logger.debug(cookies)
-    return self._session
+    return session
 
   @classmethod
   def get_bid_of_cookies(cls):
@@ -583,21 +1071,67 @@ class DoubanGroupUserCrawler(ProxyMixinCrawler):
     logger.debug(headers)
     return headers
 
-  async def parse_group(self, url, data, *args, **kwargs):
+  def follow_links(self, url):
+    # Member pages are planned from the member count, see plan_member_pages.
+    return self.admission.check(url).item_kind != 'group'
+
+  def plan_member_pages(self, url, member_count):
+    """Queue the ?start= pages following a group's first members page, so
+    the group takes ceil(member_count / MEMBERS_PER_PAGE) requests in all.
+    """
+    base_url = url.split('?', 1)[0]
+    pages = math.ceil(member_count / self.MEMBERS_PER_PAGE)
+    planned = 0
+    for page in range(1, pages):
+      page_url = '{}?start={}'.format(base_url, page * self.MEMBERS_PER_PAGE)
+      if page_url not in self.seen_urls:
+        self.add_url(page_url)
+        planned += 1
+    logger.info('group %r has %d members, planned %d more pages', base_url,
+                member_count, planned)
+
+  @staticmethod
+  def members_start(url):
+    """The ?start= offset of a members page url, as a string."""
+    return urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get(
+      'start', ['0'])[0]
+
+  def page_unchanged(self, url):
+    # The first members page isn't parsed this time, so plan the rest from
+    # the member count stored with it.
+    if (self.admission.check(url).item_kind != 'group' or
+        self.members_start(url) != '0'):
+      return
+    member_count = self.http_cache.note(url)
+    if member_count is not None:
+      self.plan_member_pages(url, member_count)
+    else:
+      logger.warning('no stored member count for unchanged %r', url)
+
+  async def parse_group(self, url, body, *args, encoding=None, **kwargs):
     meta = kwargs.get('meta', {})
-    tree = html.fromstring(data)
-    group_users = tree.cssselect('.nbg')
+    group_users, member_count = await self.run_parser(extract_group_page,
+                                                      body, encoding)
     if len(group_users) == 0:
-      logger.error('Group Users is zero. data:{}'.format(data))
-      self.add_url(url, self.max_redirect, meta)
+      logger.error('Group Users is zero. data:{}'.format(
+        body.decode(encoding or 'utf-8', errors='replace')))
       proxy = meta.get('proxy', None)
       if proxy:
         self.delete_proxy(proxy)
-    for user_ in group_users:
-      user_meta = self.UserMeta(user_.attrib['href'],
-                                user_.cssselect('img')[0].attrib['alt'])
-      self._users.add(user_meta)
-      await self.add_user(user_meta)
+      return False
+    else:
+      start = self.members_start(url)
+      if start == '0' and member_count is not None:
+        self.note_for_cache(url, member_count)
+        self.plan_member_pages(url, member_count)
+      elif start == '0':
+        logger.warning('no member count on %r, following its links', url)
+        data = body.decode(encoding or 'utf-8', errors='replace')
+        for link in await self._parse_links(url, data):
+          if link not in self.seen_urls:
+            self.add_url(link)
+    for home_url, name in group_users:
+      await self.emit(self.UserMeta(home_url, name))
 
     logger.info('Finish get members of url: {}, members numbers is: {}'.format(
       url, len(self._users)))
@@ -611,40 +1145,15 @@ class CoupletCrawler(BaseCrawler):
   Couplet = namedtuple('Couplet', 'first second')
   couplets = set()
 
-  def _has_tag(self, element, key):
-    if element.cssselect(key):
-      return True
-    return False
-
-  def couplet_in_font(self, element):
-    if self._has_tag(element, 'font'):
-      font_tags = element.cssselect('font')
-      if len(font_tags) >= 2:
-        return True
-    return False
+  def item_stages(self):
+    return [Dedup(self.couplets)]
 
-  async def parse_couplet(self, url, data, **kwargs):
+  async def parse_couplet(self, url, body, encoding=None, **kwargs):
     meta = kwargs.get('meta', {})
-    tree = html.fromstring(data)
-    couplets = tree.cssselect('.content_zw > p')
-    if couplets:
-      for couplet in couplets:
-        couplet_item = None
-        if self.couplet_in_font(couplet):
-          couplet = couplet.cssselect('font')
-          if len(couplet) >= 2:
-            couplet_item = self.Couplet(couplet[0].text, couplet[1].text)
-            self.couplets.add(couplet_item)
-          logger.info('{}, {}'.format(couplet[0].text, couplet[1].text))
-        else:
-          lines = couplet.text_content().split('\n')
-          if len(lines) >= 2:
-            couplet_item = self.Couplet(lines[0].strip(),
-                                        lines[1].strip().split(' ')[0])
-
-            logger.info(
-              '{}, {}'.format(lines[0].strip(), lines[1].strip().split(' ')[0]))
-        if couplet_item:
-          self.couplets.add(couplet_item)
-          continue
-        logger.error('parse failed : {}'.format(couplet.text_content()))
+    couplets, failures = await self.run_parser(extract_couplets, body,
+                                               encoding)
+    for first, second in couplets:
+      logger.info('{}, {}'.format(first, second))
+      await self.emit(self.Couplet(first, second))
+    for text in failures:
+      logger.error('parse failed : {}'.format(text))
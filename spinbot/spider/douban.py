@@ -16,6 +16,8 @@ import requests
 import uvloop
 from lxml import html
 
+from spinbot.spider.retry import RetryError, backoff
+
 logging.basicConfig(
   level=logging.DEBUG
 )
@@ -32,6 +34,7 @@ asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 loop = asyncio.get_event_loop()
 sema = asyncio.Semaphore(15, loop=loop)
 users = set()
+MAX_TRIES = 5
 # proxies = requests.get('http://spin.printf.me:8000/?types=0&country=国内&count=10')
 # ip_ports = json.loads(proxies.text)
 
@@ -68,95 +71,103 @@ def get_random_user_agent():
 
 
 async def fetch(url):
-  try:
-    with async_timeout.timeout(15):
-      headers = {'User-Agent': get_random_user_agent(),
-                 'Host': 'www.douban.com'}
-      cookies = {
-        'bid': "".join(random.sample(string.ascii_letters + string.digits, 11))}
-      async with aiohttp.request(
-        method='GET',
-        url=url, headers=headers,
-        cookies=cookies,
-        proxy='http://spin.printf.me:3128', allow_redirects=False) as r:
-        data = await r.text()
-        return data
-  except Exception as e:
-    # logger.exception(e)
-    data = await fetch(url)
-    return data
-
-
-async def fetch_use_session(url):
-  try:
-    with (await sema):
+  for tries in range(MAX_TRIES):
+    try:
       with async_timeout.timeout(15):
         headers = {'User-Agent': get_random_user_agent(),
                    'Host': 'www.douban.com'}
         cookies = {
           'bid': "".join(random.sample(string.ascii_letters + string.digits, 11))}
-        async with aiohttp.ClientSession(cookies=cookies) as session:
-          # random.shuffle(ip_ports)
-          # ip = ip_ports[0][0]
-          # port = ip_ports[0][1]
-          # proxy = 'http://{ip}:{port}'.format(ip=ip, port=port)
-          # logger.info('proxy is:{}, url is:{}'.format(proxy, url))
-          async with session.get(
-            url=url, headers=headers,
-            proxy='http://spin.printf.me:3128',
-            allow_redirects=False) as r:
-            logger.info('status is : {}, type is : {}'.format(
-              r.status, type(r.status)))
-            if r.status == 200:
-              data = await r.text()
-              logger.info('success download url:{}'.format(url))
-              return data
-  except Exception as e:
-    # logger.exception(e)
-    data = await fetch_use_session(url)
-    return data
-
-  logger.error('Error status code {}, url is : {}'.format(
-    r.status, url))
-  return await fetch_use_session(url)
-
+        async with aiohttp.request(
+          method='GET',
+          url=url, headers=headers,
+          cookies=cookies,
+          proxy='http://spin.printf.me:3128', allow_redirects=False) as r:
+          data = await r.text()
+          return data
+    except Exception as e:
+      logger.info('try %r for %r raised %r', tries, url, e)
+    await asyncio.sleep(backoff(tries))
+  raise RetryError('{} failed after {} tries'.format(url, MAX_TRIES))
 
-async def get_member(url):
 
-  try:
-    r = await fetch_use_session(url)
-  except Exception as e:
-    logger.exception(e)
-    return
+async def fetch_use_session(url):
+  for tries in range(MAX_TRIES):
+    try:
+      with (await sema):
+        with async_timeout.timeout(15):
+          headers = {'User-Agent': get_random_user_agent(),
+                     'Host': 'www.douban.com'}
+          cookies = {
+            'bid': "".join(random.sample(string.ascii_letters + string.digits, 11))}
+          async with aiohttp.ClientSession(cookies=cookies) as session:
+            # random.shuffle(ip_ports)
+            # ip = ip_ports[0][0]
+            # port = ip_ports[0][1]
+            # proxy = 'http://{ip}:{port}'.format(ip=ip, port=port)
+            # logger.info('proxy is:{}, url is:{}'.format(proxy, url))
+            async with session.get(
+              url=url, headers=headers,
+              proxy='http://spin.printf.me:3128',
+              allow_redirects=False) as r:
+              logger.info('status is : {}, type is : {}'.format(
+                r.status, type(r.status)))
+              if r.status == 200:
+                data = await r.text()
+                logger.info('success download url:{}'.format(url))
+                return data
+              logger.error('Error status code {}, url is : {}'.format(
+                r.status, url))
+    except Exception as e:
+      logger.info('try %r for %r raised %r', tries, url, e)
+    # Back off outside the semaphore so waiting doesn't hold a slot.
+    await asyncio.sleep(backoff(tries))
+  raise RetryError('{} failed after {} tries'.format(url, MAX_TRIES))
 
-  tree = html.fromstring(r)
-  group_users = tree.cssselect('.nbg')
-  if len(group_users) == 0:
-    logger.error('Group Users is zero. data:{}'.format(r))
-    return await get_member(url)
-  for user_ in group_users:
-    user_meta = UserMeta(user_.attrib['href'],
-                         user_.cssselect('img')[0].attrib['alt'])
-    users.add(user_meta)
 
-  logger.info('Finish get members of url: {}, members numbers is: {}'.format(
-    url, len(users)))
+async def get_member(url):
+  for tries in range(MAX_TRIES):
+    try:
+      r = await fetch_use_session(url)
+    except Exception as e:
+      logger.exception(e)
+      return
+
+    tree = html.fromstring(r)
+    group_users = tree.cssselect('.nbg')
+    if len(group_users) == 0:
+      logger.error('Group Users is zero. data:{}'.format(r))
+      await asyncio.sleep(backoff(tries))
+      continue
+    for user_ in group_users:
+      user_meta = UserMeta(user_.attrib['href'],
+                           user_.cssselect('img')[0].attrib['alt'])
+      users.add(user_meta)
+
+    logger.info('Finish get members of url: {}, members numbers is: {}'.format(
+      url, len(users)))
+    return
+  logger.error('No members found on %r after %r tries', url, MAX_TRIES)
 
 
 async def get_max_page(group_id):
   step = 35
   group_url = 'https://www.douban.com/group/{}/members'.format(group_id)
-  rsp = await fetch_use_session(group_url)
-  tree = lxml.html.fromstring(rsp)
-  try:
-    total_amount = int(tree.cssselect('.ft-members i')[0].text)
+  for tries in range(MAX_TRIES):
+    rsp = await fetch_use_session(group_url)
+    tree = lxml.html.fromstring(rsp)
+    try:
+      total_amount = int(tree.cssselect('.ft-members i')[0].text)
+    except Exception as e:
+      logger.exception(e)
+      logger.info(rsp)
+      await asyncio.sleep(backoff(tries))
+      continue
     page_num = int(total_amount / step) + 1
     logger.info('The number of Group:{} is {}'.format(group_id, page_num))
-  except Exception as e:
-    logger.exception(e)
-    logger.info(rsp)
-    return await get_max_page(group_id)
-  return page_num
+    return page_num
+  raise RetryError('no member count for group {} after {} tries'.format(
+    group_id, MAX_TRIES))
 
 
 async def fetch_group_members_page(max_page, loop):
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Per-host politeness frontier for the crawler.
+
+``HostScheduler`` is a drop-in replacement for the ``asyncio.Queue`` the
+crawler used to pull work from.  Every host gets its own FIFO; hosts that
+have work and a free concurrency slot sit in a heap keyed by the time they
+may next be fetched, so ``get()`` always hands out the url that can be
+fetched soonest while honouring ``min_delay`` and ``max_per_host``.
+Retries are ``defer``-red on a separate heap until they are due, so they keep
+the crawl from finishing without occupying a worker.
+"""
+
+import heapq
+import itertools
+import logging
+import time
+import urllib.parse
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def url_host(url):
+  return urllib.parse.urlsplit(url).netloc.lower()
+
+
+class HostQueue(object):
+  __slots__ = ('host', 'items', 'active', 'next_allowed', 'scheduled')
+
+  def __init__(self, host):
+    self.host = host
+    self.items = deque()
+    self.active = 0
+    self.next_allowed = 0.0
+    self.scheduled = False
+
+
+class HostScheduler(object):
+  """Frontier with one queue per host and a ready-time heap.
+
+  Items are ``(url, max_redirect, meta)`` tuples, as used by ``add_url``.
+  ``task_done`` takes the finished item so the host's slot can be released.
+  """
+
+  def __init__(self, min_delay=0.0, max_per_host=None, *, loop,
+               clock=time.monotonic):
+    self.min_delay = min_delay
+    self.max_per_host = max_per_host
+    self._loop = loop
+    self._clock = clock
+    self._hosts = {}
+    self._ready = []
+    self._counter = itertools.count()
+    self._size = 0
+    self._unfinished = 0
+    self._delayed = []
+    self._delay_timer = None
+    self._getters = deque()
+    self._joiners = []
+
+  def _host_queue(self, host):
+    queue = self._hosts.get(host)
+    if queue is None:
+      queue = self._hosts[host] = HostQueue(host)
+    return queue
+
+  def _has_slot(self, queue):
+    return self.max_per_host is None or queue.active < self.max_per_host
+
+  def _schedule(self, queue):
+    if queue.scheduled or not queue.items or not self._has_slot(queue):
+      return
+    queue.scheduled = True
+    heapq.heappush(self._ready,
+                   (queue.next_allowed, next(self._counter), queue))
+    self._wakeup()
+
+  def _wakeup(self):
+    while self._getters:
+      waiter = self._getters.popleft()
+      if not waiter.done():
+        waiter.set_result(None)
+        return
+
+  def put_nowait(self, item):
+    queue = self._host_queue(url_host(item[0]))
+    queue.items.append(item)
+    self._size += 1
+    self._unfinished += 1
+    self._schedule(queue)
+
+  def defer(self, item, delay):
+    """Queue item once delay seconds have passed."""
+    heapq.heappush(self._delayed,
+                   (self._clock() + delay, next(self._counter), item))
+    self._unfinished += 1
+    self._arm_delay_timer()
+
+  def _arm_delay_timer(self):
+    if self._delay_timer is not None:
+      self._delay_timer.cancel()
+      self._delay_timer = None
+    if self._delayed:
+      delay = max(0.0, self._delayed[0][0] - self._clock())
+      self._delay_timer = self._loop.call_later(delay, self._release_delayed)
+
+  def _release_delayed(self):
+    self._delay_timer = None
+    now = self._clock()
+    while self._delayed and self._delayed[0][0] <= now:
+      _, _, item = heapq.heappop(self._delayed)
+      # put_nowait() counts it as unfinished again.
+      self._unfinished -= 1
+      self.put_nowait(item)
+    self._arm_delay_timer()
+
+  def _pop_ready(self, now):
+    if not self._ready or self._ready[0][0] > now:
+      return None
+    _, _, queue = heapq.heappop(self._ready)
+    queue.scheduled = False
+    item = queue.items.popleft()
+    self._size -= 1
+    queue.active += 1
+    queue.next_allowed = now + self.min_delay
+    self._schedule(queue)
+    return item
+
+  async def get(self):
+    while True:
+      item = self._pop_ready(self._clock())
+      if item is not None:
+        return item
+      waiter = self._loop.create_future()
+      self._getters.append(waiter)
+      timer = None
+      if self._ready:
+        delay = max(0.0, self._ready[0][0] - self._clock())
+        timer = self._loop.call_later(delay, self._release_waiter, waiter)
+      try:
+        await waiter
+      finally:
+        if timer is not None:
+          timer.cancel()
+        if not waiter.done():
+          waiter.cancel()
+
+  @staticmethod
+  def _release_waiter(waiter):
+    if not waiter.done():
+      waiter.set_result(None)
+
+  def task_done(self, item):
+    host = url_host(item[0])
+    queue = self._hosts.get(host)
+    if queue is not None:
+      queue.active -= 1
+      if queue.items:
+        self._schedule(queue)
+      elif not queue.active and queue.next_allowed <= self._clock():
+        del self._hosts[host]
+    self._unfinished -= 1
+    if self._unfinished <= 0:
+      for joiner in self._joiners:
+        if not joiner.done():
+          joiner.set_result(None)
+      self._joiners = []
+
+  async def join(self):
+    if self._unfinished > 0:
+      joiner = self._loop.create_future()
+      self._joiners.append(joiner)
+      await joiner
+
+  def qsize(self):
+    return self._size
+
+  def empty(self):
+    return self._size == 0
+
+  def delayed(self):
+    """Number of deferred items not due yet."""
+    return len(self._delayed)
+
+  def snapshot(self):
+    """Return every queued (not yet handed out) item, deferred ones too."""
+    items = [item for queue in self._hosts.values() for item in queue.items]
+    items.extend(item for _, _, item in sorted(self._delayed))
+    return items
+
+  def clear(self):
+    """Drop all queued items (used before restoring a checkpoint)."""
+    for queue in self._hosts.values():
+      self._unfinished -= len(queue.items)
+      queue.items.clear()
+    self._unfinished -= len(self._delayed)
+    self._delayed = []
+    self._arm_delay_timer()
+    self._size = 0
+    self._ready = []
+    for queue in self._hosts.values():
+      queue.scheduled = False
+
+  def host_depths(self):
+    """Return {host: number of queued urls} for hosts with pending work."""
+    return {host: len(queue.items) for host, queue in self._hosts.items()
+            if queue.items}
+
+  def active_hosts(self):
+    return {host: queue.active for host, queue in self._hosts.items()
+            if queue.active}
@@ -0,0 +1,318 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Hooks around the crawler's call points, and profiling hooks built on them.
+
+A ``Hook`` sees ``before``/``after`` every call of the points it lists
+(``fetch``, ``parse``, ``parse_item``, ``record_statistic``).
+``HookRegistry`` wraps those methods on the crawler instance only while
+some hook wants them, so an idle registry costs nothing.  Hooks can also be
+triggered by name, from a signal or a control call:
+
+  ``ProfileHook``  runs cProfile for a window of seconds (on demand or every
+                   ``interval``) and writes the pstats plus a text report
+                   with per-call-point timings.
+  ``MemoryHook``   starts tracemalloc on the first trigger and on each later
+                   one writes the top allocation growth since the previous.
+"""
+
+import asyncio
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import signal
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+POINTS = ('fetch', 'parse', 'parse_item', 'record_statistic')
+
+
+def _report_path(directory, prefix):
+  os.makedirs(directory, exist_ok=True)
+  return os.path.join(directory, '{}-{}-{}'.format(
+    prefix, os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+
+
+class Hook(object):
+  """Base hook: override what you need.  before() returns a state that is
+  handed back to after() along with the exception raised, if any.
+  """
+
+  points = ()
+
+  def before(self, point, args):
+    return None
+
+  def after(self, point, state, exc):
+    pass
+
+  def trigger(self):
+    """Run the hook's on-demand action; returns a report path or None."""
+
+  def start(self, loop):
+    pass
+
+  def stop(self):
+    pass
+
+
+class HookRegistry(object):
+
+  def __init__(self):
+    self.hooks = {}
+    self.signals = {}
+    self._crawler = None
+    self._loop = None
+
+  def register(self, name, hook, sig=None):
+    """Add hook under name; sig is a signal number that triggers it."""
+    self.hooks[name] = hook
+    if sig is not None:
+      self.signals[sig] = name
+    self._wrap()
+
+  def unregister(self, name):
+    self.hooks.pop(name, None)
+    for sig, hook_name in list(self.signals.items()):
+      if hook_name == name:
+        del self.signals[sig]
+    self._wrap()
+
+  def attach(self, crawler):
+    self._crawler = crawler
+    self._wrap()
+
+  def trigger(self, name):
+    hook = self.hooks.get(name)
+    if hook is None:
+      raise KeyError('No hook named {!r}'.format(name))
+    logger.info('triggering hook %s', name)
+    return hook.trigger()
+
+  def start(self, loop):
+    self._loop = loop
+    for hook in self.hooks.values():
+      hook.start(loop)
+    for sig, name in self.signals.items():
+      loop.add_signal_handler(sig, self._on_signal, name)
+
+  def stop(self):
+    if self._loop is not None:
+      for sig in self.signals:
+        self._loop.remove_signal_handler(sig)
+      self._loop = None
+    for hook in self.hooks.values():
+      hook.stop()
+
+  def _on_signal(self, name):
+    try:
+      self.trigger(name)
+    except Exception:
+      logger.exception('hook %s failed', name)
+
+  def _wrap(self):
+    crawler = self._crawler
+    if crawler is None:
+      return
+    for point in POINTS:
+      # Drop an earlier wrapper so the class method shows through again.
+      crawler.__dict__.pop(point, None)
+      hooks = [hook for hook in self.hooks.values() if point in hook.points]
+      if hooks:
+        setattr(crawler, point, _wrap(point, getattr(crawler, point), hooks))
+
+
+def _wrap(point, method, hooks):
+  if asyncio.iscoroutinefunction(method):
+    async def wrapper(*args, **kwargs):
+      states = [hook.before(point, args) for hook in hooks]
+      exc = None
+      try:
+        return await method(*args, **kwargs)
+      except BaseException as e:
+        exc = e
+        raise
+      finally:
+        for hook, state in zip(hooks, states):
+          hook.after(point, state, exc)
+  else:
+    def wrapper(*args, **kwargs):
+      states = [hook.before(point, args) for hook in hooks]
+      exc = None
+      try:
+        return method(*args, **kwargs)
+      except BaseException as e:
+        exc = e
+        raise
+      finally:
+        for hook, state in zip(hooks, states):
+          hook.after(point, state, exc)
+  return functools.wraps(method)(wrapper)
+
+
+class ProfileHook(Hook):
+  """cProfile the crawler's thread for duration seconds per capture."""
+
+  points = POINTS
+
+  def __init__(self, directory, duration=30.0, interval=None, top=40):
+    self.directory = directory
+    self.duration = duration
+    self.interval = interval
+    self.top = top
+    self.captures = 0
+    self._profile = None
+    self._timings = {}
+    self._started = None
+    self._loop = None
+    self._timer = None
+    self._finish_timer = None
+
+  @property
+  def active(self):
+    return self._profile is not None
+
+  def before(self, point, args):
+    if self._profile is None:
+      return None
+    return time.perf_counter()
+
+  def after(self, point, state, exc):
+    if state is None or self._profile is None:
+      return
+    count, total, errors = self._timings.get(point, (0, 0.0, 0))
+    self._timings[point] = (count + 1, total + time.perf_counter() - state,
+                            errors + (exc is not None))
+
+  def start(self, loop):
+    self._loop = loop
+    if self.interval:
+      self._timer = loop.call_later(self.interval, self._periodic)
+
+  def stop(self):
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    if self.active:
+      self.finish()
+    self._loop = None
+
+  def _periodic(self):
+    self.trigger()
+    self._timer = self._loop.call_later(self.interval, self._periodic)
+
+  def trigger(self):
+    if self.active:
+      logger.info('profile capture already running')
+      return None
+    self._timings = {}
+    self._started = time.perf_counter()
+    self._profile = cProfile.Profile()
+    self._profile.enable()
+    if self._loop is not None:
+      self._finish_timer = self._loop.call_later(self.duration, self.finish)
+    logger.info('profiling for %.1f secs', self.duration)
+    return None
+
+  def finish(self):
+    """End the capture and write <prefix>.pstats and <prefix>.txt."""
+    if not self.active:
+      return None
+    profile, self._profile = self._profile, None
+    profile.disable()
+    if self._finish_timer is not None:
+      self._finish_timer.cancel()
+      self._finish_timer = None
+    elapsed = time.perf_counter() - self._started
+    path = _report_path(self.directory, 'profile')
+    profile.dump_stats(path + '.pstats')
+    out = io.StringIO()
+    out.write('profile window: {:.1f} secs\n\n'.format(elapsed))
+    out.write('{:<18} {:>8} {:>12} {:>12} {:>7}\n'.format(
+      'call point', 'calls', 'total secs', 'mean secs', 'errors'))
+    for point, (count, total, errors) in sorted(self._timings.items()):
+      out.write('{:<18} {:>8} {:>12.3f} {:>12.6f} {:>7}\n'.format(
+        point, count, total, total / count, errors))
+    out.write('\n')
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats('cumulative').print_stats(self.top)
+    with open(path + '.txt', 'w') as fp:
+      fp.write(out.getvalue())
+    self.captures += 1
+    logger.info('wrote profile to %s.pstats', path)
+    return path + '.pstats'
+
+
+class MemoryHook(Hook):
+  """tracemalloc snapshot diffs between consecutive triggers."""
+
+  def __init__(self, directory, frames=10, top=30, key_type='lineno',
+               dump=False):
+    self.directory = directory
+    self.frames = frames
+    self.top = top
+    self.key_type = key_type
+    self.dump = dump
+    self.snapshots = 0
+    self._last = None
+    self._started_tracing = False
+
+  def _snapshot(self):
+    return tracemalloc.take_snapshot().filter_traces((
+      tracemalloc.Filter(False, tracemalloc.__file__),
+      tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+
+  def trigger(self):
+    if not tracemalloc.is_tracing():
+      tracemalloc.start(self.frames)
+      self._started_tracing = True
+      self._last = self._snapshot()
+      logger.info('started tracemalloc; trigger again for a diff')
+      return None
+    snapshot = self._snapshot()
+    if self._last is None:
+      self._last = snapshot
+      return None
+    current, peak = tracemalloc.get_traced_memory()
+    path = _report_path(self.directory, 'memory')
+    with open(path + '.txt', 'w') as fp:
+      fp.write('traced: {:.1f} MiB, peak {:.1f} MiB\n'.format(
+        current / 2 ** 20, peak / 2 ** 20))
+      fp.write('top {} allocation changes since the previous snapshot:\n\n'
+               .format(self.top))
+      for stat in snapshot.compare_to(self._last, self.key_type)[:self.top]:
+        fp.write('{}\n'.format(stat))
+        if self.key_type == 'traceback':
+          for line in stat.traceback.format():
+            fp.write('    {}\n'.format(line))
+    if self.dump:
+      snapshot.dump(path + '.snapshot')
+    self._last = snapshot
+    self.snapshots += 1
+    logger.info('wrote memory diff to %s.txt', path)
+    return path + '.txt'
+
+  def stop(self):
+    if self._started_tracing:
+      tracemalloc.stop()
+      self._started_tracing = False
+    self._last = None
+
+
+def profiling_hooks(directory, profile_seconds=30.0, profile_interval=None,
+                    frames=10):
+  """Registry with 'profile' on SIGUSR1 and 'memory' on SIGUSR2."""
+  registry = HookRegistry()
+  registry.register('profile', ProfileHook(directory, profile_seconds,
+                                           profile_interval),
+                    sig=signal.SIGUSR1)
+  registry.register('memory', MemoryHook(directory, frames),
+                    sig=signal.SIGUSR2)
+  return registry
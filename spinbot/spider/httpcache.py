@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Persistent validator cache for conditional re-crawls.
+
+For every fetched url ``ConditionalCache`` remembers the ETag, the
+Last-Modified date, a digest of the body and an optional note (a small JSON
+value the crawler derived from the page) in a local sqlite file.  The
+next run sends ``If-None-Match`` / ``If-Modified-Since``; a 304 (or a 200
+whose body digest did not change) lets the crawler skip parsing and item
+writes; the note stands in for the parse where later pages depend on it.
+The crawler stores validators only once the page was accepted, so
+a ban page is never mistaken for an unchanged one.  Only validators are
+stored, never bodies, and the oldest entries are evicted once the store
+exceeds ``max_bytes``.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+# Rough per-row overhead of the sqlite b-tree, used for size accounting.
+ROW_OVERHEAD = 40
+
+
+def body_digest(body):
+  return hashlib.blake2b(body, digest_size=16).digest()
+
+
+class ConditionalCache(object):
+
+  def __init__(self, path, max_bytes=64 * 1024 * 1024, commit_every=500):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.commit_every = commit_every
+    self.hits = 0
+    self.misses = 0
+    self.not_modified = 0
+    self.unchanged = 0
+    self._writes = 0
+    self._db = sqlite3.connect(path)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.execute(
+      'CREATE TABLE IF NOT EXISTS validators ('
+      ' url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT,'
+      ' digest BLOB, size INTEGER, accessed REAL, note TEXT)')
+    columns = [row[1] for row in
+               self._db.execute('PRAGMA table_info(validators)')]
+    if 'note' not in columns:
+      # Caches written before notes existed.
+      self._db.execute('ALTER TABLE validators ADD COLUMN note TEXT')
+    self._db.execute(
+      'CREATE INDEX IF NOT EXISTS validators_accessed'
+      ' ON validators (accessed)')
+    self.size = self._db.execute(
+      'SELECT COALESCE(SUM(size), 0) FROM validators').fetchone()[0]
+
+  def _get(self, url):
+    return self._db.execute(
+      'SELECT etag, last_modified, digest, size FROM validators WHERE url = ?',
+      (url,)).fetchone()
+
+  def conditional_headers(self, url):
+    """Headers to revalidate url, counting a hit if we know it."""
+    row = self._get(url)
+    if row is None:
+      self.misses += 1
+      return {}
+    self.hits += 1
+    etag, last_modified, _, _ = row
+    headers = {}
+    if etag:
+      headers['If-None-Match'] = etag
+    if last_modified:
+      headers['If-Modified-Since'] = last_modified
+    return headers
+
+  def mark_not_modified(self, url):
+    self.not_modified += 1
+    self._db.execute('UPDATE validators SET accessed = ? WHERE url = ?',
+                     (time.time(), url))
+    self._written()
+
+  def is_unchanged(self, url, digest):
+    """Whether digest (see body_digest) matches the one stored for url."""
+    row = self._get(url)
+    if row is None or row[2] != digest:
+      return False
+    self.unchanged += 1
+    self._db.execute('UPDATE validators SET accessed = ? WHERE url = ?',
+                     (time.time(), url))
+    self._written()
+    return True
+
+  def note(self, url):
+    """The note stored with url's validators, or None."""
+    row = self._db.execute('SELECT note FROM validators WHERE url = ?',
+                           (url,)).fetchone()
+    if row is None or row[0] is None:
+      return None
+    return json.loads(row[0])
+
+  def store(self, url, headers, digest, note=None):
+    """Store the validators of an accepted 200 response, with an optional
+    JSON-serializable note.
+    """
+    row = self._get(url)
+    etag = headers.get('etag')
+    last_modified = headers.get('last-modified')
+    note = json.dumps(note) if note is not None else None
+    size = (len(url) + len(etag or '') + len(last_modified or '') +
+            len(digest) + len(note or '') + ROW_OVERHEAD)
+    self._db.execute(
+      'INSERT OR REPLACE INTO validators'
+      ' (url, etag, last_modified, digest, size, accessed, note)'
+      ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+      (url, etag, last_modified, digest, size, time.time(), note))
+    self.size += size - (row[3] if row is not None else 0)
+    self._written()
+
+  def _written(self):
+    self._writes += 1
+    if self._writes >= self.commit_every:
+      self.commit()
+
+  def evict(self):
+    """Drop least recently used entries until under 90% of max_bytes."""
+    if self.size <= self.max_bytes:
+      return
+    target = self.max_bytes * 0.9
+    while self.size > target:
+      rows = self._db.execute(
+        'SELECT url, size FROM validators ORDER BY accessed LIMIT 1000'
+      ).fetchall()
+      if not rows:
+        self.size = 0
+        break
+      doomed = []
+      for url, size in rows:
+        if self.size <= target:
+          break
+        doomed.append((url,))
+        self.size -= size
+      self._db.executemany('DELETE FROM validators WHERE url = ?', doomed)
+      logger.debug('evicted %d cache entries', len(doomed))
+
+  def commit(self):
+    self.evict()
+    self._db.commit()
+    self._writes = 0
+
+  def close(self):
+    if self._db is not None:
+      self.commit()
+      self._db.close()
+      self._db = None
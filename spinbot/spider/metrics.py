@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Live crawl metrics in Prometheus text format.
+
+``Metrics`` keeps labelled counters and latency histograms (the fixed
+bucket ``LatencyHistogram`` of ``stats``) plus gauges read on demand.  An
+observation is a dict lookup and a bisect, cheap enough to leave on; the
+number of label sets per metric is capped so per-host and per-proxy series
+can't grow without bound.  ``MetricsServer`` serves ``/metrics`` from a
+small aiohttp app on the crawler's loop, along with ``POST /hooks/<name>``
+to trigger a crawler hook (see ``hooks``) when given a registry.
+"""
+
+import logging
+import time
+
+from aiohttp import web
+
+from spinbot.spider.stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW = (('overflow', 'true'),)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _Timer(object):
+  __slots__ = ('metrics', 'name', 'labels', 'started', 'elapsed')
+
+  def __init__(self, metrics, name, labels):
+    self.metrics = metrics
+    self.name = name
+    self.labels = labels
+    self.elapsed = None
+
+  def __enter__(self):
+    self.started = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.elapsed = time.perf_counter() - self.started
+    self.metrics.observe(self.name, self.elapsed, **self.labels)
+
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+    '\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+  pairs = tuple(labels) + tuple(extra)
+  if not pairs:
+    return ''
+  return '{' + ','.join('{}="{}"'.format(key, _escape(value))
+                        for key, value in pairs) + '}'
+
+
+def _format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+
+  def __init__(self, prefix='spinbot', max_series=1000):
+    self.prefix = prefix
+    self.max_series = max_series
+    self._counters = {}
+    self._histograms = {}
+    self._gauges = {}
+    self._help = {}
+
+  def describe(self, name, text):
+    self._help[name] = text
+
+  def _key(self, series, labels):
+    key = tuple(sorted(labels.items()))
+    if key not in series and len(series) >= self.max_series:
+      return OVERFLOW
+    return key
+
+  def inc(self, name, value=1, **labels):
+    series = self._counters.get(name)
+    if series is None:
+      series = self._counters[name] = {}
+    key = self._key(series, labels)
+    series[key] = series.get(key, 0) + value
+
+  def observe(self, name, value, **labels):
+    series = self._histograms.get(name)
+    if series is None:
+      series = self._histograms[name] = {}
+    key = self._key(series, labels)
+    histogram = series.get(key)
+    if histogram is None:
+      histogram = series[key] = LatencyHistogram()
+    histogram.add(value)
+
+  def timer(self, name, **labels):
+    """Context manager observing the seconds spent in its block."""
+    return _Timer(self, name, labels)
+
+  def gauge(self, name, func):
+    """Register func() returning a number, or {label pairs: number} with
+    label pairs a tuple like (('host', 'a.com'),).
+    """
+    self._gauges[name] = func
+
+  def histogram(self, name, **labels):
+    return self._histograms.get(name, {}).get(tuple(sorted(labels.items())))
+
+  def counter(self, name, **labels):
+    return self._counters.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+  def _header(self, lines, name, kind):
+    full_name = '{}_{}'.format(self.prefix, name)
+    if name in self._help:
+      lines.append('# HELP {} {}'.format(full_name, self._help[name]))
+    lines.append('# TYPE {} {}'.format(full_name, kind))
+    return full_name
+
+  def render(self):
+    lines = []
+    for name, series in sorted(self._counters.items()):
+      full_name = self._header(lines, name, 'counter')
+      for labels, value in sorted(series.items()):
+        lines.append('{}{} {}'.format(full_name, _format_labels(labels),
+                                      _format_value(value)))
+    for name, series in sorted(self._histograms.items()):
+      full_name = self._header(lines, name, 'histogram')
+      for labels, histogram in sorted(series.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.bounds, histogram.counts):
+          cumulative += count
+          lines.append('{}_bucket{} {}'.format(
+            full_name, _format_labels(labels, (('le',
+                                                _format_value(bound)),)),
+            cumulative))
+        lines.append('{}_sum{} {}'.format(full_name, _format_labels(labels),
+                                          repr(histogram.sum)))
+        lines.append('{}_count{} {}'.format(full_name, _format_labels(labels),
+                                            histogram.count))
+    for name, func in sorted(self._gauges.items()):
+      try:
+        value = func()
+      except Exception as e:
+        logger.debug('gauge %s failed: %r', name, e)
+        continue
+      if value is None:
+        continue
+      full_name = self._header(lines, name, 'gauge')
+      if isinstance(value, dict):
+        for labels, item in sorted(value.items()):
+          lines.append('{}{} {}'.format(full_name, _format_labels(labels),
+                                        _format_value(item)))
+      else:
+        lines.append('{} {}'.format(full_name, _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(object):
+  """Serve Metrics.render() at http://host:port/metrics."""
+
+  def __init__(self, metrics, host='127.0.0.1', port=9108, hooks=None):
+    self.metrics = metrics
+    self.host = host
+    self.port = port
+    self.hooks = hooks
+    self._runner = None
+
+  async def handle(self, request):
+    return web.Response(body=self.metrics.render().encode('utf-8'),
+                        headers={'Content-Type': CONTENT_TYPE})
+
+  async def trigger_hook(self, request):
+    name = request.match_info['name']
+    try:
+      path = self.hooks.trigger(name)
+    except KeyError:
+      raise web.HTTPNotFound(text='No hook named {!r}\n'.format(name))
+    return web.Response(text='{}\n'.format(path or 'triggered'))
+
+  async def start(self):
+    app = web.Application()
+    app.router.add_get('/metrics', self.handle)
+    if self.hooks is not None:
+      app.router.add_post('/hooks/{name}', self.trigger_hook)
+    self._runner = web.AppRunner(app)
+    await self._runner.setup()
+    await web.TCPSite(self._runner, self.host, self.port).start()
+    logger.info('serving metrics on http://%s:%d/metrics', self.host,
+                self.port)
+
+  async def stop(self):
+    if self._runner is not None:
+      await self._runner.cleanup()
+      self._runner = None
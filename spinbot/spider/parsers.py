@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Item extraction functions and the pool that runs them.
+
+The ``extract_*`` functions are plain module level functions: they take the
+raw page (bytes plus its charset, or text) and return plain tuples, so
+``ParserPool`` can run them in a process pool (or a thread pool -- lxml
+releases the GIL while parsing) without pickling crawler state.  Decoding
+happens there too, off the event loop.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import re
+
+from lxml import html
+
+logger = logging.getLogger(__name__)
+
+
+def _document(body, encoding=None):
+  if encoding is not None and isinstance(body, bytes):
+    body = body.decode(encoding, errors='replace')
+  return html.fromstring(body)
+
+
+def extract_group_page(body, encoding=None):
+  """Return (members, member_count) for a Douban group members page.
+  members is [(home_url, name), ...]; member_count is the group size shown
+  in the '.ft-members i' counter, or None when the page has none.
+  """
+  tree = _document(body, encoding)
+  members = [(user_.attrib['href'], user_.cssselect('img')[0].attrib['alt'])
+             for user_ in tree.cssselect('.nbg')]
+  member_count = None
+  counters = tree.cssselect('.ft-members i')
+  if counters:
+    digits = re.sub(r'\D', '', counters[0].text_content())
+    if digits:
+      member_count = int(digits)
+  return members, member_count
+
+
+def _couplet_in_font(element):
+  return len(element.cssselect('font')) >= 2
+
+
+def extract_couplets(body, encoding=None):
+  """Return ([(first, second), ...], [unparsed text, ...]) for a couplet page.
+  """
+  tree = _document(body, encoding)
+  couplets = []
+  failures = []
+  for couplet in tree.cssselect('.content_zw > p'):
+    if _couplet_in_font(couplet):
+      fonts = couplet.cssselect('font')
+      couplets.append((fonts[0].text, fonts[1].text))
+      continue
+    lines = couplet.text_content().split('\n')
+    if len(lines) >= 2:
+      couplets.append((lines[0].strip(), lines[1].strip().split(' ')[0]))
+      continue
+    failures.append(couplet.text_content())
+  return couplets, failures
+
+
+class ParserPool(object):
+  """Run extraction functions off the event loop.
+
+  ``kind`` is 'inline' (run on the loop, the default), 'thread' or
+  'process'.  At most ``max_in_flight`` jobs are submitted at once so a
+  burst of responses can't pile up unbounded work in the executor.
+  """
+
+  def __init__(self, kind='inline', workers=None, max_in_flight=None):
+    self.kind = kind
+    self.workers = workers or os.cpu_count() or 1
+    self.max_in_flight = max_in_flight or self.workers * 2
+    self._executor = None
+    if kind == 'process':
+      self._executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+    elif kind == 'thread':
+      self._executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+    elif kind != 'inline':
+      raise ValueError('Unknown parser pool kind: {!r}'.format(kind))
+    self._slots = None
+
+  async def run(self, func, *args):
+    if self._executor is None:
+      return func(*args)
+    if self._slots is None:
+      self._slots = asyncio.Semaphore(self.max_in_flight)
+    async with self._slots:
+      return await asyncio.get_event_loop().run_in_executor(
+        self._executor, func, *args)
+
+  def shutdown(self, wait=True):
+    if self._executor is not None:
+      self._executor.shutdown(wait=wait)
+      self._executor = None
@@ -0,0 +1,357 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Item pipeline between parse callbacks and storage.
+
+Parse callbacks hand items (the crawlers' namedtuples) to
+``ItemPipeline.put`` instead of writing them themselves.  Items then flow
+through a chain of stages (``Validate``, ``Dedup``, ``Enrich`` or any
+``Stage``), each with its own number of workers.  They are gathered into
+batches of ``batch_size`` (or whatever arrived within ``batch_timeout``)
+and written to every sink (``MongoSink``, ``JsonlSink``, ``RedisSink``).
+Every stage reads from a queue of at most ``maxsize`` items.  When storage
+falls behind, the queues fill up and ``put`` waits, which slows the fetch
+workers down instead of letting items pile up in memory.  Per-stage
+counts, busy time and queue depths go to the crawler's ``Metrics``.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import Counter, OrderedDict
+
+from spinbot.database.mongodb.bulk import BulkWriter
+
+logger = logging.getLogger(__name__)
+
+
+class Stage(object):
+  """One step of the pipeline; process() returns the item or None to drop
+  it.
+  """
+
+  name = 'stage'
+
+  def __init__(self, concurrency=1):
+    self.concurrency = concurrency
+
+  async def process(self, item):
+    return item
+
+
+class Validate(Stage):
+
+  name = 'validate'
+
+  def __init__(self, check, concurrency=1):
+    super(Validate, self).__init__(concurrency)
+    self.check = check
+
+  async def process(self, item):
+    return item if self.check(item) else None
+
+
+class Dedup(Stage):
+  """Drop items whose key was seen; seen may be a set shared with the
+  crawler (e.g. DoubanGroupUserCrawler._users).
+  """
+
+  name = 'dedup'
+
+  def __init__(self, seen=None, key=None, concurrency=1):
+    super(Dedup, self).__init__(concurrency)
+    self.seen = set() if seen is None else seen
+    self.key = key
+
+  async def process(self, item):
+    key = item if self.key is None else self.key(item)
+    if key in self.seen:
+      return None
+    self.seen.add(key)
+    return item
+
+
+class Enrich(Stage):
+  """Replace each item by func(item); func may be a coroutine function."""
+
+  name = 'enrich'
+
+  def __init__(self, func, concurrency=1):
+    super(Enrich, self).__init__(concurrency)
+    self.func = func
+
+  async def process(self, item):
+    result = self.func(item)
+    if asyncio.iscoroutine(result):
+      result = await result
+    return result
+
+
+def item_record(item):
+  """A JSON-friendly dict for a namedtuple (or dict) item."""
+  if hasattr(item, '_asdict'):
+    return dict(item._asdict())
+  return item
+
+
+class Sink(object):
+
+  name = 'sink'
+
+  async def write(self, items):
+    raise NotImplementedError
+
+  async def close(self):
+    pass
+
+
+class MongoSink(Sink):
+  """Write items through a BulkWriter; to_operation turns an item into a
+  pymongo write operation.  collection may be a callable returning the
+  collection, so nothing connects to Mongo before the first item.
+  """
+
+  name = 'mongo'
+
+  def __init__(self, collection, to_operation, **writer_options):
+    self.collection = collection
+    self.to_operation = to_operation
+    self.writer_options = writer_options
+    self._writer = None
+
+  @property
+  def writer(self):
+    if self._writer is None:
+      collection = self.collection
+      if callable(collection):
+        collection = collection()
+      self._writer = BulkWriter(collection, **self.writer_options)
+    return self._writer
+
+  async def write(self, items):
+    writer = self.writer
+    for item in items:
+      # Blocks once the writer has max_pending operations waiting.
+      await writer.add(self.to_operation(item))
+
+  async def close(self):
+    if self._writer is not None:
+      await self._writer.close()
+
+
+class JsonlSink(Sink):
+  """Append items as JSON lines to path."""
+
+  name = 'jsonl'
+
+  def __init__(self, path):
+    self.path = path
+    self._file = None
+
+  async def write(self, items):
+    if self._file is None:
+      self._file = open(self.path, 'a', encoding='utf-8')
+    self._file.write(''.join(
+      json.dumps(item_record(item), ensure_ascii=False) + '\n'
+      for item in items))
+    self._file.flush()
+
+  async def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+
+class RedisSink(Sink):
+  """RPUSH items as JSON onto the Redis list key, keeping at most
+  max_length of the newest when given.
+  """
+
+  name = 'redis'
+
+  def __init__(self, key, redis=None, max_length=None):
+    self.key = key
+    self.max_length = max_length
+    self._redis = redis
+
+  async def redis(self):
+    if self._redis is None:
+      from spinbot.database.redis.redisbase import RedisSession
+      self._redis = await RedisSession().get_redis_pool()
+    return self._redis
+
+  async def write(self, items):
+    redis = await self.redis()
+    await redis.execute('RPUSH', self.key, *(
+      json.dumps(item_record(item), ensure_ascii=False) for item in items))
+    if self.max_length:
+      await redis.execute('LTRIM', self.key, -self.max_length, -1)
+
+
+def _unique_names(objects):
+  names = []
+  for obj in objects:
+    name = obj.name
+    if name in names:
+      name = '{}{}'.format(name, sum(1 for n in names
+                                     if n.startswith(obj.name)) + 1)
+    names.append(name)
+  return names
+
+
+class ItemPipeline(object):
+
+  def __init__(self, stages=(), sinks=(), maxsize=1000, batch_size=100,
+               batch_timeout=1.0, sink_concurrency=1, metrics=None):
+    self.stages = list(stages)
+    self.sinks = list(sinks)
+    self.maxsize = maxsize
+    self.batch_size = batch_size
+    self.batch_timeout = batch_timeout
+    self.sink_concurrency = sink_concurrency
+    self.metrics = metrics
+    self.stage_names = _unique_names(self.stages)
+    self.sink_names = _unique_names(self.sinks)
+    self.counts = OrderedDict(
+      (name, Counter())
+      for name in self.stage_names + ['batch'] + self.sink_names)
+    self.busy = Counter()
+    self.emitted = 0
+    self.batches = 0
+    self._queues = None
+    self._tasks = []
+    self._closing = False
+    if metrics is not None:
+      metrics.describe('pipeline_items_total',
+                       'Items per pipeline stage and result.')
+      metrics.gauge('pipeline_queue_depth', self.queue_depths)
+
+  @property
+  def running(self):
+    return bool(self._tasks)
+
+  def queue_depths(self):
+    if self._queues is None:
+      return None
+    return {(('stage', name),): queue.qsize()
+            for name, queue in zip(self.stage_names + ['batch'],
+                                   self._queues)}
+
+  def start(self):
+    if self._tasks:
+      return
+    self._closing = False
+    self._queues = [asyncio.Queue(self.maxsize)
+                    for _ in range(len(self.stages) + 1)]
+    for index, stage in enumerate(self.stages):
+      for _ in range(stage.concurrency):
+        self._tasks.append(asyncio.ensure_future(self._run_stage(index)))
+    for _ in range(self.sink_concurrency):
+      self._tasks.append(asyncio.ensure_future(self._run_sinks()))
+
+  async def put(self, item):
+    """Queue an item, waiting while the first stage's queue is full."""
+    if not self._tasks:
+      self.start()
+    self.emitted += 1
+    await self._queues[0].put(item)
+
+  def _count(self, name, result, count=1):
+    self.counts[name][result] += count
+    if self.metrics is not None:
+      self.metrics.inc('pipeline_items_total', count, stage=name,
+                       result=result)
+
+  def _observe(self, name, secs):
+    self.busy[name] += secs
+    if self.metrics is not None:
+      self.metrics.observe('pipeline_stage_seconds', secs, stage=name)
+
+  async def _run_stage(self, index):
+    stage = self.stages[index]
+    name = self.stage_names[index]
+    inbox, outbox = self._queues[index], self._queues[index + 1]
+    while True:
+      item = await inbox.get()
+      try:
+        self._count(name, 'in')
+        started = time.perf_counter()
+        try:
+          result = await stage.process(item)
+        except Exception:
+          logger.exception('pipeline stage %s failed on %r', name, item)
+          self._count(name, 'failed')
+          continue
+        finally:
+          self._observe(name, time.perf_counter() - started)
+        if result is None:
+          self._count(name, 'dropped')
+        else:
+          self._count(name, 'out')
+          await outbox.put(result)
+      finally:
+        inbox.task_done()
+
+  async def _run_sinks(self):
+    inbox = self._queues[-1]
+    loop = asyncio.get_event_loop()
+    while True:
+      batch = [await inbox.get()]
+      deadline = loop.time() + self.batch_timeout
+      while len(batch) < self.batch_size:
+        if not inbox.empty():
+          batch.append(inbox.get_nowait())
+          continue
+        remaining = deadline - loop.time()
+        if remaining <= 0 or self._closing:
+          break
+        await asyncio.sleep(min(remaining, 0.05))
+      try:
+        self.batches += 1
+        self._count('batch', 'out', len(batch))
+        await asyncio.gather(*(self._write(name, sink, batch) for name, sink
+                               in zip(self.sink_names, self.sinks)))
+      finally:
+        for _ in batch:
+          inbox.task_done()
+
+  async def _write(self, name, sink, batch):
+    started = time.perf_counter()
+    try:
+      await sink.write(batch)
+      self._count(name, 'out', len(batch))
+    except Exception:
+      logger.exception('pipeline sink %s failed on %d items', name,
+                       len(batch))
+      self._count(name, 'failed', len(batch))
+    finally:
+      self._observe(name, time.perf_counter() - started)
+
+  async def join(self):
+    """Wait until every item put so far went through to the sinks."""
+    if self._queues is None:
+      return
+    # Items only move forward, so draining the queues in order drains all.
+    for queue in self._queues:
+      await queue.join()
+
+  async def close(self):
+    """Drain the pipeline, stop its workers and close the sinks."""
+    self._closing = True
+    await self.join()
+    for task in self._tasks:
+      task.cancel()
+    self._tasks = []
+    for sink in self.sinks:
+      await sink.close()
+
+  def stats(self):
+    return {
+      'emitted': self.emitted,
+      'batches': self.batches,
+      'stages': OrderedDict(
+        (name, dict(counts, busy_secs=self.busy[name]))
+        for name, counts in self.counts.items()),
+    }
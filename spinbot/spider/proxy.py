@@ -4,13 +4,15 @@
 
 from spinbot.settings import *
 from spinbot.database.redis.redisbase import RedisSession
-from spinbot.utils.token_bucket import Bucket
+from spinbot.utils.rate_limit import RateLimiter
+import asyncio
+import async_timeout
 import datetime
-from collections import defaultdict
-import random
-import requests
+import heapq
+import itertools
 import logging
 import time
+from collections import deque
 
 logger = logging.getLogger(__name__)
 
@@ -25,16 +27,163 @@ class ProxyPool:
     return redis_session
 
 
+class ProxyEntry(object):
+  __slots__ = ('ip', 'limiter', 'fail', 'ready_at', 'removed')
+
+  def __init__(self, ip, limiter):
+    self.ip = ip
+    self.limiter = limiter
+    self.fail = 0
+    self.ready_at = 0.0
+    self.removed = False
+
+
+class IndexedProxyPool(object):
+  """Proxies ordered by the time their rate limiter can next serve a request.
+
+  ``acquire`` pops the heap head in O(log n) and sleeps until it is ready
+  instead of polling random proxies.  Waiting callers are served one at a
+  time in arrival order: only the first one sleeps on the heap head.
+  ``remove`` and ``fail`` are O(1): removed entries are only flagged and
+  skipped lazily when they reach the top.
+  """
+
+  def __init__(self, rate=2, burst=1, max_fail=4, clock=time.monotonic):
+    self.rate = rate
+    self.burst = burst
+    self.max_fail = max_fail
+    self._clock = clock
+    self._entries = {}
+    self._heap = []
+    self._counter = itertools.count()
+    self._waiters = deque()
+    self._timer = None
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, ip):
+    return ip in self._entries
+
+  def __iter__(self):
+    return iter(self._entries)
+
+  def _push(self, entry):
+    heapq.heappush(self._heap, (entry.ready_at, next(self._counter), entry))
+
+  def add(self, ip):
+    """Add a proxy, return False if it is already pooled."""
+    if ip in self._entries:
+      return False
+    entry = ProxyEntry(ip, RateLimiter(self.rate, self.burst, self._clock))
+    self._entries[ip] = entry
+    self._push(entry)
+    self._wake_first()
+    return True
+
+  def remove(self, ip):
+    entry = self._entries.pop(ip, None)
+    if entry is None:
+      return False
+    entry.removed = True
+    if len(self._heap) > 2 * len(self._entries) + 64:
+      self._compact()
+    return True
+
+  def fail(self, ip):
+    """Count a failure for ip, return True if it got evicted for it."""
+    entry = self._entries.get(ip)
+    if entry is None:
+      return False
+    entry.fail += 1
+    if entry.fail > self.max_fail:
+      return self.remove(ip)
+    return False
+
+  def _compact(self):
+    self._heap = [item for item in self._heap if not item[2].removed]
+    heapq.heapify(self._heap)
+
+  def _wake_first(self):
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    if self._waiters and not self._waiters[0].done():
+      self._waiters[0].set_result(None)
+
+  def _arm_timer(self):
+    """Wake the first waiter when the heap head is ready; with no proxies
+    left it waits for add().
+    """
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    delay = self.next_ready_in()
+    if self._waiters and delay is not None:
+      self._timer = asyncio.get_event_loop().call_later(delay,
+                                                        self._wake_first)
+
+  def try_acquire(self):
+    """Take a token from the soonest ready proxy, or return None."""
+    heap = self._heap
+    while heap:
+      ready_at, _, entry = heap[0]
+      if entry.removed:
+        heapq.heappop(heap)
+        continue
+      if ready_at > self._clock():
+        return None
+      acquired = entry.limiter.try_acquire()
+      entry.ready_at = self._clock() + entry.limiter.delay()
+      heapq.heapreplace(heap, (entry.ready_at, next(self._counter), entry))
+      if acquired:
+        return entry.ip
+    return None
+
+  def next_ready_in(self):
+    """Seconds until the heap head is ready, None if the pool is empty."""
+    while self._heap and self._heap[0][2].removed:
+      heapq.heappop(self._heap)
+    if not self._heap:
+      return None
+    return max(0.0, self._heap[0][0] - self._clock())
+
+  async def acquire(self):
+    """Wait until some proxy has a token and return its ip."""
+    if not self._waiters:
+      ip = self.try_acquire()
+      if ip is not None:
+        return ip
+    loop = asyncio.get_event_loop()
+    waiter = loop.create_future()
+    self._waiters.append(waiter)
+    try:
+      if len(self._waiters) == 1:
+        self._arm_timer()
+      while True:
+        await waiter
+        ip = self.try_acquire()
+        if ip is not None:
+          return ip
+        # Still first in line; sleep until the new heap head is ready.
+        waiter = loop.create_future()
+        self._waiters[0] = waiter
+        self._arm_timer()
+    finally:
+      first = self._waiters[0] is waiter
+      self._waiters.remove(waiter)
+      if first:
+        self._arm_timer()
+
+
 class ProxyMixin:
   def __init__(self, upstream_url=None, min_count=10, max_fail=4, rate=2,
                burst=1, update_interval=30, *args, **kwargs):
     self.upstream_url = UPSTREAM_URL
-    self.proxy_pool = defaultdict(dict)
     self.deleted_proxies = set()
     self.min_count = CRAWLER_SETTINGS.get('max_tasks')
     self.rate = rate
     self.burst = burst
-    self.valid_proxy_count = 0
     self.last_update = time.time()
     self.last_clear = time.time()
     self.update_interval = update_interval * 60
@@ -42,76 +191,104 @@ class ProxyMixin:
     if min_count:
       self.min_count = min_count
     self.max_fail = max_fail
+    self.proxy_pool = IndexedProxyPool(rate=self.rate, burst=self.burst,
+                                       max_fail=self.max_fail)
 
     if upstream_url:
       self.upstream_url = upstream_url
 
-    self._fetch_proxy_from_upstream()
+    self.upstream_timeout = 10
+    self._refresh_task = None
+    self._refresh_event = None
+    self._proxy_refresher = None
 
   @property
-  def proxy(self):
-    if self.valid_proxy_count < self.min_count:
-      self._fetch_proxy_from_upstream()
-    proxy = self.get_proxy()
-    logger.info('proxy ip: %s', proxy)
+  def valid_proxy_count(self):
+    return len(self.proxy_pool)
+
+  async def acquire_proxy(self):
+    """Return a proxy url, waiting on the upstream only if the pool is empty.
+    """
+    if not self.proxy_pool:
+      await self.refresh_proxies()
+      if not self.proxy_pool:
+        raise LookupError('no proxy available from {}'.format(
+          self.upstream_url))
+    elif self.valid_proxy_count < self.min_count:
+      self.request_proxy_refresh()
+    ip = await self.proxy_pool.acquire()
+    proxy = 'http://{}'.format(ip)
+    logger.debug('proxy ip: %s', proxy)
     return proxy
 
-  def get_proxy(self):
-    logger.info('valid ip number is: {}'.format(self.valid_proxy_count))
-    now = time.time()
-    if now - self.last_update > self.update_interval:
-      self._fetch_proxy_from_upstream()
+  def request_proxy_refresh(self):
+    """Ask the background refresher to refill the pool now."""
+    if self._refresh_event is not None:
+      self._refresh_event.set()
+
+  async def refresh_proxies(self):
+    """Refill the pool from upstream; concurrent callers share one request.
+    """
+    if self._refresh_task is None or self._refresh_task.done():
+      self._refresh_task = asyncio.ensure_future(
+        self._fetch_proxy_from_upstream())
+    try:
+      await asyncio.shield(self._refresh_task)
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      logger.error('fetch proxies from %r failed: %r', self.upstream_url, e)
+
+  def start_proxy_refresher(self):
+    if self._proxy_refresher is None:
+      self._refresh_event = asyncio.Event()
+      self._proxy_refresher = asyncio.ensure_future(
+        self._refresh_proxies_forever())
+
+  def stop_proxy_refresher(self):
+    if self._proxy_refresher is not None:
+      self._proxy_refresher.cancel()
+      self._proxy_refresher = None
+      self._refresh_event = None
+
+  async def _refresh_proxies_forever(self):
     while True:
-      ip, value = random.choice(list(self.proxy_pool.items()))
-      if value['fail'] > self.max_fail:
-        self.delete_proxy(ip)
-        continue
-      bucket = value.get('bucket')
-      if bucket:
-        if bucket.get() < 1:
-          continue
-        bucket.desc()
-      return 'http://{}'.format(ip.strip())
-
-  def clear_fail_proxy(self):
-    for k, v in self.proxy_pool.items():
-      if v.get('fail') > self.max_fail:
-        del self.proxy_pool[k]
-        self.deleted_proxies.add(k)
+      try:
+        await asyncio.wait_for(self._refresh_event.wait(),
+                               self.update_interval)
+      except asyncio.TimeoutError:
+        pass
+      self._refresh_event.clear()
+      await self.refresh_proxies()
 
   def update_fail_proxy(self, ip):
     ip = ip.split('//')[-1]
-    value = self.proxy_pool.get(ip, {
-      'bucket': Bucket(rate=self.rate, burst=self.burst),
-      'fail': 0,
-    })
-    value['fail'] = value.get('fail', 0) + 1
-    self.proxy_pool.update({ip: value})
+    if self.proxy_pool.fail(ip):
+      self.deleted_proxies.add(ip)
+      if self.valid_proxy_count < self.min_count:
+        self.request_proxy_refresh()
 
   def delete_proxy(self, ip):
     ip = ip.split('//')[-1]
-    del self.proxy_pool[ip]
-    self.valid_proxy_count -= 1
+    self.proxy_pool.remove(ip)
     self.deleted_proxies.add(ip)
     if self.valid_proxy_count < self.min_count:
-      self._fetch_proxy_from_upstream()
+      self.request_proxy_refresh()
 
   def clear_deleted_proxy(self):
     self.deleted_proxies.clear()
     self.last_clear = time.time()
 
-  def _fetch_proxy_from_upstream(self):
-    r = requests.get(self.upstream_url)
-    ips = r.json()
+  async def _fetch_proxy_from_upstream(self):
+    with async_timeout.timeout(self.upstream_timeout):
+      async with self.session.get(self.upstream_url) as r:
+        ips = await r.json(content_type=None)
     now = time.time()
     if now - self.last_clear > self.clear_interval:
       self.clear_deleted_proxy()
-    self.clear_fail_proxy()
     for ip in ips:
-      if ip.strip() not in self.proxy_pool.keys() and ip.strip() not in self.deleted_proxies:
-        self.proxy_pool[ip] = {
-          'bucket': Bucket(rate=self.rate, burst=self.burst),
-          'fail': 0
-        }
-    self.valid_proxy_count = len(self.proxy_pool)
+      ip = ip.strip()
+      if ip not in self.deleted_proxies:
+        self.proxy_pool.add(ip)
+    logger.info('valid ip number is: {}'.format(self.valid_proxy_count))
     self.last_update = time.time()
@@ -0,0 +1,290 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Redis backed frontier shared by several crawler processes.
+
+``RedisFrontier`` implements the frontier interface ``BaseCrawler`` uses
+(``put_nowait``/``get``/``task_done``/``join``/``qsize``) on top of a few
+Redis keys under one namespace:
+
+* ``<ns>:queue``  -- list of pending items (JSON)
+* ``<ns>:seen``   -- set of 64-bit url fingerprints; an url is only queued
+  the first time any process adds it
+* ``<ns>:leases`` -- sorted set of handed out items scored by their lease
+  deadline.  Leases of live workers are extended periodically; items of a
+  crashed worker become visible again once their lease expires
+* ``<ns>:delayed`` -- sorted set of deferred retries scored by due time;
+  due ones are moved to the queue whenever a process pops
+* ``<ns>:feeders`` -- sorted set of processes that still hold unqueued
+  seeds, scored by a heartbeat deadline like the leases
+* ``<ns>:done``   -- set once the queue, the leases, the retries and the
+  feeders are all empty; cleared whenever work is pushed again
+
+Writes of one process go through a single ordered pipe, so links found
+while fetching an url are queued before that url's lease is released.  The
+crawl is therefore only declared done when no process can add more work.
+Any client with an aioredis 1.x style ``execute(*args)`` coroutine works,
+which also makes a local stand-in easy to plug in.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+
+from spinbot.utils.dedup import fingerprint
+
+logger = logging.getLogger(__name__)
+
+PUSH_SCRIPT = """
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+  redis.call('LPUSH', KEYS[1], ARGV[2])
+  redis.call('DEL', KEYS[3])
+  return 1
+end
+return 0
+"""
+
+POP_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[2],
+                       'LIMIT', 0, 100)
+for _, item in ipairs(due) do
+  redis.call('ZREM', KEYS[3], item)
+  redis.call('RPUSH', KEYS[1], item)
+end
+local item = redis.call('RPOP', KEYS[1])
+if item then
+  redis.call('ZADD', KEYS[2], ARGV[1], item)
+end
+return item
+"""
+
+REQUEUE_EXPIRED_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1],
+                           'LIMIT', 0, 100)
+for _, item in ipairs(expired) do
+  redis.call('ZREM', KEYS[2], item)
+  redis.call('RPUSH', KEYS[1], item)
+end
+return #expired
+"""
+
+DONE_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+  return 1
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[5], '-inf', ARGV[1])
+if redis.call('LLEN', KEYS[1]) == 0 and redis.call('ZCARD', KEYS[2]) == 0 and
+   redis.call('ZCARD', KEYS[4]) == 0 and redis.call('ZCARD', KEYS[5]) == 0 then
+  redis.call('SET', KEYS[3], '1')
+  return 1
+end
+return 0
+"""
+
+
+class RedisFrontier(object):
+
+  def __init__(self, namespace='spinbot', redis=None, visibility_timeout=120,
+               poll_interval=0.5):
+    self.namespace = namespace
+    self.queue_key = '{}:queue'.format(namespace)
+    self.seen_key = '{}:seen'.format(namespace)
+    self.leases_key = '{}:leases'.format(namespace)
+    self.done_key = '{}:done'.format(namespace)
+    self.delayed_key = '{}:delayed'.format(namespace)
+    self.feeders_key = '{}:feeders'.format(namespace)
+    self.token = os.urandom(8).hex()
+    self.visibility_timeout = visibility_timeout
+    self.poll_interval = poll_interval
+    self._redis = redis
+    self._ops = deque()
+    self._pump_task = None
+    self._lease_task = None
+    self._leased = {}
+    # Queue length seen at the last pop or lease check, plus the pushes
+    # still on their way to Redis.
+    self._remote_size = 0
+    self._pushes = 0
+    self._seeding = False
+
+  async def redis(self):
+    if self._redis is None:
+      from spinbot.database.redis.redisbase import RedisSession
+      self._redis = await RedisSession().get_redis_pool()
+    return self._redis
+
+  async def _eval(self, script, keys, args):
+    redis = await self.redis()
+    return await redis.execute('EVAL', script, len(keys), *keys, *args)
+
+  # -- ordered writes -------------------------------------------------------
+
+  def _enqueue_op(self, op):
+    if op[0] == 'push':
+      self._pushes += 1
+    self._ops.append(op)
+    if self._pump_task is None or self._pump_task.done():
+      self._pump_task = asyncio.ensure_future(self._pump())
+
+  async def _pump(self):
+    while self._ops:
+      kind, payload, extra = self._ops[0]
+      pushed = 0
+      try:
+        if kind == 'push':
+          pushed = await self._eval(
+            PUSH_SCRIPT, (self.queue_key, self.seen_key, self.done_key),
+            (extra, payload))
+        elif kind == 'defer':
+          redis = await self.redis()
+          await redis.execute('ZADD', self.delayed_key, extra, payload)
+        elif kind == 'done':
+          redis = await self.redis()
+          await redis.execute('ZREM', self.leases_key, payload)
+        elif kind == 'feeder':
+          redis = await self.redis()
+          if extra is None:
+            await redis.execute('ZREM', self.feeders_key, payload)
+          else:
+            await redis.execute('ZADD', self.feeders_key, extra, payload)
+            await redis.execute('DEL', self.done_key)
+      except asyncio.CancelledError:
+        raise
+      except Exception as e:
+        logger.error('redis frontier %s failed: %r, retrying', kind, e)
+        await asyncio.sleep(self.poll_interval)
+        continue
+      self._ops.popleft()
+      if kind == 'push':
+        self._pushes -= 1
+        self._remote_size += pushed
+
+  @staticmethod
+  def _encode(item):
+    url, max_redirect, meta = item
+    return json.dumps([url, max_redirect, meta or {}, os.urandom(6).hex()])
+
+  @staticmethod
+  def _decode(payload):
+    if isinstance(payload, bytes):
+      payload = payload.decode('utf-8')
+    url, max_redirect, meta, _ = json.loads(payload)
+    return url, max_redirect, meta
+
+  def put_nowait(self, item):
+    """Queue item unless some process already queued its url."""
+    seen = fingerprint(item[0]).to_bytes(8, 'little')
+    self._enqueue_op(('push', self._encode(item), seen))
+
+  def defer(self, item, delay):
+    """Queue item again once delay seconds have passed."""
+    self._enqueue_op(('defer', self._encode(item), time.time() + delay))
+
+  def seeding(self, active):
+    """Tell other processes this one still holds seeds it hasn't queued.
+    No process finishes while any live one is seeding.
+    """
+    if active == self._seeding:
+      return
+    self._seeding = active
+    deadline = time.time() + self.visibility_timeout if active else None
+    self._enqueue_op(('feeder', self.token, deadline))
+
+  async def flush(self):
+    """Wait until every queued write reached Redis."""
+    while self._ops:
+      await asyncio.shield(self._pump_task)
+
+  # -- leases ---------------------------------------------------------------
+
+  def _start_lease_keeper(self):
+    if self._lease_task is None or self._lease_task.done():
+      self._lease_task = asyncio.ensure_future(self._keep_leases())
+
+  async def _keep_leases(self):
+    interval = self.visibility_timeout / 3.0
+    while True:
+      try:
+        redis = await self.redis()
+        deadline = time.time() + self.visibility_timeout
+        for _, payload in list(self._leased.values()):
+          await redis.execute('ZADD', self.leases_key, 'XX', deadline, payload)
+        if self._seeding:
+          await redis.execute('ZADD', self.feeders_key, 'XX', deadline,
+                              self.token)
+        requeued = await self._eval(
+          REQUEUE_EXPIRED_SCRIPT, (self.queue_key, self.leases_key),
+          (time.time(),))
+        if requeued:
+          logger.info('requeued %d expired leases', requeued)
+        self._remote_size = await redis.execute('LLEN', self.queue_key)
+      except asyncio.CancelledError:
+        raise
+      except Exception as e:
+        logger.error('redis lease keeper failed: %r', e)
+      await asyncio.sleep(interval)
+
+  async def get(self):
+    self._start_lease_keeper()
+    while True:
+      now = time.time()
+      payload = await self._eval(
+        POP_SCRIPT, (self.queue_key, self.leases_key, self.delayed_key),
+        (now + self.visibility_timeout, now))
+      if payload:
+        item = self._decode(payload)
+        self._leased[id(item)] = (item, payload)
+        self._remote_size = max(0, self._remote_size - 1)
+        return item
+      self._remote_size = 0
+      await asyncio.sleep(self.poll_interval)
+
+  def task_done(self, item):
+    _, payload = self._leased.pop(id(item))
+    self._enqueue_op(('done', payload, None))
+
+  async def join(self):
+    """Wait until no process has queued or leased work left."""
+    while True:
+      if not self._ops and not self._leased and not self._seeding:
+        done = await self._eval(
+          DONE_SCRIPT, (self.queue_key, self.leases_key, self.done_key,
+                        self.delayed_key, self.feeders_key), (time.time(),))
+        if done:
+          return
+      await asyncio.sleep(self.poll_interval)
+
+  async def reset(self):
+    """Forget the whole crawl (queue, seen set, leases, retries, feeders
+    and done flag).
+    """
+    redis = await self.redis()
+    await redis.execute('DEL', self.queue_key, self.seen_key, self.leases_key,
+                        self.done_key, self.delayed_key, self.feeders_key)
+
+  def close(self):
+    for task in (self._pump_task, self._lease_task):
+      if task is not None:
+        task.cancel()
+
+  # -- frontier introspection ----------------------------------------------
+
+  def qsize(self):
+    return self._remote_size + self._pushes
+
+  def empty(self):
+    return self.qsize() == 0
+
+  def snapshot(self):
+    # Redis persists the shared queue itself; nothing to checkpoint locally.
+    return []
+
+  def clear(self):
+    pass
+
+  def host_depths(self):
+    return {}
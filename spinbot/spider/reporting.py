@@ -1,6 +1,19 @@
-"""Reporting subsystem for web crawler."""
+"""Reporting subsystem for web crawler.
 
+Everything here reads the crawler's running aggregates (``FetchStats``), so
+reporting costs the same after a million urls as after ten: ``report`` prints
+the end-of-run text report, ``summary`` returns it as a JSON-friendly dict
+and ``ProgressReporter`` prints periodic progress lines while crawling.
+"""
+
+import asyncio
+import json
+import logging
+import sys
 import time
+from collections import deque, namedtuple
+
+logger = logging.getLogger(__name__)
 
 
 class Stats:
@@ -17,63 +30,310 @@ class Stats:
             print('%10d' % count, key, file=file)
 
 
-def report(crawler, file=None):
-    """Print a report on all completed URLs."""
+def report(crawler, file=None, urls=True):
+    """Print a report from the crawler's aggregated fetch statistics.
+    urls=False leaves out the per-URL lines of the recent fetches.
+    """
     t1 = crawler.t1 or time.time()
     dt = t1 - crawler.t0
+    stats = crawler.stats
     if dt and crawler.max_tasks:
-        speed = len(crawler.done) / dt / crawler.max_tasks
+        speed = len(stats) / dt / crawler.max_tasks
     else:
         speed = 0
-    stats = Stats()
     print('*** Report ***', file=file)
     try:
-        show = list(crawler.done)
-        show.sort(key=lambda _stat: _stat.url)
-        for stat in show:
-            url_report(stat, stats, file=file)
+        if urls and stats.recent:
+            print('Last', len(stats.recent), 'urls:', file=file)
+        for stat in (stats.recent if urls else ()):
+            url_report(stat, file=file)
     except KeyboardInterrupt:
         print('\nInterrupted', file=file)
-    print('Finished', len(crawler.done),
+    print('Finished', len(stats),
           'urls in %.3f secs' % dt,
           '(max_tasks=%d)' % crawler.max_tasks,
           '(%.3f urls/sec/task)' % speed,
           file=file)
-    stats.report(file=file)
+    stats.outcomes.report(file=file)
+    if stats.latency.count:
+        print('Latency: mean %.3fs' % stats.latency.mean,
+              'p50 <= %ss' % stats.latency.percentile(50),
+              'p99 <= %ss' % stats.latency.percentile(99),
+              file=file)
+    for name, count in stats.by_exception.most_common(10):
+        print('%10d' % count, name, file=file)
+    if stats.retries:
+        print('Retries:', sum(stats.retries.values()), file=file)
+        for reason, count in stats.retries.most_common(10):
+            print('%10d' % count, reason, file=file)
+    policy = getattr(crawler, 'retry_policy', None)
+    if policy is not None and (policy.exhausted or policy.over_budget):
+        print('Gave up: %d out of retries, %d over the retry budget'
+              % (policy.exhausted, policy.over_budget), file=file)
+    cache = getattr(crawler, 'http_cache', None)
+    if cache is not None:
+        print('Cache: %d hits, %d misses, %d not modified, %d unchanged'
+              % (cache.hits, cache.misses, cache.not_modified,
+                 cache.unchanged), file=file)
+    concurrency = getattr(crawler, 'concurrency', None)
+    if concurrency is not None:
+        print('Concurrency: limit %d (%d..%d), %d increases, %d decreases'
+              % (concurrency.limit, concurrency.min_limit,
+                 concurrency.max_limit, concurrency.increases,
+                 concurrency.decreases), file=file)
+    sessions = getattr(crawler, 'sessions', None)
+    if sessions is not None:
+        pool = sessions.pool_stats()
+        line = 'Pool: %d/%d connections in use, %d idle' % (
+            pool['acquired'], pool['limit'], pool['idle'])
+        if pool['reuse_ratio'] is not None:
+            line += ', %d new, %d reused (%.1f%% reuse)' % (
+                pool['created'], pool['reused'], 100 * pool['reuse_ratio'])
+        if pool['queued']:
+            line += ', %d waited %.3f secs for a connection' % (
+                pool['queued'], pool['queued_time'])
+        print(line, file=file)
+    pipeline = getattr(crawler, '_pipeline', None)
+    if pipeline is not None:
+        pipeline_stats = pipeline.stats()
+        print('Pipeline: %d items in %d batches' % (
+            pipeline_stats['emitted'], pipeline_stats['batches']), file=file)
+        for name, counts in pipeline_stats['stages'].items():
+            print('%10d' % counts.get('out', 0), name,
+                  '(%d dropped, %d failed, %.3f busy secs%s)' % (
+                      counts.get('dropped', 0), counts.get('failed', 0),
+                      counts['busy_secs'],
+                      ', %.1f/sec' % (counts.get('out', 0) / dt) if dt
+                      else ''), file=file)
+    dead_groups = getattr(crawler, 'dead_groups', None)
+    if dead_groups is not None:
+        print('Skipped groups: %d (%s), %d known dead, %d newly recorded'
+              % (sum(dead_groups.skipped.values()),
+                 ', '.join('%s %d' % item for item in
+                           sorted(dead_groups.skipped.items())) or 'none',
+                 len(dead_groups), sum(dead_groups.recorded.values())),
+              file=file)
     print('Todo:', crawler.q.qsize(), file=file)
-    print('Done:', len(crawler.done), file=file)
+    if hasattr(crawler.q, 'host_depths'):
+        depths = sorted(crawler.q.host_depths().items(),
+                        key=lambda item: item[1], reverse=True)
+        for host, depth in depths[:10]:
+            print('%10d' % depth, host, file=file)
+    print('Done:', len(stats), file=file)
+    seen = crawler.seen_urls
+    if hasattr(seen, 'memory_usage'):
+        print('Seen:', len(seen),
+              'urls in %.1f MiB' % (seen.memory_usage() / 2 ** 20), file=file)
     print('Date:', time.ctime(), 'local time', file=file)
 
 
-def url_report(stat, stats, file=None):
-    """Print a report on the state for this URL.
-    Also update the Stats instance.
+def _bound(value):
+    """JSON has no infinity: the open-ended histogram bucket becomes None."""
+    return None if value == float('inf') else value
+
+
+def summary(crawler):
+    """The final report as a dict ready for json.dump().
+    Latency percentiles are upper bounds of histogram buckets.
+    """
+    t1 = crawler.t1 or time.time()
+    dt = t1 - crawler.t0
+    stats = crawler.stats
+    latency = stats.latency
+    result = {
+        'started': crawler.t0,
+        'finished': t1,
+        'elapsed_secs': dt,
+        'max_tasks': crawler.max_tasks,
+        'urls': len(stats),
+        'bytes': stats.bytes,
+        'urls_per_sec': len(stats) / dt if dt else None,
+        'outcomes': dict(stats.outcomes.stats),
+        'status': {str(status): count
+                   for status, count in stats.by_status.items()},
+        'content_types': dict(stats.by_content_type),
+        'exceptions': dict(stats.by_exception),
+        'retries': dict(stats.retries),
+        'latency': {
+            'count': latency.count,
+            'mean': latency.mean,
+            'p50': _bound(latency.percentile(50)),
+            'p90': _bound(latency.percentile(90)),
+            'p99': _bound(latency.percentile(99)),
+            'p999': _bound(latency.percentile(99.9)),
+        },
+        'todo': crawler.q.qsize(),
+        'seen': len(crawler.seen_urls),
+    }
+    policy = getattr(crawler, 'retry_policy', None)
+    if policy is not None:
+        result['gave_up'] = {'out_of_retries': policy.exhausted,
+                             'over_budget': policy.over_budget}
+    cache = getattr(crawler, 'http_cache', None)
+    if cache is not None:
+        result['cache'] = {'hits': cache.hits, 'misses': cache.misses,
+                           'not_modified': cache.not_modified,
+                           'unchanged': cache.unchanged}
+    concurrency = getattr(crawler, 'concurrency', None)
+    if concurrency is not None:
+        result['concurrency'] = {'limit': concurrency.limit,
+                                 'increases': concurrency.increases,
+                                 'decreases': concurrency.decreases}
+    sessions = getattr(crawler, 'sessions', None)
+    if sessions is not None:
+        result['pool'] = sessions.pool_stats()
+    pipeline = getattr(crawler, '_pipeline', None)
+    if pipeline is not None:
+        result['pipeline'] = pipeline.stats()
+    dead_groups = getattr(crawler, 'dead_groups', None)
+    if dead_groups is not None:
+        result['skipped_groups'] = dict(dead_groups.skipped)
+    # A merged sharded crawl has a users count; a crawler's users property
+    # would connect to MongoDB.
+    if hasattr(crawler, '_users'):
+        result['users'] = len(crawler._users)
+    elif isinstance(getattr(crawler, 'users', None), int):
+        result['users'] = crawler.users
+    if hasattr(crawler, 'shards'):
+        result['shards'] = crawler.shards
+    return result
+
+
+def write_summary(crawler, path):
+    """Write summary(crawler) as JSON to path, or to stdout for '-'."""
+    text = json.dumps(summary(crawler), indent=2, sort_keys=True)
+    if path == '-':
+        print(text)
+        return
+    with open(path, 'w') as fp:
+        fp.write(text + '\n')
+
+
+def _duration(secs):
+    secs = int(secs)
+    return '%d:%02d:%02d' % (secs // 3600, secs // 60 % 60, secs % 60)
+
+
+_Sample = namedtuple('_Sample', 'time total bytes outcomes retries swept')
+
+
+class ProgressReporter:
+    """Print a progress line every interval seconds while a crawl runs.
+
+    Rates and the error mix cover the last window seconds; they are
+    differences between samples of the running aggregates.  Crawlers with a
+    sweep_progress() returning (done, total), like the Douban group range,
+    also get an ETA.
     """
+
+    def __init__(self, interval=10, window=60, file=None, label=None):
+        self.interval = interval
+        self.window = window
+        self.file = file
+        self.label = label
+        self._samples = deque()
+        self._task = None
+
+    def start(self, crawler):
+        if self._task is None:
+            self._samples.clear()
+            self._sample(crawler)
+            self._task = asyncio.ensure_future(self._report_forever(crawler))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _report_forever(self, crawler):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                print(self.line(crawler), file=self.file or sys.stderr,
+                      flush=True)
+            except Exception:
+                logger.exception('progress report failed')
+
+    def _sample(self, crawler):
+        stats = crawler.stats
+        progress = getattr(crawler, 'sweep_progress', None)
+        swept = progress() if progress is not None else None
+        sample = _Sample(time.time(), len(stats), stats.bytes,
+                         dict(stats.outcomes.stats), dict(stats.retries),
+                         swept)
+        self._samples.append(sample)
+        # Keep one sample at or beyond the window as the baseline.
+        while (len(self._samples) > 2 and
+               sample.time - self._samples[1].time >= self.window):
+            self._samples.popleft()
+        return sample
+
+    def line(self, crawler):
+        """Take a sample and describe the progress since the window start."""
+        now = self._sample(crawler)
+        first = self._samples[0]
+        dt = now.time - first.time
+        urls = now.total - first.total
+        parts = ['%d urls' % now.total]
+        if self.label:
+            parts.insert(0, self.label)
+        if dt > 0:
+            parts.append('%.1f urls/sec, %.2f MiB/sec' % (
+                urls / dt, (now.bytes - first.bytes) / dt / 2 ** 20))
+        errors = {}
+        for key, count in now.outcomes.items():
+            if key.startswith(('fail_', 'status_')):
+                count -= first.outcomes.get(key, 0)
+                if count:
+                    errors[key] = count
+        # Retried attempts never reach the outcomes; show why they failed.
+        for reason, count in now.retries.items():
+            count -= first.retries.get(reason, 0)
+            if count:
+                errors['retry_' + reason] = count
+        failed = sum(now.outcomes.get(key, 0) - first.outcomes.get(key, 0)
+                     for key in ('fail', 'error'))
+        if urls:
+            mix = sorted(errors.items(), key=lambda item: item[1],
+                         reverse=True)[:3]
+            parts.append('errors %.1f%%%s' % (
+                100.0 * failed / urls,
+                ' (%s)' % ', '.join('%s %d' % item for item in mix)
+                if mix else ''))
+        queue = 'queue %d' % crawler.q.qsize()
+        in_flight = getattr(crawler, '_in_flight', None)
+        if in_flight is not None:
+            queue += ', %d in flight' % len(in_flight)
+        if hasattr(crawler.q, 'delayed'):
+            queue += ', %d retrying' % crawler.q.delayed()
+        parts.append(queue)
+        if now.swept is not None:
+            done, total = now.swept
+            sweep = 'swept %d/%d' % (done, total)
+            if total:
+                sweep += ' (%.1f%%)' % (100.0 * done / total)
+            if first.swept is not None and dt > 0 and done > first.swept[0]:
+                rate = (done - first.swept[0]) / dt
+                sweep += ' ETA %s' % _duration((total - done) / rate)
+            parts.append(sweep)
+        return ' | '.join(parts)
+
+
+def url_report(stat, file=None):
+    """Print a report on the state for this URL."""
     if stat.exception:
-        stats.add('fail')
-        stats.add('fail_' + str(stat.exception.__class__.__name__))
         print(stat.url, 'error', stat.exception, file=file)
     elif stat.next_url:
-        stats.add('redirect')
         print(stat.url, stat.status, 'redirect', stat.next_url,
               file=file)
     elif stat.content_type == 'text/html':
-        stats.add('html')
-        stats.add('html_bytes', stat.size)
         print(stat.url, stat.status,
               stat.content_type, stat.encoding,
               stat.size,
               '%d/%d' % (stat.num_new_urls, stat.num_urls),
               file=file)
     else:
-        if stat.status == 200:
-            stats.add('other')
-            stats.add('other_bytes', stat.size)
-        else:
-            stats.add('error')
-            stats.add('error_bytes', stat.size)
-            stats.add('status_%s' % stat.status)
         print(stat.url, stat.status,
               stat.content_type, stat.encoding,
               stat.size,
-              file=file)
\ No newline at end of file
+              file=file)
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Retry policy: exponential backoff with jitter and retry budgets.
+
+A failed url is not retried in place.  The crawler asks ``RetryPolicy``
+whether it may try again; if so the url is deferred on the frontier for
+``backoff(attempt)`` seconds and the worker moves on to fresh work.  Each url
+gets at most ``max_retries`` retries, and the whole run at most ``budget``
+retries and ``budget_ratio`` retries per finished fetch (plus
+``min_budget``), so a ban wave can't turn the crawl into a retry storm.
+"""
+
+import random
+
+
+class RetryError(Exception):
+  """Raised when an operation still fails after its last try."""
+
+
+def backoff(attempt, base_delay=1.0, factor=2.0, max_delay=300.0,
+            jitter=0.5):
+  """Delay before retry number attempt (0 based).
+
+  The exponential delay is capped at max_delay, then up to a jitter
+  fraction of it is taken off at random so retries of urls that failed
+  together don't come back together.
+  """
+  delay = min(max_delay, base_delay * factor ** attempt)
+  return delay * (1 - jitter * random.random())
+
+
+class RetryPolicy(object):
+
+  def __init__(self, max_retries=3, base_delay=1.0, factor=2.0,
+               max_delay=300.0, jitter=0.5, budget=None, budget_ratio=None,
+               min_budget=10):
+    self.max_retries = max_retries
+    self.base_delay = base_delay
+    self.factor = factor
+    self.max_delay = max_delay
+    self.jitter = jitter
+    self.budget = budget
+    self.budget_ratio = budget_ratio
+    self.min_budget = min_budget
+    self.retries = 0
+    self.exhausted = 0
+    self.over_budget = 0
+
+  def delay(self, attempt):
+    return backoff(attempt, self.base_delay, self.factor, self.max_delay,
+                   self.jitter)
+
+  def within_budget(self, fetched=0):
+    if self.budget is not None and self.retries >= self.budget:
+      return False
+    if (self.budget_ratio is not None and
+        self.retries >= self.min_budget + self.budget_ratio * fetched):
+      return False
+    return True
+
+  def schedule(self, attempt, fetched=0):
+    """Delay before retry number attempt, or None to give up.
+    fetched is the number of fetches finished so far, for budget_ratio.
+    """
+    if attempt >= self.max_retries:
+      self.exhausted += 1
+      return None
+    if not self.within_budget(fetched):
+      self.over_budget += 1
+      return None
+    self.retries += 1
+    return self.delay(attempt)
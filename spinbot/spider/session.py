@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""HTTP session and connection pool of a crawler.
+
+``SessionManager`` builds the crawler's ``aiohttp.ClientSession`` on an
+explicitly sized ``TCPConnector``: the total limit follows ``max_tasks``,
+idle connections are kept alive for reuse (aiohttp keys them by target and
+proxy, so each proxy endpoint keeps its own warm connections) and resolved
+addresses are cached for ``dns_ttl`` seconds.  Where aiohttp supports
+request tracing it also counts new versus reused connections and the time
+requests spent waiting for a free one.
+"""
+
+import logging
+import time
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class SessionManager(object):
+
+  def __init__(self, limit=10, limit_per_host=0, keepalive_timeout=30,
+               dns_ttl=300, *, loop=None):
+    self.limit = limit
+    self.limit_per_host = limit_per_host
+    self.keepalive_timeout = keepalive_timeout
+    self.dns_ttl = dns_ttl
+    self.loop = loop
+    self.created = 0
+    self.reused = 0
+    self.queued = 0
+    self.queued_time = 0.0
+    self._connector = None
+    self._session = None
+
+  def _trace_configs(self):
+    if not hasattr(aiohttp, 'TraceConfig'):
+      return []
+
+    async def on_create(session, context, params):
+      self.created += 1
+
+    async def on_reuse(session, context, params):
+      self.reused += 1
+
+    async def on_queued_start(session, context, params):
+      context.queued_at = time.monotonic()
+
+    async def on_queued_end(session, context, params):
+      self.queued += 1
+      self.queued_time += time.monotonic() - context.queued_at
+
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_create_end.append(on_create)
+    trace.on_connection_reuseconn.append(on_reuse)
+    trace.on_connection_queued_start.append(on_queued_start)
+    trace.on_connection_queued_end.append(on_queued_end)
+    return [trace]
+
+  @property
+  def connector(self):
+    if self._connector is None:
+      self._connector = aiohttp.TCPConnector(
+        limit=self.limit, limit_per_host=self.limit_per_host,
+        keepalive_timeout=self.keepalive_timeout, use_dns_cache=True,
+        ttl_dns_cache=self.dns_ttl, loop=self.loop)
+    return self._connector
+
+  @property
+  def session(self):
+    if self._session is None or self._session.closed:
+      # A closed session took its connector down with it.
+      self._connector = None
+      options = {}
+      trace_configs = self._trace_configs()
+      if trace_configs:
+        options['trace_configs'] = trace_configs
+      self._session = aiohttp.ClientSession(
+        connector=self.connector, loop=self.loop, **options)
+    return self._session
+
+  def pool_stats(self):
+    """Connections in use and idle, occupancy and reuse ratio."""
+    connector = self._connector
+    acquired = len(getattr(connector, '_acquired', ()))
+    idle = sum(len(conns) for conns in
+               getattr(connector, '_conns', {}).values())
+    connects = self.created + self.reused
+    return {
+      'limit': self.limit,
+      'acquired': acquired,
+      'idle': idle,
+      'occupancy': acquired / self.limit if self.limit else None,
+      'created': self.created,
+      'reused': self.reused,
+      'reuse_ratio': self.reused / connects if connects else None,
+      'queued': self.queued,
+      'queued_time': self.queued_time,
+    }
+
+  def close(self):
+    """Close the session (and its connector); returns what aiohttp's close
+    returns, a coroutine on aiohttp 3.
+    """
+    session, self._session = self._session, None
+    self._connector = None
+    if session is not None:
+      return session.close()
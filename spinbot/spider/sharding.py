@@ -0,0 +1,393 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Multi-process crawling.
+
+``run_sharded`` starts one process per shard, each with its own event loop
+and crawler.  Urls belong to the shard picked by a consistent hash of the
+crawler's ``shard_key`` (the host, or the group id for Douban); links a
+shard doesn't own are batched and forwarded to the owner's inbox queue.
+
+A shard whose local queue drained reports ``idle`` with the number of
+batches it sent and received.  Once every shard is idle and the totals
+match, the coordinator probes all shards again and stops the crawl only if
+none of them changed in between, so no batch can still be in flight.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+from collections import Counter, OrderedDict, defaultdict
+
+from spinbot.spider.stats import FetchStats
+from spinbot.utils.hashring import HashRing
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SIZE = 256
+
+
+def shard_path(path, shard):
+  """Per shard variant of a file or directory option ('a.gz' -> 'a.shard0.gz')
+  """
+  if not path:
+    return path
+  root, ext = os.path.splitext(path)
+  return '{}.shard{}{}'.format(root, shard, ext)
+
+
+class ShardLink(object):
+  """One crawler's connection to the other shards and the coordinator."""
+
+  def __init__(self, index, inboxes, control, poll_interval=0.05):
+    self.index = index
+    self.inboxes = inboxes
+    self.control = control
+    self.ring = HashRing(range(len(inboxes)))
+    self.poll_interval = poll_interval
+    self.sent = 0
+    self.received = 0
+    self.forwarded = 0
+    self._outbox = defaultdict(list)
+    self._idle = False
+    self._stopped = False
+    self._wakeup = None
+    self._pump_task = None
+
+  def owner(self, key):
+    return self.ring.node_for(key)
+
+  def owns(self, key):
+    return self.owner(key) == self.index
+
+  def forward(self, owner, item):
+    batch = self._outbox[owner]
+    batch.append(item)
+    self.forwarded += 1
+    if len(batch) >= FLUSH_SIZE:
+      self._flush_to(owner)
+
+  def flush(self):
+    for owner in list(self._outbox):
+      self._flush_to(owner)
+
+  def _flush_to(self, owner):
+    batch = self._outbox.pop(owner, None)
+    if batch:
+      self.sent += 1
+      self.inboxes[owner].put(('urls', batch))
+
+  def _wake(self):
+    self._idle = False
+    if self._wakeup is not None and not self._wakeup.done():
+      self._wakeup.set_result(None)
+
+  def start(self, crawler):
+    if self._pump_task is None:
+      self._pump_task = asyncio.ensure_future(self._pump(crawler))
+
+  def stop(self):
+    if self._pump_task is not None:
+      self._pump_task.cancel()
+      self._pump_task = None
+
+  async def _pump(self, crawler):
+    inbox = self.inboxes[self.index]
+    while True:
+      self.flush()
+      try:
+        message = inbox.get_nowait()
+      except queue.Empty:
+        await asyncio.sleep(self.poll_interval)
+        continue
+      kind = message[0]
+      if kind == 'urls':
+        self.received += 1
+        for url, max_redirect, meta in message[1]:
+          if url not in crawler.seen_urls:
+            crawler.add_url(url, max_redirect, meta)
+        # Even all-duplicate batches change our counters: report again.
+        self._wake()
+      elif kind == 'probe':
+        self.control.put(('probe', self.index, message[1], self._idle,
+                          self.sent, self.received))
+      elif kind == 'stop':
+        self._stopped = True
+        self._wake()
+      await asyncio.sleep(0)
+
+  async def join(self, crawler):
+    """Wait for the local queue, then until the coordinator stops the crawl.
+    """
+    loop = asyncio.get_event_loop()
+    while not self._stopped:
+      self._wakeup = loop.create_future()
+      joined = asyncio.ensure_future(crawler.q.join())
+      await asyncio.wait([joined, self._wakeup],
+                         return_when=asyncio.FIRST_COMPLETED)
+      if not joined.done():
+        joined.cancel()
+        continue
+      self.flush()
+      self._idle = True
+      self.control.put(('idle', self.index, self.sent, self.received))
+      await self._wakeup
+
+
+class Coordinator(object):
+  """Detects global termination and collects the shards' results."""
+
+  def __init__(self, processes, inboxes, control, poll_interval=0.2):
+    self.processes = processes
+    self.inboxes = inboxes
+    self.control = control
+    self.poll_interval = poll_interval
+    self._status = {}
+    self._probe = None
+    self._rounds = 0
+    self._stopping = False
+
+  def stop(self):
+    if not self._stopping:
+      self._stopping = True
+      for inbox in self.inboxes:
+        inbox.put(('stop',))
+
+  def _maybe_probe(self):
+    status = self._status
+    if (self._probe is not None or self._stopping or
+        len(status) < len(self.processes)):
+      return
+    if sum(s for s, _ in status.values()) != sum(r for _, r in
+                                                 status.values()):
+      return
+    self._rounds += 1
+    self._probe = (self._rounds, dict(status), {})
+    for inbox in self.inboxes:
+      inbox.put(('probe', self._rounds))
+
+  def _probe_reply(self, index, probe_round, idle, sent, received):
+    if self._probe is None or self._probe[0] != probe_round:
+      return
+    _, snapshot, replies = self._probe
+    replies[index] = (idle, sent, received)
+    if idle:
+      self._status[index] = (sent, received)
+    else:
+      self._status.pop(index, None)
+    if len(replies) < len(self.processes):
+      return
+    self._probe = None
+    if all(reply == (True,) + snapshot[i] for i, reply in replies.items()):
+      logger.info('all shards idle after %d probes, stopping', self._rounds)
+      self.stop()
+    else:
+      self._maybe_probe()
+
+  def run(self):
+    """Block until every shard reported its result; return the results."""
+    results = {}
+    while len(results) < len(self.processes):
+      try:
+        message = self.control.get(timeout=self.poll_interval)
+      except queue.Empty:
+        for index, process in enumerate(self.processes):
+          if index not in results and not process.is_alive():
+            logger.error('shard %d exited with %r', index, process.exitcode)
+            results[index] = None
+            self.stop()
+        continue
+      except KeyboardInterrupt:
+        self.stop()
+        continue
+      kind, index = message[:2]
+      if kind == 'idle':
+        self._status[index] = message[2:]
+        self._maybe_probe()
+      elif kind == 'probe':
+        self._probe_reply(index, *message[2:])
+      elif kind == 'result':
+        results[index] = message[2]
+    return [results[index] for index in range(len(self.processes))]
+
+
+def _run_shard(target, index, inboxes, control, *args):
+  link = ShardLink(index, inboxes, control)
+  summary = None
+  try:
+    summary = target(link, *args)
+  finally:
+    control.put(('result', index, summary))
+    # Don't block exit on batches nobody will read any more.
+    for inbox in inboxes:
+      inbox.cancel_join_thread()
+
+
+def run_sharded(processes, target, *args):
+  """Run target(shard_link, *args) in one process per shard.
+  Return the values target returned, one per shard (None if it failed).
+  """
+  context = multiprocessing.get_context('spawn')
+  inboxes = [context.Queue() for _ in range(processes)]
+  control = context.Queue()
+  workers = [
+    context.Process(target=_run_shard, name='shard-{}'.format(index),
+                    args=(target, index, inboxes, control) + args)
+    for index in range(processes)
+  ]
+  for worker in workers:
+    worker.start()
+  try:
+    results = Coordinator(workers, inboxes, control).run()
+  finally:
+    for inbox in inboxes:
+      inbox.cancel_join_thread()
+    for worker in workers:
+      worker.join()
+  return results
+
+
+def shard_summary(crawler):
+  """Picklable summary of a finished crawler, see MergedCrawl."""
+  seen = crawler.seen_urls
+  cache = crawler.http_cache
+  policy = getattr(crawler, 'retry_policy', None)
+  pipeline = getattr(crawler, '_pipeline', None)
+  dead_groups = getattr(crawler, 'dead_groups', None)
+  return {
+    't0': crawler.t0,
+    't1': crawler.t1,
+    'max_tasks': crawler.max_tasks,
+    'stats': crawler.stats.state(),
+    'recent': list(crawler.stats.recent),
+    'pending': crawler.q.qsize(),
+    'host_depths': (crawler.q.host_depths()
+                    if hasattr(crawler.q, 'host_depths') else {}),
+    'seen': len(seen),
+    'seen_bytes': (seen.memory_usage()
+                   if hasattr(seen, 'memory_usage') else 0),
+    'cache': (None if cache is None else
+              (cache.hits, cache.misses, cache.not_modified, cache.unchanged)),
+    'users': len(getattr(crawler, '_users', ())),
+    'gave_up': (None if policy is None else
+                (policy.exhausted, policy.over_budget)),
+    'pipeline': None if pipeline is None else pipeline.stats(),
+    'dead_groups': (None if dead_groups is None else
+                    (dict(dead_groups.skipped), dict(dead_groups.recorded),
+                     len(dead_groups))),
+  }
+
+
+class _MergedFrontier(object):
+
+  def __init__(self, pending, depths):
+    self._pending = pending
+    self._depths = depths
+
+  def qsize(self):
+    return self._pending
+
+  def host_depths(self):
+    return self._depths
+
+
+class _MergedSeen(object):
+
+  def __init__(self, count, size):
+    self._count = count
+    self._size = size
+
+  def __len__(self):
+    return self._count
+
+  def memory_usage(self):
+    return self._size
+
+
+class _MergedCache(object):
+
+  def __init__(self, hits, misses, not_modified, unchanged):
+    self.hits = hits
+    self.misses = misses
+    self.not_modified = not_modified
+    self.unchanged = unchanged
+
+
+class _MergedRetryPolicy(object):
+
+  def __init__(self, exhausted, over_budget):
+    self.exhausted = exhausted
+    self.over_budget = over_budget
+
+
+class _MergedPipeline(object):
+
+  def __init__(self, stats):
+    self._stats = {'emitted': 0, 'batches': 0, 'stages': OrderedDict()}
+    for shard_stats in stats:
+      self._stats['emitted'] += shard_stats['emitted']
+      self._stats['batches'] += shard_stats['batches']
+      for name, counts in shard_stats['stages'].items():
+        merged = self._stats['stages'].setdefault(name, {})
+        for key, value in counts.items():
+          merged[key] = merged.get(key, 0) + value
+
+  def stats(self):
+    return self._stats
+
+
+class _MergedDeadGroups(object):
+
+  def __init__(self, groups):
+    self.skipped = Counter()
+    self.recorded = Counter()
+    self._count = 0
+    for skipped, recorded, count in groups:
+      self.skipped.update(skipped)
+      self.recorded.update(recorded)
+      self._count += count
+
+  def __len__(self):
+    return self._count
+
+
+class MergedCrawl(object):
+  """Shard summaries folded into the crawler attributes report() reads."""
+
+  def __init__(self, summaries):
+    summaries = [summary for summary in summaries if summary]
+    self.shards = len(summaries)
+    self.stats = FetchStats(
+      ring_size=max(1, sum(len(s['recent']) for s in summaries)))
+    depths = defaultdict(int)
+    caches = []
+    for summary in summaries:
+      self.stats.merge(summary['stats'])
+      self.stats.recent.extend(summary['recent'])
+      for host, depth in summary['host_depths'].items():
+        depths[host] += depth
+      if summary['cache'] is not None:
+        caches.append(summary['cache'])
+    self.t0 = min((s['t0'] for s in summaries), default=0)
+    self.t1 = max((s['t1'] or 0 for s in summaries), default=0) or None
+    self.max_tasks = sum(s['max_tasks'] for s in summaries)
+    self.q = _MergedFrontier(sum(s['pending'] for s in summaries),
+                             dict(depths))
+    self.seen_urls = _MergedSeen(sum(s['seen'] for s in summaries),
+                                 sum(s['seen_bytes'] for s in summaries))
+    self.http_cache = (_MergedCache(*map(sum, zip(*caches)))
+                       if caches else None)
+    self.users = sum(s['users'] for s in summaries)
+    gave_up = [s['gave_up'] for s in summaries if s.get('gave_up')]
+    if gave_up:
+      self.retry_policy = _MergedRetryPolicy(*map(sum, zip(*gave_up)))
+    pipelines = [s['pipeline'] for s in summaries if s.get('pipeline')]
+    if pipelines:
+      self._pipeline = _MergedPipeline(pipelines)
+    dead_groups = [s['dead_groups'] for s in summaries
+                   if s.get('dead_groups')]
+    if dead_groups:
+      self.dead_groups = _MergedDeadGroups(dead_groups)
@@ -0,0 +1,179 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Constant-memory fetch statistics.
+
+``FetchStats`` replaces the ever-growing ``crawler.done`` list.  Each
+``FetchStatistic`` is folded into running aggregates (outcome counters, status,
+content type and exception class counts, byte totals and a latency
+histogram), kept in a fixed-size ring buffer of recent records, and
+optionally streamed as JSON lines to a gzip file.  Records never keep the
+live exception object, only its repr.
+"""
+
+import bisect
+import gzip
+import json
+from collections import Counter, deque
+
+from spinbot.spider.reporting import Stats
+
+
+class LatencyHistogram(object):
+  """Fixed-bucket latency histogram (seconds)."""
+
+  BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+            30.0, 60.0, float('inf'))
+
+  def __init__(self, bounds=None):
+    self.bounds = tuple(bounds or self.BOUNDS)
+    self.counts = [0] * len(self.bounds)
+    self.count = 0
+    self.sum = 0.0
+
+  def add(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def percentile(self, p):
+    """Upper bound of the bucket holding the p-th percentile (0-100)."""
+    if not self.count:
+      return None
+    rank = p / 100.0 * self.count
+    seen = 0
+    for bound, count in zip(self.bounds, self.counts):
+      seen += count
+      if seen >= rank:
+        return bound
+    return self.bounds[-1]
+
+  def merge(self, other):
+    for index, count in enumerate(other.counts):
+      self.counts[index] += count
+    self.count += other.count
+    self.sum += other.sum
+
+  @property
+  def mean(self):
+    return self.sum / self.count if self.count else None
+
+
+def classify(stat, stats):
+  """Update the outcome counters of a Stats instance for one FetchStatistic.
+  """
+  if stat.exception:
+    stats.add('fail')
+    stats.add('fail_' + exception_name(stat.exception))
+  elif stat.next_url:
+    stats.add('redirect')
+  elif stat.status == 304:
+    stats.add('not_modified')
+  elif stat.content_type == 'text/html':
+    stats.add('html')
+    stats.add('html_bytes', stat.size)
+  elif stat.status == 200:
+    stats.add('other')
+    stats.add('other_bytes', stat.size)
+  else:
+    stats.add('error')
+    stats.add('error_bytes', stat.size)
+    stats.add('status_%s' % stat.status)
+
+
+def exception_name(exception):
+  if isinstance(exception, str):
+    return exception.split('(', 1)[0]
+  return exception.__class__.__name__
+
+
+class FetchStats(object):
+  """Running aggregates plus a bounded view of recent fetches."""
+
+  def __init__(self, ring_size=1000, path=None):
+    self.outcomes = Stats()
+    self.by_status = Counter()
+    self.by_content_type = Counter()
+    self.by_exception = Counter()
+    self.retries = Counter()
+    self.latency = LatencyHistogram()
+    self.total = 0
+    self.bytes = 0
+    self.recent = deque(maxlen=ring_size)
+    self.path = path
+    self._file = gzip.open(path, 'at', encoding='utf-8') if path else None
+
+  def __len__(self):
+    return self.total
+
+  def record(self, stat, elapsed=None):
+    classify(stat, self.outcomes)
+    self.total += 1
+    self.bytes += stat.size or 0
+    self.by_status[stat.status] += 1
+    if stat.content_type:
+      self.by_content_type[stat.content_type] += 1
+    if stat.exception:
+      self.by_exception[exception_name(stat.exception)] += 1
+      stat = stat._replace(exception=repr(stat.exception))
+    if elapsed is not None:
+      self.latency.add(elapsed)
+    self.recent.append(stat)
+    if self._file is not None:
+      record = stat._asdict()
+      record['elapsed'] = elapsed
+      self._file.write(json.dumps(record) + '\n')
+
+  def record_retry(self, reason):
+    self.retries[reason] += 1
+
+  def state(self):
+    """Picklable snapshot of the aggregates (not the ring or the file)."""
+    return {
+      'outcomes': dict(self.outcomes.stats),
+      'by_status': dict(self.by_status),
+      'by_content_type': dict(self.by_content_type),
+      'by_exception': dict(self.by_exception),
+      'retries': dict(self.retries),
+      'latency': (self.latency.bounds, list(self.latency.counts),
+                  self.latency.count, self.latency.sum),
+      'total': self.total,
+      'bytes': self.bytes,
+    }
+
+  def restore(self, state):
+    self.outcomes.stats = dict(state['outcomes'])
+    self.by_status = Counter(state['by_status'])
+    self.by_content_type = Counter(state['by_content_type'])
+    self.by_exception = Counter(state['by_exception'])
+    self.retries = Counter(state.get('retries', {}))
+    bounds, counts, count, total = state['latency']
+    self.latency = LatencyHistogram(bounds)
+    self.latency.counts = list(counts)
+    self.latency.count = count
+    self.latency.sum = total
+    self.total = state['total']
+    self.bytes = state['bytes']
+
+  def merge(self, state):
+    """Add the aggregates of another FetchStats' state() to this one."""
+    for key, count in state['outcomes'].items():
+      self.outcomes.add(key, count)
+    self.by_status.update(state['by_status'])
+    self.by_content_type.update(state['by_content_type'])
+    self.by_exception.update(state['by_exception'])
+    self.retries.update(state.get('retries', {}))
+    bounds, counts, count, total = state['latency']
+    other = LatencyHistogram(bounds)
+    other.counts = list(counts)
+    other.count = count
+    other.sum = total
+    self.latency.merge(other)
+    self.total += state['total']
+    self.bytes += state['bytes']
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
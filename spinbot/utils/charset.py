@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Decide the encoding of a fetched page once.
+
+Order: charset from the Content-Type header, then a ``<meta charset>`` /
+``http-equiv`` declaration in the first few KB, then cchardet (if installed)
+and finally utf-8.
+"""
+
+import codecs
+import re
+
+try:
+  import cchardet
+except ImportError:
+  cchardet = None
+
+META_CHARSET_RE = re.compile(
+  br'''<meta[^>]+charset\s*=\s*["']?\s*([A-Za-z0-9_.:-]+)''', re.I)
+
+SNIFF_BYTES = 4096
+DEFAULT_ENCODING = 'utf-8'
+
+
+def normalize_encoding(name):
+  """Return the canonical codec name, or None if Python doesn't know it."""
+  if not name:
+    return None
+  if isinstance(name, bytes):
+    name = name.decode('ascii', 'ignore')
+  try:
+    return codecs.lookup(name.strip()).name
+  except LookupError:
+    return None
+
+
+def detect_encoding(body, declared=None, sniff_bytes=SNIFF_BYTES):
+  """Return (encoding, source) for body; source is header/meta/chardet/default.
+  """
+  encoding = normalize_encoding(declared)
+  if encoding:
+    return encoding, 'header'
+  head = body[:sniff_bytes]
+  match = META_CHARSET_RE.search(head)
+  if match:
+    encoding = normalize_encoding(match.group(1))
+    if encoding:
+      return encoding, 'meta'
+  if cchardet is not None and body:
+    result = cchardet.detect(head)
+    encoding = normalize_encoding(result.get('encoding'))
+    if encoding and (result.get('confidence') or 0) > 0.5:
+      return encoding, 'chardet'
+  return DEFAULT_ENCODING, 'default'
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Adaptive concurrency limits.
+
+``ResizableSemaphore`` is a semaphore whose limit can change while tasks
+hold or wait for slots.  ``AIMDController`` drives its limit like TCP
+congestion control: every ``window`` observed fetches it either grows the
+limit by ``increase`` (additive) when fetches succeed and slots are busy,
+or cuts it by ``decrease`` (multiplicative) when the failure or timeout
+rate is too high or latency climbs well above the best seen so far.
+"""
+
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class ResizableSemaphore(object):
+
+  def __init__(self, limit):
+    self.limit = limit
+    self.in_use = 0
+    self._waiters = deque()
+
+  def locked(self):
+    return self.in_use >= self.limit
+
+  async def acquire(self):
+    if self.in_use < self.limit and not self._waiters:
+      self.in_use += 1
+      return
+    waiter = asyncio.get_event_loop().create_future()
+    self._waiters.append(waiter)
+    try:
+      await waiter
+    except asyncio.CancelledError:
+      if waiter.done() and not waiter.cancelled():
+        # The slot was handed over just before we got cancelled.
+        self.release()
+      raise
+
+  def release(self):
+    self.in_use -= 1
+    self._wake()
+
+  def resize(self, limit):
+    self.limit = limit
+    self._wake()
+
+  def _wake(self):
+    while self._waiters and self.in_use < self.limit:
+      waiter = self._waiters.popleft()
+      if not waiter.done():
+        self.in_use += 1
+        waiter.set_result(None)
+
+  async def __aenter__(self):
+    await self.acquire()
+
+  async def __aexit__(self, *exc_info):
+    self.release()
+
+
+class AIMDController(object):
+
+  def __init__(self, initial, min_limit=1, max_limit=None, increase=1,
+               decrease=0.5, window=20, min_success=0.9, max_timeouts=0.1,
+               latency_tolerance=3.0):
+    self.min_limit = min_limit
+    self.max_limit = max_limit or initial
+    self.increase = increase
+    self.decrease = decrease
+    self.window = window
+    self.min_success = min_success
+    self.max_timeouts = max_timeouts
+    self.latency_tolerance = latency_tolerance
+    self.slots = ResizableSemaphore(self._clamp(initial))
+    self.increases = 0
+    self.decreases = 0
+    self.base_latency = None
+    self._reset_window()
+
+  def _clamp(self, limit):
+    return max(self.min_limit, min(self.max_limit, limit))
+
+  def _reset_window(self):
+    self._count = 0
+    self._failures = 0
+    self._timeouts = 0
+    self._latencies = []
+    self._saturated = 0
+
+  @property
+  def limit(self):
+    return self.slots.limit
+
+  def acquire(self):
+    return self.slots.acquire()
+
+  def release(self):
+    self.slots.release()
+
+  def observe(self, success, timeout=False, latency=None):
+    """Account for one finished fetch, adjusting the limit every window."""
+    self._count += 1
+    if not success:
+      self._failures += 1
+    if timeout:
+      self._timeouts += 1
+    if latency is not None:
+      self._latencies.append(latency)
+    # Only grow when the limit is what holds the crawl back.
+    if self.slots.in_use >= self.slots.limit - 1:
+      self._saturated += 1
+    if self._count >= self.window:
+      self._adjust()
+      self._reset_window()
+
+  def _adjust(self):
+    count = self._count
+    success = 1 - self._failures / count
+    timeouts = self._timeouts / count
+    p90 = None
+    if self._latencies:
+      latencies = sorted(self._latencies)
+      p50 = latencies[len(latencies) // 2]
+      p90 = latencies[int(len(latencies) * 0.9)]
+      if self.base_latency is None or p50 < self.base_latency:
+        self.base_latency = p50
+    if success < self.min_success:
+      reason = 'success rate %.2f' % success
+    elif timeouts > self.max_timeouts:
+      reason = 'timeout rate %.2f' % timeouts
+    elif (p90 is not None and self.base_latency and
+          p90 > self.latency_tolerance * self.base_latency):
+      reason = 'p90 latency %.3fs vs base %.3fs' % (p90, self.base_latency)
+    else:
+      if self._saturated >= count / 2:
+        self._set_limit(self.limit + self.increase,
+                        'success rate %.2f' % success)
+      return
+    self._set_limit(int(self.limit * self.decrease), reason)
+
+  def _set_limit(self, limit, reason):
+    old = self.limit
+    limit = self._clamp(limit)
+    if limit == old:
+      return
+    if limit > old:
+      self.increases += 1
+    else:
+      self.decreases += 1
+    logger.info('concurrency %d -> %d (%s)', old, limit, reason)
+    self.slots.resize(limit)
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Compact seen-URL stores for the crawler.
+
+Two interchangeable stores are provided:
+
+* ``FingerprintSet`` keeps a 64-bit fingerprint per URL in an open addressing
+  table backed by ``array('Q')``.  The table doubles once it is 70% full, so
+  it costs about 11 to 23 bytes per URL.  False positives only happen on a
+  64-bit hash collision.
+* ``ScalableBloomFilter`` chains bloom filters of growing size so the overall
+  false positive rate stays under ``error_rate`` however many URLs are added.
+
+Both support ``add``, ``update``, ``in``, ``len`` and ``memory_usage``.
+"""
+
+import hashlib
+import math
+import sys
+from array import array
+
+
+def fingerprint(url):
+  """Return the 64-bit fingerprint of an url (never 0)."""
+  if isinstance(url, str):
+    url = url.encode('utf-8')
+  value = int.from_bytes(hashlib.blake2b(url, digest_size=8).digest(), 'little')
+  return value or 1
+
+
+class FingerprintSet(object):
+  """Exact (modulo 64-bit collisions) set of url fingerprints."""
+
+  MAX_LOAD = 0.7
+
+  def __init__(self, capacity=1 << 16):
+    self._count = 0
+    self._journal = None
+    self._allocate(self._table_size(capacity))
+
+  def _table_size(self, capacity):
+    return 1 << max(4, int(capacity / self.MAX_LOAD).bit_length())
+
+  def _allocate(self, size):
+    self._table = array('Q', bytes(8 * size))
+    self._mask = size - 1
+    self._limit = int(size * self.MAX_LOAD)
+
+  def _grow(self):
+    old = self._table
+    self._allocate(len(old) * 2)
+    for value in old:
+      if value:
+        self._insert(value)
+
+  def _insert(self, value):
+    table = self._table
+    mask = self._mask
+    index = value & mask
+    while True:
+      slot = table[index]
+      if not slot:
+        table[index] = value
+        return True
+      if slot == value:
+        return False
+      index = (index + 1) & mask
+
+  def add_fingerprint(self, value):
+    if self._count >= self._limit:
+      self._grow()
+    added = self._insert(value)
+    if added:
+      self._count += 1
+      if self._journal is not None:
+        self._journal.append(value)
+    return added
+
+  def add(self, url):
+    """Add an url, return True if it was not seen before."""
+    return self.add_fingerprint(fingerprint(url))
+
+  def update(self, urls):
+    for url in urls:
+      self.add(url)
+
+  def __contains__(self, url):
+    value = fingerprint(url)
+    table = self._table
+    mask = self._mask
+    index = value & mask
+    while True:
+      slot = table[index]
+      if not slot:
+        return False
+      if slot == value:
+        return True
+      index = (index + 1) & mask
+
+  def __len__(self):
+    return self._count
+
+  def fingerprints(self):
+    """Iterate over the stored fingerprints."""
+    return (value for value in self._table if value)
+
+  def start_journal(self, include_existing=True):
+    """Record fingerprints added from now on (for incremental checkpoints).
+    """
+    self._journal = array('Q')
+    if include_existing:
+      self._journal.extend(self.fingerprints())
+
+  def drain_journal(self):
+    """Return the fingerprints added since the last drain as array('Q')."""
+    journal = self._journal
+    if journal is None:
+      return array('Q')
+    self._journal = array('Q')
+    return journal
+
+  def restore_journal(self, values):
+    """Put back what drain_journal() returned, e.g. when storing it failed.
+    """
+    if self._journal is not None:
+      values.extend(self._journal)
+      self._journal = values
+
+  def load_fingerprints(self, values):
+    while self._count + len(values) > self._limit:
+      self._grow()
+    for value in values:
+      self.add_fingerprint(value)
+
+  def memory_usage(self):
+    """Approximate number of bytes held by the store."""
+    return self._table.itemsize * len(self._table) + sys.getsizeof(self)
+
+
+class BloomFilter(object):
+  """Fixed capacity bloom filter using double hashing."""
+
+  def __init__(self, capacity, error_rate):
+    self.capacity = capacity
+    self.error_rate = error_rate
+    num_bits = int(math.ceil(
+      -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+    self.num_bits = max(8, num_bits)
+    self.num_hashes = max(1, int(round(
+      self.num_bits / capacity * math.log(2))))
+    self._bits = bytearray((self.num_bits + 7) // 8)
+    self.count = 0
+
+  def _indexes(self, h1, h2):
+    num_bits = self.num_bits
+    for i in range(self.num_hashes):
+      yield (h1 + i * h2) % num_bits
+
+  def contains_hashes(self, h1, h2):
+    bits = self._bits
+    for index in self._indexes(h1, h2):
+      if not bits[index >> 3] & (1 << (index & 7)):
+        return False
+    return True
+
+  def add_hashes(self, h1, h2):
+    bits = self._bits
+    added = False
+    for index in self._indexes(h1, h2):
+      mask = 1 << (index & 7)
+      if not bits[index >> 3] & mask:
+        bits[index >> 3] |= mask
+        added = True
+    if added:
+      self.count += 1
+    return added
+
+  @property
+  def full(self):
+    return self.count >= self.capacity
+
+  def memory_usage(self):
+    return len(self._bits) + sys.getsizeof(self)
+
+
+class ScalableBloomFilter(object):
+  """Bloom filter that adds larger slices as it fills up.
+
+  Each new slice has ``growth`` times the capacity of the previous one and a
+  false positive rate tightened by ``tightening``, which bounds the compound
+  rate by ``error_rate``.
+  """
+
+  def __init__(self, capacity=1 << 20, error_rate=0.001, growth=2,
+               tightening=0.85):
+    self.initial_capacity = capacity
+    self.error_rate = error_rate
+    self.growth = growth
+    self.tightening = tightening
+    self.filters = []
+    self._add_filter()
+
+  def _add_filter(self):
+    index = len(self.filters)
+    capacity = self.initial_capacity * self.growth ** index
+    error_rate = self.error_rate * (1 - self.tightening) * (
+      self.tightening ** index)
+    self.filters.append(BloomFilter(capacity, error_rate))
+
+  @staticmethod
+  def _hashes(url):
+    if isinstance(url, str):
+      url = url.encode('utf-8')
+    digest = hashlib.blake2b(url, digest_size=16).digest()
+    return (int.from_bytes(digest[:8], 'little'),
+            int.from_bytes(digest[8:], 'little') | 1)
+
+  def add(self, url):
+    """Add an url, return True if it was (probably) not seen before."""
+    h1, h2 = self._hashes(url)
+    for bloom in self.filters:
+      if bloom.contains_hashes(h1, h2):
+        return False
+    if self.filters[-1].full:
+      self._add_filter()
+    return self.filters[-1].add_hashes(h1, h2)
+
+  def update(self, urls):
+    for url in urls:
+      self.add(url)
+
+  def __contains__(self, url):
+    h1, h2 = self._hashes(url)
+    return any(bloom.contains_hashes(h1, h2) for bloom in self.filters)
+
+  def __len__(self):
+    return sum(bloom.count for bloom in self.filters)
+
+  def memory_usage(self):
+    return sum(bloom.memory_usage() for bloom in self.filters) + \
+      sys.getsizeof(self)
+
+
+SEEN_STORES = {
+  'exact': FingerprintSet,
+  'bloom': ScalableBloomFilter,
+}
+
+
+def seen_store_mode(store):
+  """The create_seen_store() mode of store (its class name if custom)."""
+  for mode, store_class in SEEN_STORES.items():
+    if type(store) is store_class:
+      return mode
+  return type(store).__name__
+
+
+def create_seen_store(mode='exact', **options):
+  """Build a seen-URL store by mode name ('exact' or 'bloom')."""
+  try:
+    store_class = SEEN_STORES[mode]
+  except KeyError:
+    raise ValueError('Unknown dedup mode: {!r}'.format(mode))
+  return store_class(**options)
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Consistent hash ring.
+
+Each node is placed on the ring ``replicas`` times; a key belongs to the
+first node point clockwise from its hash.  Adding or removing a node only
+moves the keys of that node, so e.g. a crawl resumed with a different
+number of processes keeps most urls on the shard that already saw them.
+"""
+
+import bisect
+import hashlib
+
+
+def _hash(value):
+  if isinstance(value, str):
+    value = value.encode('utf-8')
+  return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'big')
+
+
+class HashRing(object):
+
+  def __init__(self, nodes=(), replicas=64):
+    self.replicas = replicas
+    self._points = []
+    self._nodes = []
+    for node in nodes:
+      self.add(node)
+
+  def add(self, node):
+    for replica in range(self.replicas):
+      point = _hash('{}#{}'.format(node, replica))
+      index = bisect.bisect(self._points, point)
+      self._points.insert(index, point)
+      self._nodes.insert(index, node)
+
+  def remove(self, node):
+    keep = [(point, owner) for point, owner in zip(self._points, self._nodes)
+            if owner != node]
+    self._points = [point for point, _ in keep]
+    self._nodes = [owner for _, owner in keep]
+
+  def node_for(self, key):
+    if not self._points:
+      raise LookupError('empty hash ring')
+    index = bisect.bisect(self._points, _hash(key))
+    if index == len(self._points):
+      index = 0
+    return self._nodes[index]
+
+  def __len__(self):
+    return len(set(self._nodes))
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Persistent negative cache over a numeric id space.
+
+``NegativeIdCache`` remembers ids known to be useless (e.g. dead, private
+or redirecting Douban groups), why, and the day they were last checked.
+Like roaring bitmaps, ids are split into chunks of 65536 keyed by their
+high bits; each chunk holds sorted ``array('H')`` offsets with parallel
+day and reason arrays, about 5 bytes per id.  The file format is those
+arrays written chunk by chunk, replaced atomically on save.
+"""
+
+import bisect
+import logging
+import os
+import struct
+import time
+from array import array
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SPNC'
+VERSION = 1
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+DAY = 24 * 60 * 60
+
+
+class _Chunk(object):
+  __slots__ = ('offsets', 'days', 'reasons')
+
+  def __init__(self):
+    self.offsets = array('H')
+    self.days = array('H')
+    self.reasons = array('B')
+
+
+class NegativeIdCache(object):
+
+  REASONS = ('dead', 'private', 'redirect')
+
+  def __init__(self, path=None, recheck_days=30, clock=time.time):
+    self.path = path
+    self.recheck_days = recheck_days
+    self._clock = clock
+    self._chunks = {}
+    self._count = 0
+    self.skipped = Counter()
+    self.recorded = Counter()
+    self.cleared = 0
+    if path and os.path.exists(path):
+      self.load()
+
+  def _today(self):
+    return int(self._clock() // DAY)
+
+  def _find(self, value):
+    chunk = self._chunks.get(value >> CHUNK_BITS)
+    if chunk is None:
+      return None, -1
+    offset = value & CHUNK_MASK
+    index = bisect.bisect_left(chunk.offsets, offset)
+    if index < len(chunk.offsets) and chunk.offsets[index] == offset:
+      return chunk, index
+    return chunk, -1
+
+  def add(self, value, reason):
+    """Record value as useless for reason, checked today."""
+    code = self.REASONS.index(reason) + 1
+    today = self._today()
+    chunk, index = self._find(value)
+    if index >= 0:
+      chunk.days[index] = today
+      chunk.reasons[index] = code
+    else:
+      if chunk is None:
+        chunk = self._chunks[value >> CHUNK_BITS] = _Chunk()
+      offset = value & CHUNK_MASK
+      index = bisect.bisect_left(chunk.offsets, offset)
+      chunk.offsets.insert(index, offset)
+      chunk.days.insert(index, today)
+      chunk.reasons.insert(index, code)
+      self._count += 1
+    self.recorded[reason] += 1
+
+  def discard(self, value):
+    chunk, index = self._find(value)
+    if index < 0:
+      return
+    del chunk.offsets[index]
+    del chunk.days[index]
+    del chunk.reasons[index]
+    self._count -= 1
+    self.cleared += 1
+    if not chunk.offsets:
+      del self._chunks[value >> CHUNK_BITS]
+
+  def get(self, value):
+    """Return (reason, last checked timestamp) or None."""
+    chunk, index = self._find(value)
+    if index < 0:
+      return None
+    return (self.REASONS[chunk.reasons[index] - 1],
+            chunk.days[index] * DAY)
+
+  def should_skip(self, value):
+    """True if value is known useless and not due for a recheck yet."""
+    chunk, index = self._find(value)
+    if index < 0:
+      return False
+    if self._today() - chunk.days[index] >= self.recheck_days:
+      return False
+    self.skipped[self.REASONS[chunk.reasons[index] - 1]] += 1
+    return True
+
+  def __contains__(self, value):
+    return self._find(value)[1] >= 0
+
+  def __len__(self):
+    return self._count
+
+  def memory_usage(self):
+    return sum(chunk.offsets.itemsize * len(chunk.offsets) +
+               chunk.days.itemsize * len(chunk.days) + len(chunk.reasons)
+               for chunk in self._chunks.values())
+
+  def save(self, path=None):
+    path = path or self.path
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+      fp.write(MAGIC + struct.pack('<II', VERSION, len(self._chunks)))
+      for key in sorted(self._chunks):
+        chunk = self._chunks[key]
+        fp.write(struct.pack('<II', key, len(chunk.offsets)))
+        chunk.offsets.tofile(fp)
+        chunk.days.tofile(fp)
+        chunk.reasons.tofile(fp)
+      fp.flush()
+      os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+    logger.info('saved %d negative ids to %s', self._count, path)
+
+  def load(self, path=None):
+    path = path or self.path
+    with open(path, 'rb') as fp:
+      header = fp.read(12)
+      if header[:4] != MAGIC:
+        raise ValueError('Not a negative id cache: {!r}'.format(path))
+      version, num_chunks = struct.unpack('<II', header[4:])
+      if version != VERSION:
+        raise ValueError('Unsupported negative id cache version: {!r}'
+                         .format(version))
+      self._chunks = {}
+      self._count = 0
+      for _ in range(num_chunks):
+        key, size = struct.unpack('<II', fp.read(8))
+        chunk = _Chunk()
+        chunk.offsets.fromfile(fp, size)
+        chunk.days.fromfile(fp, size)
+        chunk.reasons.fromfile(fp, size)
+        self._chunks[key] = chunk
+        self._count += size
+    logger.info('loaded %d negative ids from %s', self._count, path)
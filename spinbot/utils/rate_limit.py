@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""Awaitable rate limiting on top of token_bucket.Bucket.
+
+``RateLimiter.acquire(n)`` sleeps exactly until ``n`` tokens are available
+instead of polling.  ``RateLimits`` groups a global limiter with lazily
+created per-host and per-proxy limiters; ``acquire`` waits until every
+applicable limiter can serve the request and then takes the tokens from all
+of them at once.
+"""
+
+import asyncio
+import time
+
+from spinbot.utils.token_bucket import Bucket
+
+
+class RateLimiter(object):
+
+  def __init__(self, rate, burst=None, clock=time.monotonic):
+    self.bucket = Bucket(rate=rate, burst=burst if burst is not None else 1,
+                         clock=clock)
+
+  @property
+  def rate(self):
+    return self.bucket.rate
+
+  @property
+  def burst(self):
+    return self.bucket.burst
+
+  def delay(self, n=1):
+    """Seconds until n tokens are available."""
+    return self.bucket.delay(n)
+
+  def try_acquire(self, n=1):
+    if self.bucket.get() >= n:
+      self.bucket.desc(n)
+      return True
+    return False
+
+  async def acquire(self, n=1):
+    await acquire_all((self,), n)
+
+
+async def acquire_all(limiters, n=1):
+  """Wait until every limiter has n tokens, then take them from all."""
+  for limiter in limiters:
+    if n > limiter.burst:
+      raise ValueError('cannot acquire {} tokens with burst {}'.format(
+        n, limiter.burst))
+  while True:
+    delay = max((limiter.delay(n) for limiter in limiters), default=0.0)
+    if delay <= 0:
+      for limiter in limiters:
+        limiter.bucket.desc(n)
+      return
+    await asyncio.sleep(delay)
+
+
+class RateLimits(object):
+  """Hierarchical limits: global, per host and per proxy.
+
+  A rate of None disables that level.
+  """
+
+  def __init__(self, global_rate=None, host_rate=None, proxy_rate=None,
+               burst=1, clock=time.monotonic):
+    self.host_rate = host_rate
+    self.proxy_rate = proxy_rate
+    self.burst = burst
+    self._clock = clock
+    self.global_limiter = None
+    if global_rate:
+      self.global_limiter = RateLimiter(global_rate, burst, clock)
+    self._host_limiters = {}
+    self._proxy_limiters = {}
+
+  def __bool__(self):
+    return bool(self.global_limiter or self.host_rate or self.proxy_rate)
+
+  def _limiter(self, limiters, key, rate):
+    limiter = limiters.get(key)
+    if limiter is None:
+      limiter = limiters[key] = RateLimiter(rate, self.burst, self._clock)
+    return limiter
+
+  def limiters(self, host=None, proxy=None):
+    limiters = []
+    if self.global_limiter:
+      limiters.append(self.global_limiter)
+    if host and self.host_rate:
+      limiters.append(self._limiter(self._host_limiters, host, self.host_rate))
+    if proxy and self.proxy_rate:
+      limiters.append(
+        self._limiter(self._proxy_limiters, proxy, self.proxy_rate))
+    return limiters
+
+  async def acquire(self, host=None, proxy=None, n=1):
+    limiters = self.limiters(host, proxy)
+    if limiters:
+      await acquire_all(limiters, n)
@@ -16,29 +16,24 @@ class Bucket(object):
 
     update_interval = 30
 
-    def __init__(self, rate=1, burst=None):
+    def __init__(self, rate=1, burst=None, clock=time.monotonic):
         self.rate = float(rate)
         if burst is None:
             self.burst = float(rate) * 10
         else:
             self.burst = float(burst)
+        self.clock = clock
         self.bucket = self.burst
-        self.last_update = time.time()
+        self.last_update = clock()
 
     def get(self):
         """Get the number of tokens in bucket
         """
-        now = time.time()
-        if self.bucket >= self.burst:
-            self.last_update = now
-            return self.bucket
-        # TODO:
-        bucket = self.rate * (now - self.last_update)
-        if bucket > 1:
-            self.bucket += bucket
-            if self.bucket > self.burst:
-                self.bucket = self.burst
-            self.last_update = now
+        now = self.clock()
+        if self.bucket < self.burst:
+            self.bucket = min(
+                self.burst, self.bucket + self.rate * (now - self.last_update))
+        self.last_update = now
         return self.bucket
 
     def set(self, value):
@@ -46,6 +41,14 @@ class Bucket(object):
         """
         self.bucket = value
 
+    def delay(self, value=1):
+        """Seconds until value tokens can be taken from the bucket
+        """
+        missing = value - self.get()
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate
+
     def desc(self, value=1):
         """Use value tokens"""
         self.bucket -= value
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# vim:set shiftwidth=2 tabstop=2 expandtab textwidth=79:
+
+"""RedisFrontier's Lua scripts against fakeredis, with two frontiers sharing
+one server standing in for two crawler processes.
+"""
+
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+# fakeredis runs EVAL through lupa.
+pytest.importorskip('lupa')
+
+from spinbot.spider.redis_frontier import RedisFrontier  # noqa: E402
+
+
+class Connection(object):
+  """The execute(*args) interface RedisFrontier expects from a pool."""
+
+  def __init__(self, server):
+    self._redis = fakeredis.FakeAsyncRedis(server=server)
+
+  async def execute(self, *args):
+    # Like aioredis, a cancelled caller doesn't abort the command itself
+    # (redis-py drops the connection and may retry instead).
+    return await asyncio.shield(self._redis.execute_command(*args))
+
+
+def frontiers(count=2, **kwargs):
+  server = fakeredis.FakeServer()
+  kwargs.setdefault('poll_interval', 0.01)
+  return [RedisFrontier(namespace='test', redis=Connection(server), **kwargs)
+          for _ in range(count)]
+
+
+def run(coro):
+  return asyncio.run(asyncio.wait_for(coro, 10))
+
+
+async def finished(frontier, timeout=0.2):
+  try:
+    await asyncio.wait_for(frontier.join(), timeout)
+  except asyncio.TimeoutError:
+    return False
+  return True
+
+
+def test_seen_set_is_shared():
+  async def main():
+    a, b = frontiers()
+    a.put_nowait(('http://example.com/', 10, None))
+    b.put_nowait(('http://example.com/', 10, None))
+    b.put_nowait(('http://example.com/other', 10, None))
+    await a.flush()
+    await b.flush()
+    redis = await a.redis()
+    assert await redis.execute('LLEN', a.queue_key) == 2
+    assert a.qsize() == 1 and b.qsize() == 1
+    urls = sorted([(await b.get())[0] for _ in range(2)])
+    assert urls == ['http://example.com/', 'http://example.com/other']
+    a.close()
+    b.close()
+  run(main())
+
+
+def test_expired_lease_is_requeued():
+  async def main():
+    a, b = frontiers(visibility_timeout=0.3)
+    a.put_nowait(('http://example.com/', 10, {'depth': 1}))
+    await a.flush()
+    assert await a.get() == ('http://example.com/', 10, {'depth': 1})
+    # a "crashes": its lease keeper stops renewing and nobody calls
+    # task_done, so the url comes back to b once the lease runs out.
+    a.close()
+    assert not await finished(b)
+    assert await b.get() == ('http://example.com/', 10, {'depth': 1})
+    redis = await b.redis()
+    assert await redis.execute('ZCARD', b.leases_key) == 1
+    b.close()
+  run(main())
+
+
+def test_live_lease_is_kept():
+  async def main():
+    a, b = frontiers(visibility_timeout=0.3)
+    a.put_nowait(('http://example.com/', 10, None))
+    await a.flush()
+    item = await a.get()
+    getter = asyncio.ensure_future(b.get())
+    await asyncio.sleep(0.6)
+    assert not getter.done()
+    getter.cancel()
+    a.task_done(item)
+    await a.flush()
+    assert await finished(a) and await finished(b)
+    a.close()
+    b.close()
+  run(main())
+
+
+def test_done_waits_for_every_frontier():
+  async def main():
+    a, b = frontiers()
+    a.put_nowait(('http://example.com/', 10, None))
+    await a.flush()
+    item = await b.get()
+    # a has nothing of its own left but b still holds a lease.
+    assert not await finished(a)
+    b.put_nowait(('http://example.com/next', 10, None))
+    b.task_done(item)
+    await b.flush()
+    assert not await finished(a)
+    item = await a.get()
+    a.task_done(item)
+    await a.flush()
+    assert await finished(a) and await finished(b)
+    a.close()
+    b.close()
+  run(main())
+
+
+def test_done_waits_for_deferred_retries():
+  async def main():
+    a, = frontiers(count=1)
+    a.put_nowait(('http://example.com/', 10, None))
+    await a.flush()
+    item = await a.get()
+    a.defer(item, 0.3)
+    a.task_done(item)
+    await a.flush()
+    assert not await finished(a)
+    item = await a.get()
+    a.task_done(item)
+    assert await finished(a)
+    a.close()
+  run(main())
+
+
+def test_done_waits_for_seeding_frontiers():
+  async def main():
+    a, b = frontiers()
+    b.seeding(True)
+    await b.flush()
+    # The queue is empty, but b has seeds it hasn't pushed yet.
+    assert not await finished(a)
+    b.put_nowait(('http://example.com/', 10, None))
+    b.seeding(False)
+    await b.flush()
+    assert not await finished(a)
+    a.task_done(await a.get())
+    assert await finished(a) and await finished(b)
+    a.close()
+    b.close()
+  run(main())
+
+
+def test_new_work_clears_done_flag():
+  async def main():
+    a, b = frontiers()
+    assert await finished(a)
+    # A later run without a reset must not exit at once.
+    b.seeding(True)
+    b.put_nowait(('http://example.com/', 10, None))
+    b.seeding(False)
+    await b.flush()
+    assert not await finished(b)
+    b.task_done(await b.get())
+    assert await finished(b)
+    a.close()
+    b.close()
+  run(main())